@@ -0,0 +1,385 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Load benchmark for main.py and nuclei-api.py against stub nmap/nuclei
+#
+#   python benchmarks/bench_api.py --requests 50 --concurrency 8 --out bench.json
+#
+# The API modules are copied to a temporary directory and served by
+# hypercorn from there, with benchmarks/stubs first on PATH, so no real
+# scanning happens and nmap_scans/ in the checkout stays untouched.
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+SCENARIOS = ("scan", "async", "file", "rate", "nuclei")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+
+
+def latency_stats(values: list) -> dict:
+    return {
+        "p50_ms": percentile(values, 0.50),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": round(max(values) * 1000, 2) if values else None,
+    }
+
+
+def rss_mb(pid: int, field: str = "VmRSS"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+# serve the app in the launched process itself (like main.py's __main__),
+# so its pid is the one whose RSS is sampled
+LAUNCHER = """
+import asyncio, importlib, sys
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+config = Config()
+config.bind = ["127.0.0.1:" + sys.argv[2]]
+asyncio.run(serve(importlib.import_module(sys.argv[1]).app, config))
+"""
+
+
+class Server:
+    def __init__(self, workdir: str, module: str, env: dict, probe: str):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.probe = probe
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", LAUNCHER, module, str(self.port)],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server on port {self.port} exited with {self.process.returncode}")
+            try:
+                await client.get(self.url + self.probe)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"server on port {self.port} did not start")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class Monitor:
+    """Samples the server's RSS and how long a trivial request takes while a
+    scenario runs; the latter is dominated by event-loop lag. Runs in its own
+    thread so the load generator's event loop does not skew it."""
+
+    def __init__(self, server: Server, interval: float = 0.05):
+        self.server = server
+        self.interval = interval
+        self.lag = []
+        self.rss = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        with httpx.Client(timeout=60) as client:
+            while not self.stopped.is_set():
+                t0 = time.perf_counter()
+                try:
+                    client.get(self.server.url + self.server.probe)
+                    self.lag.append(time.perf_counter() - t0)
+                except httpx.HTTPError:
+                    pass
+                rss = rss_mb(self.server.process.pid)
+                if rss is not None:
+                    self.rss.append(rss)
+                self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def report(self) -> dict:
+        return {"loop_lag": latency_stats(self.lag), "peak_rss_mb": max(self.rss) if self.rss else None}
+
+
+async def run_load(requests: int, concurrency: int, fn) -> dict:
+    latencies, errors = [], 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with limit:
+            t0 = time.perf_counter()
+            try:
+                ok = await fn(i)
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - t0)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        **latency_stats(latencies),
+    }
+
+
+def scan_body(i: int, output: list = ()) -> dict:
+    # a distinct target per request so the result cache never short-circuits
+    return {"target": f"10.{i // 256 % 256}.{i % 256}.0/24", "options": list(output), "max_age": 0}
+
+
+async def poll(client, url: str, done, interval: float, timings: list, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        t0 = time.perf_counter()
+        r = await client.get(url)
+        timings.append(time.perf_counter() - t0)
+        body = r.json()
+        if done(body):
+            return body
+        await asyncio.sleep(interval)
+    return None
+
+
+async def bench_scan(client, main: Server, args) -> dict:
+    async def fn(i):
+        r = await client.post(main.url + "/scan", json=scan_body(i))
+        return r.status_code == 200 and "error" not in r.json()
+    return await run_load(args.requests, args.concurrency, fn)
+
+
+async def bench_async(client, main: Server, args) -> dict:
+    polls = []
+
+    async def fn(i):
+        r = await client.post(main.url + "/scan/async", json=scan_body(i))
+        job_id = r.json().get("job_id")
+        if not job_id:
+            return False
+        job = await poll(client, f"{main.url}/scan/async/{job_id}",
+                         lambda b: b.get("status") not in ("running", "queued"),
+                         args.poll_interval, polls, args.timeout)
+        return bool(job) and "error" not in job
+    result = await run_load(args.requests, args.concurrency, fn)
+    result["status_poll"] = dict(latency_stats(polls), polls=len(polls))
+    return result
+
+
+async def bench_file(client, main: Server, args) -> dict:
+    # one large report, then concurrent full and filtered reads of it
+    r = await client.post(main.url + "/scan", json=dict(scan_body(0), options=[{"id": 151, "value": "bench.xml"}]),
+                          timeout=args.timeout)
+    report = r.json().get("output_file")
+    if not report:
+        return {"error": r.json()}
+    full = {"output_file": report, "output_mode": 2}
+    query = dict(full, port="443", state="open", limit=100, fields="address,ports.port")
+
+    async def fetch(params):
+        r = await client.get(main.url + "/file", params=params, timeout=args.timeout)
+        # don't decode multi-megabyte bodies in the load generator
+        return r.status_code == 200 and not r.content.startswith(b'{"error"')
+
+    first = time.perf_counter()
+    await fetch(full)
+    return {
+        "report_hosts": args.file_hosts,
+        "first_fetch_ms": round((time.perf_counter() - first) * 1000, 2),
+        "full": await run_load(args.requests, args.concurrency, lambda i: fetch(full)),
+        "query": await run_load(args.requests, args.concurrency, lambda i: fetch(query)),
+    }
+
+
+async def bench_rate(client, main: Server, args) -> dict:
+    # async scans, every other one sharded, under a rate budget: each scan
+    # (or each shard) has to report the packet rate nmap observed
+    polls, missing = [], []
+
+    async def fn(i):
+        body = dict(scan_body(i), shards=2) if i % 2 else scan_body(i)
+        r = await client.post(main.url + "/scan/async", json=body)
+        job_id = r.json().get("job_id")
+        if not job_id:
+            return False
+        job = await poll(client, f"{main.url}/scan/async/{job_id}",
+                         lambda b: b.get("status") not in ("running", "queued"),
+                         args.poll_interval, polls, args.timeout)
+        if not job or "error" in job:
+            return False
+        rates = [s.get("rate") for s in job["shards"]] if "shards" in job else [job.get("rate")]
+        if not all(rate and rate.get("observed") is not None for rate in rates):
+            missing.append(job_id)
+            return False
+        return True
+    result = await run_load(args.requests, args.concurrency, fn)
+    result["missing_observed"] = len(missing)
+    result["status_poll"] = dict(latency_stats(polls), polls=len(polls))
+    return result
+
+
+async def bench_nuclei(client, nuclei: Server, args) -> dict:
+    polls = []
+
+    async def fn(i):
+        r = await client.post(nuclei.url + "/nuclei/scan", json={"target": f"http://10.0.0.{i % 256}"})
+        job_id = r.json().get("job_id")
+        if not job_id:
+            return False
+        job = await poll(client, f"{nuclei.url}/jobs/{job_id}?limit=0",
+                         lambda b: b.get("status") not in ("running", "queued"),
+                         args.poll_interval, polls, args.timeout)
+        return bool(job) and job.get("status") == "completed"
+    result = await run_load(args.requests, args.concurrency, fn)
+    result["status_poll"] = dict(latency_stats(polls), polls=len(polls))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args, workdir: str) -> dict:
+    env = dict(os.environ)
+    env["PATH"] = STUBS_DIR + os.pathsep + env.get("PATH", "")
+    env.update({
+        "BENCH_HOSTS": str(args.hosts),
+        "BENCH_PORTS": str(args.ports),
+        "BENCH_RUNTIME": str(args.runtime),
+        "BENCH_FINDINGS": str(args.findings),
+        "BENCH_NUCLEI_RUNTIME": str(args.runtime),
+        "NUCLEI_TEMPLATES_DIR": os.path.join(workdir, "no-templates"),
+    })
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": vars(args),
+        },
+        "scenarios": {},
+    }
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    servers = {}
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout, limits=httpx.Limits(max_connections=None)) as client:
+            if set(scenarios) & {"scan", "async", "file", "rate"}:
+                servers["main"] = Server(workdir, "main", env, "/alive")
+                await servers["main"].wait_ready(client)
+            if "nuclei" in scenarios:
+                servers["nuclei"] = Server(workdir, "nuclei-api", env, "/jobs/bench-probe")
+                await servers["nuclei"].wait_ready(client)
+            for name in scenarios:
+                server = servers["nuclei" if name == "nuclei" else "main"]
+                if name == "file":
+                    # the report for /file is larger than the per-scan default
+                    server.stop()
+                    servers["main"] = server = Server(workdir, "main", dict(env, BENCH_HOSTS=str(args.file_hosts)), "/alive")
+                    await server.wait_ready(client)
+                elif name == "rate":
+                    # the rate budget is off by default
+                    server.stop()
+                    servers["main"] = server = Server(workdir, "main", dict(env, NMAP_RATE_BUDGET=str(args.rate_budget)), "/alive")
+                    await server.wait_ready(client)
+                fn = {"scan": bench_scan, "async": bench_async, "file": bench_file, "rate": bench_rate,
+                      "nuclei": bench_nuclei}[name]
+                with Monitor(server) as monitor:
+                    result = await fn(client, server, args)
+                result.update(monitor.report())
+                # the server's own counters (GET /metrics?format=json), cumulative per server
+                r = await client.get(server.url + "/metrics", params={"format": "json"})
+                result["server_metrics"] = r.json() if r.status_code == 200 else None
+                results["scenarios"][name] = result
+            for name, server in servers.items():
+                results["meta"][f"{name}_peak_rss_mb"] = rss_mb(server.process.pid, "VmHWM")
+    finally:
+        for server in servers.values():
+            server.stop()
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma separated: {', '.join(SCENARIOS)}")
+    ap.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--hosts", type=int, default=256, help="hosts per stub nmap scan")
+    ap.add_argument("--file-hosts", type=int, default=20000, help="hosts in the report read by the file scenario")
+    ap.add_argument("--ports", type=int, default=4)
+    ap.add_argument("--runtime", type=float, default=0.5, help="seconds per stub nmap/nuclei run")
+    ap.add_argument("--rate-budget", type=int, default=100000, help="NMAP_RATE_BUDGET for the rate scenario")
+    ap.add_argument("--findings", type=int, default=50, help="findings per nuclei target")
+    ap.add_argument("--poll-interval", type=float, default=0.2)
+    ap.add_argument("--timeout", type=float, default=300)
+    ap.add_argument("--out", help="write the JSON results here as well")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for path in glob.glob(os.path.join(REPO_DIR, "*.py")):
+            if os.path.basename(path) != "nmap-testing.py":
+                shutil.copy(path, workdir)
+        results = asyncio.run(run(args, workdir))
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
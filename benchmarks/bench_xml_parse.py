@@ -0,0 +1,77 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Compare the streaming parser against the old libnmap-based parser
+#
+#   python benchmarks/bench_xml_parse.py --hosts 100000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nmap_xml import iter_nmap_hosts, parse_nmap_xml
+from synthetic import write_report
+
+
+def libnmap_to_dict(path: str) -> list:
+    from libnmap.parser import NmapParser
+    report = NmapParser.parse_fromfile(path)
+    result = []
+    for host in report.hosts:
+        host_data = {"address": host.address, "status": host.status, "ports": []}
+        for service in host.services:
+            host_data["ports"].append({
+                "port": service.port,
+                "protocol": service.protocol,
+                "state": service.state,
+                "service": service.service,
+                "banner": service.banner
+            })
+        result.append(host_data)
+    return result
+
+
+def stream_count(path: str) -> int:
+    return sum(1 for _ in iter_nmap_hosts(path))
+
+
+def measure(fn, path):
+    # timing and peak memory come from separate runs; tracemalloc itself
+    # slows allocation-heavy code down several times
+    t0 = time.perf_counter()
+    out = fn(path)
+    elapsed = time.perf_counter() - t0
+    del out
+    tracemalloc.start()
+    out = fn(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, {"seconds": round(elapsed, 3), "peak_mb": round(peak / 2**20, 1)}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--hosts", type=int, default=100000)
+    ap.add_argument("--ports", type=int, default=4)
+    ap.add_argument("--skip-libnmap", action="store_true")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_report(os.path.join(tmp, "bench.xml"), args.hosts, args.ports)
+        report = {"hosts": args.hosts, "xml_mb": round(os.path.getsize(path) / 2**20, 1)}
+
+        streamed, report["stream_list"] = measure(parse_nmap_xml, path)
+        _, report["stream_iter"] = measure(stream_count, path)
+        if not args.skip_libnmap:
+            old, report["libnmap"] = measure(libnmap_to_dict, path)
+            report["identical"] = old == streamed
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
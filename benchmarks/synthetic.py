@@ -0,0 +1,71 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Synthetic Nmap XML report generator for benchmarks
+
+import ipaddress
+import random
+
+SERVICES = [
+    (22, "ssh", "OpenSSH", "8.9p1"),
+    (25, "smtp", "Postfix smtpd", None),
+    (53, "domain", "ISC BIND", "9.18"),
+    (80, "http", "nginx", "1.24.0"),
+    (443, "https", "Apache httpd", "2.4.57"),
+    (3306, "mysql", "MySQL", "8.0.35"),
+    (3389, "ms-wbt-server", "Microsoft Terminal Services", None),
+    (8080, "http-proxy", None, None),
+]
+STATES = ["open", "open", "open", "closed", "filtered"]
+
+
+def host_xml(addr: str, ports: int, rng: random.Random) -> str:
+    if rng.random() < 0.1:
+        return (
+            f'<host starttime="1700000000" endtime="1700000001">'
+            f'<status state="down" reason="no-response" reason_ttl="0"/>'
+            f'<address addr="{addr}" addrtype="ipv4"/><hostnames/></host>\n'
+        )
+    lines = [
+        '<host starttime="1700000000" endtime="1700000005">',
+        '<status state="up" reason="echo-reply" reason_ttl="64"/>',
+        f'<address addr="{addr}" addrtype="ipv4"/>',
+        '<hostnames/><ports>',
+        '<extraports state="closed" count="990"><extrareasons reason="resets" count="990"/></extraports>',
+    ]
+    for port, name, product, version in rng.sample(SERVICES, min(ports, len(SERVICES))):
+        attrs = f'name="{name}"'
+        if product:
+            attrs += f' product="{product}"'
+        if version:
+            attrs += f' version="{version}"'
+        attrs += ' method="probed" conf="10"' if product else ' method="table" conf="3"'
+        lines.append(
+            f'<port protocol="tcp" portid="{port}">'
+            f'<state state="{rng.choice(STATES)}" reason="syn-ack" reason_ttl="64"/>'
+            f'<service {attrs}><cpe>cpe:/a:{name}</cpe></service></port>'
+        )
+    lines.append('</ports><times srtt="120" rttvar="50" to="100000"/></host>\n')
+    return "".join(lines)
+
+
+def write_report(path: str, hosts: int, ports: int = 4, seed: int = 1,
+                 network: str = "10.0.0.0/8") -> str:
+    rng = random.Random(seed)
+    net = ipaddress.ip_network(network)
+    with open(path, "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<nmaprun scanner="nmap" args="nmap -sV -oX bench.xml 10.0.0.0/8" '
+            'start="1700000000" startstr="" version="7.98" xmloutputversion="1.05">\n'
+            '<scaninfo type="syn" protocol="tcp" numservices="1000" services="1-1000"/>\n'
+            '<verbose level="0"/><debugging level="0"/>\n'
+        )
+        for i in range(hosts):
+            f.write(host_xml(str(net[i + 1]), ports, rng))
+        f.write(
+            '<runstats><finished time="1700000100" timestr="" summary="" '
+            'elapsed="100.00" exit="success"/>'
+            f'<hosts up="{hosts}" down="0" total="{hosts}"/></runstats>\n'
+            '</nmaprun>\n'
+        )
+    return path
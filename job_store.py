@@ -0,0 +1,295 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Bounded job stores shared by main.py and nuclei-api.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+ACTIVE_STATES = ("running", "queued")
+
+
+def is_active(record: dict) -> bool:
+    return record.get("status") in ACTIVE_STATES
+
+
+class MemoryJobStore:
+    """In-memory LRU job store with optional TTL for finished jobs.
+
+    Running/queued jobs are never evicted; finished jobs are dropped once
+    they are older than ttl seconds or when more than max_jobs are held.
+    on_evict(job_id) is called for every job dropped that way, so files
+    kept outside the store can go with it.
+    """
+
+    def __init__(self, max_jobs: int = 1000, ttl: Optional[float] = None, on_evict=None):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, job_id: str, default=None, payloads: bool = True):
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                return default
+            record, updated = entry
+            expired = self.ttl and not is_active(record) and time.time() - updated > self.ttl
+            if not expired:
+                self.jobs.move_to_end(job_id)
+                return dict(record)
+            del self.jobs[job_id]
+        if self.on_evict:
+            self.on_evict(job_id)
+        return default
+
+    def __getitem__(self, job_id: str) -> dict:
+        record = self.get(job_id)
+        if record is None:
+            raise KeyError(job_id)
+        return record
+
+    def __setitem__(self, job_id: str, record: dict):
+        with self.lock:
+            self.jobs[job_id] = (dict(record), time.time())
+            self.jobs.move_to_end(job_id)
+            doomed = self.evict()
+        if self.on_evict:
+            for evicted in doomed:
+                self.on_evict(evicted)
+
+    def __delitem__(self, job_id: str):
+        with self.lock:
+            del self.jobs[job_id]
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.get(job_id, payloads=False) is not None
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def update(self, job_id: str, **fields) -> dict:
+        with self.lock:
+            record, _ = self.jobs.get(job_id, ({}, 0))
+            record = dict(record, **fields)
+            self.jobs[job_id] = (record, time.time())
+            self.jobs.move_to_end(job_id)
+            return dict(record)
+
+    def active(self) -> dict:
+        with self.lock:
+            return {k: dict(r) for k, (r, _) in self.jobs.items() if is_active(r)}
+
+    def evict(self) -> list:
+        # called with self.lock held; returns the evicted job ids
+        now = time.time()
+        excess = len(self.jobs) - self.max_jobs
+        doomed = []
+        for job_id, (record, updated) in list(self.jobs.items()):
+            if is_active(record):
+                continue
+            if excess > 0:
+                excess -= 1
+            elif not (self.ttl and now - updated > self.ttl):
+                break
+            del self.jobs[job_id]
+            doomed.append(job_id)
+        return doomed
+
+
+class SqliteJobStore:
+    """SQLite (WAL) job store; survives restarts.
+
+    Record fields whose JSON encoding exceeds inline_limit bytes (nmap
+    stdout, finding lists) are written to payload_dir and only read back
+    when the job is fetched with payloads=True. on_evict(job_id) is called
+    for every job dropped by ttl or max_jobs.
+    """
+
+    def __init__(self, path: str, payload_dir: Optional[str] = None, max_jobs: int = 10000,
+                 ttl: Optional[float] = None, inline_limit: int = 64 * 1024, on_evict=None):
+        self.path = path
+        self.on_evict = on_evict
+        self.payload_dir = payload_dir or os.path.join(os.path.dirname(path), "job_payloads")
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.inline_limit = inline_limit
+        self.lock = threading.Lock()
+        self.last_evict = 0.0
+        os.makedirs(self.payload_dir, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT, record TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)")
+
+    def payload_path(self, job_id: str, field: str) -> str:
+        return os.path.join(self.payload_dir, f"{job_id}.{field}.json")
+
+    def encode_field(self, job_id: str, key: str, value):
+        if isinstance(value, (str, list, dict)):
+            data = json.dumps(value)
+            if len(data) > self.inline_limit:
+                with open(self.payload_path(job_id, key), "w") as f:
+                    f.write(data)
+                return {"$payload": key}
+        return value
+
+    def encode(self, job_id: str, record: dict) -> str:
+        return json.dumps({key: self.encode_field(job_id, key, value) for key, value in record.items()})
+
+    def decode(self, job_id: str, data: str, payloads: bool) -> dict:
+        record = json.loads(data)
+        for key, value in list(record.items()):
+            if isinstance(value, dict) and "$payload" in value:
+                if not payloads:
+                    del record[key]
+                    continue
+                try:
+                    with open(self.payload_path(job_id, value["$payload"])) as f:
+                        record[key] = json.load(f)
+                except OSError:
+                    record[key] = None
+        return record
+
+    def payload_fields(self, job_id: str) -> list:
+        row = self.db.execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return []
+        return [v["$payload"] for v in json.loads(row[0]).values()
+                if isinstance(v, dict) and "$payload" in v]
+
+    def remove_payloads(self, fields: list, job_id: str, keep=()):
+        for field in fields:
+            if field not in keep:
+                try:
+                    os.remove(self.payload_path(job_id, field))
+                except OSError:
+                    pass
+
+    def get(self, job_id: str, default=None, payloads: bool = True):
+        with self.lock:
+            row = self.db.execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return default
+        return self.decode(job_id, row[0], payloads)
+
+    def __getitem__(self, job_id: str) -> dict:
+        record = self.get(job_id)
+        if record is None:
+            raise KeyError(job_id)
+        return record
+
+    def __setitem__(self, job_id: str, record: dict):
+        with self.lock:
+            old = self.payload_fields(job_id)
+            data = self.encode(job_id, record)
+            self.remove_payloads(old, job_id, keep=[k for k, v in json.loads(data).items()
+                                                    if isinstance(v, dict) and "$payload" in v])
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, record, updated) VALUES (?, ?, ?, ?)",
+                (job_id, record.get("status"), data, time.time())
+            )
+        self.evict()
+
+    def __delitem__(self, job_id: str):
+        with self.lock:
+            old = self.payload_fields(job_id)
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.remove_payloads(old, job_id)
+
+    def __contains__(self, job_id: str) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def update(self, job_id: str, **fields) -> dict:
+        """Change some fields of a job in place. Only those fields are
+        encoded and written; payload files of the others are left alone.
+        Returns the updated record without its payload fields."""
+        with self.lock:
+            row = self.db.execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            stored = json.loads(row[0]) if row else {}
+            for key, value in fields.items():
+                old = stored.get(key)
+                stored[key] = self.encode_field(job_id, key, value)
+                if isinstance(old, dict) and "$payload" in old and stored[key] != old:
+                    self.remove_payloads([old["$payload"]], job_id)
+            data = json.dumps(stored)
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, record, updated) VALUES (?, ?, ?, ?)",
+                (job_id, stored.get("status"), data, time.time())
+            )
+        self.evict()
+        return self.decode(job_id, data, False)
+
+    def active(self) -> dict:
+        marks = ",".join("?" * len(ACTIVE_STATES))
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT id, record FROM jobs WHERE status IN ({marks})", ACTIVE_STATES
+            ).fetchall()
+        return {job_id: self.decode(job_id, data, False) for job_id, data in rows}
+
+    def evict(self, force: bool = False):
+        now = time.time()
+        if not force and now - self.last_evict < 60:
+            return
+        self.last_evict = now
+        marks = ",".join("?" * len(ACTIVE_STATES))
+        finished = f"(status IS NULL OR status NOT IN ({marks}))"
+        with self.lock:
+            doomed = []
+            if self.ttl:
+                doomed += [r[0] for r in self.db.execute(
+                    f"SELECT id FROM jobs WHERE {finished} AND updated < ?",
+                    (*ACTIVE_STATES, now - self.ttl)
+                )]
+            total = self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] - len(doomed)
+            if total > self.max_jobs:
+                doomed += [r[0] for r in self.db.execute(
+                    f"SELECT id FROM jobs WHERE {finished} ORDER BY updated LIMIT ? OFFSET ?",
+                    (*ACTIVE_STATES, total - self.max_jobs, len(doomed))
+                )]
+            for job_id in doomed:
+                old = self.payload_fields(job_id)
+                self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self.remove_payloads(old, job_id)
+        if self.on_evict:
+            for job_id in doomed:
+                self.on_evict(job_id)
+
+
+def open_job_store(base_dir: str, name: str = "jobs", on_evict=None):
+    """Build the job store selected by the JOB_STORE environment variable.
+
+    JOB_STORE=sqlite (default) or memory; JOB_RETENTION (seconds a finished
+    job is kept, default 7 days) and JOB_MAX_JOBS bound both backends.
+    on_evict(job_id) runs for every job they drop.
+    """
+    kind = os.environ.get("JOB_STORE", "sqlite")
+    os.makedirs(base_dir, exist_ok=True)
+    ttl = float(os.environ.get("JOB_RETENTION", 7 * 24 * 3600)) or None
+    max_jobs = int(os.environ.get("JOB_MAX_JOBS", 10000))
+    if kind == "memory":
+        return MemoryJobStore(max_jobs=max_jobs, ttl=ttl, on_evict=on_evict)
+    if kind != "sqlite":
+        raise ValueError(f"Unknown JOB_STORE: {kind}")
+    return SqliteJobStore(
+        os.path.join(base_dir, f"{name}.sqlite3"),
+        payload_dir=os.path.join(base_dir, f"{name}_payloads"),
+        max_jobs=max_jobs,
+        ttl=ttl,
+        on_evict=on_evict
+    )
@@ -6,20 +6,56 @@ import asyncio
 import uuid
 import os
 import sys
+import shutil
+import time
+import contextvars
+import signal
+import socket
+import sqlite3
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
-SCAN_JOBS = {}
+from job_store import open_job_store, is_active
+from scan_cache import ScanCache, cache_key, files_exist
+from scheduler import ScanScheduler, INTERACTIVE, BACKGROUND
+from process_group import group_kwargs, stop_group
+from work_queue import WorkQueue
+from rate_budget import RateBudget, flag_value, with_max_rate, observed_rate
+from metrics import REGISTRY, CONTENT_TYPE, SIZE_BUCKETS, label_limit, monitor_loop_lag
+from result_index import ByteLRU, IndexCache, ReportIndex, file_key, is_fresh, index_path, parsed_path, load_report_json, ensure_parsed
+from report_diff import DiffCache
+from asset_store import AssetStore
+from output_store import CODECS, output_id, locate, stored_path, shard_dir, open_output, compress_output, collect_garbage
 BASE_DIR=os.path.dirname(os.path.abspath(__file__))
 BASE_DIR=os.path.join(BASE_DIR, "nmap_scans")
 if not os.path.exists(BASE_DIR):
     os.makedirs(BASE_DIR, exist_ok=True)
+# bounded, persistent job records (JOB_STORE / JOB_RETENTION / JOB_MAX_JOBS);
+# kept in a subdirectory so /file can never serve them
+JOBS_DIR=os.path.join(BASE_DIR, "jobs")
+# batch items and group states, kept out of the job record (see /scan/batch)
+BATCH_DIR = os.path.join(JOBS_DIR, "batch")
+os.makedirs(BATCH_DIR, exist_ok=True)
+BATCH_FILES = (".items.jsonl", ".items.idx", ".groups.jsonl")
+
+def remove_job_files(job_id: str):
+    # files kept next to a job record go when the store evicts it
+    for suffix in BATCH_FILES:
+        try:
+            os.remove(os.path.join(BATCH_DIR, job_id + suffix))
+        except OSError:
+            pass
+
+SCAN_JOBS = open_job_store(JOBS_DIR, "scan_jobs", on_evict=remove_job_files)
 def safe_output_path(user_value: str) -> str:
     base = os.path.basename(user_value)
     name, ext = os.path.splitext(base)
     uid = uuid.uuid4().hex
     safe_name = f"{name}_{uid}{ext}"
     filename = safe_name
-    return os.path.abspath(os.path.join(BASE_DIR, filename))
+    # nmap_scans/<first two hex digits of the uuid>/, at most 256 directories
+    out_dir = shard_dir(BASE_DIR, filename)
+    os.makedirs(out_dir, exist_ok=True)
+    return os.path.abspath(os.path.join(out_dir, filename))
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     loop = asyncio.get_running_loop()
@@ -27,10 +63,48 @@ async def lifespan(app: FastAPI):
     
     if sys.platform == 'win32' and not isinstance(loop, asyncio.ProactorEventLoop):
         print("WARNING: Not using ProactorEventLoop. Nmap scans may fail.")
+
+    if NMAP_ROLE == "coordinator":
+        # tasks of the previous coordinator have nobody waiting for them
+        await asyncio.to_thread(WORK_QUEUE.cancel_all)
+    # jobs persisted as running lost their nmap process with the old server;
+    # those with a resume log continue where nmap left off (workers share the
+    # coordinator's nmap_scans, its jobs are not theirs to touch)
+    for job_id, job in (SCAN_JOBS.active().items() if NMAP_ROLE != "worker" else ()):
+        stop_stale_nmap(job.get("pid"))
+        if NMAP_AUTO_RESUME and resumable(job):
+            SCAN_JOBS.update(job_id, status="queued")
+            start_job(job_id, resume_scan_job(job_id, resume_slot(job_id, job)), job.get("timeout"))
+        else:
+            SCAN_JOBS.update(job_id, status="interrupted", error="Scan interrupted by server restart")
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+    # workers share the coordinator's nmap_scans and leave cleaning it to it
+    output_gc = None
+    if NMAP_ROLE != "worker" and (NMAP_OUTPUT_RETENTION or NMAP_OUTPUT_QUOTA):
+        output_gc = asyncio.create_task(output_gc_loop())
+    role_loop = None
+    if NMAP_ROLE == "coordinator":
+        role_loop = asyncio.create_task(coordinator_loop())
+    elif NMAP_ROLE == "worker":
+        role_loop = asyncio.create_task(worker_loop())
     
     yield 
     
     print("Server shutting down...")
+    lag_monitor.cancel()
+    if output_gc is not None:
+        output_gc.cancel()
+    # nmap runs in its own process group and won't see the server's signal;
+    # stop it here (the job records stay active and are resumed on restart)
+    tasks = list(JOB_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if role_loop is not None:
+        role_loop.cancel()
+        await asyncio.gather(role_loop, return_exceptions=True)
+    if PARSE_POOL is not None:
+        PARSE_POOL.shutdown(wait=False, cancel_futures=True)
 
 TARGET_SPEC = {
     1: {
@@ -184,7 +258,7 @@ OUTPUT = {
     154: {"flag": "--open", "needs_input": False}
 }
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 app = FastAPI(lifespan=lifespan)
 from pydantic import BaseModel
 from typing import List, Optional, Union
@@ -197,14 +271,79 @@ class Option(BaseModel):
 class ScanRequest(BaseModel):
     target: str
     options: List[Option]
+    # opt-in: split the target list across this many concurrent nmap processes
+    shards: Optional[int] = None
+    # reuse an identical scan's result if it finished at most this many
+    # seconds ago (defaults to NMAP_CACHE_TTL, 0 always runs a new scan)
+    max_age: Optional[int] = None
+    # wall-clock deadline in seconds, queueing included (capped by NMAP_MAX_RUNTIME)
+    timeout: Optional[float] = None
+    # opt-in: find live hosts with a fast -sn pass first and port scan only
+    # those (-Pn), discovery_batch hosts per nmap process
+    discovery: Optional[bool] = None
+    discovery_batch: Optional[int] = None
+    # opt-in: job ID or XML report of an earlier scan of the same targets;
+    # only hosts that changed since (or were last fully scanned more than
+    # baseline_max_age seconds ago) get the full option set again
+    baseline: Optional[str] = None
+    baseline_max_age: Optional[int] = None
 OUTPUT_IDS = {
     150: 1,  # -oN
     151: 2,  # -oX
     152: 3   # -oA
 }
-SCAN_LIMIT = asyncio.Semaphore(3)   
+# admission control for nmap processes: NMAP_MAX_SCANS concurrent scans whose
+# summed cost (see scan_cost) stays within NMAP_MAX_COST; adjustable at runtime
+SCAN_LIMIT = ScanScheduler(
+    max_scans=int(os.environ.get("NMAP_MAX_SCANS", 3)),
+    max_cost=int(os.environ.get("NMAP_MAX_COST", 6))
+)
+# extra scheduler weight of expensive flags, every scan costs at least 1
+SCAN_COST_WEIGHTS = {"-sV": 1, "--version-all": 1, "-O": 1, "-sU": 2, "--traceroute": 1}
+# async scans write <taskprogress> to their XML this often ("" disables it)
+NMAP_STATS_EVERY = os.environ.get("NMAP_STATS_EVERY", "5s")
+SSE_POLL_INTERVAL = 0.5
+SSE_KEEPALIVE = 15.0
+# bytes of XML read and parsed per step (in a thread) when following a report
+XML_FOLLOW_CHUNK = 256 * 1024
+NMAP_CACHE_TTL = int(os.environ.get("NMAP_CACHE_TTL", 0))
+SCAN_CACHE = ScanCache(max_entries=int(os.environ.get("NMAP_CACHE_ENTRIES", 256)))
+# packets/s shared by all running nmap processes, injected as --max-rate
+# (0 disables); interactive scans get twice the share of background ones
+NMAP_RATE_BUDGET = int(os.environ.get("NMAP_RATE_BUDGET", 0))
+RATE_WEIGHTS = {INTERACTIVE: 2, BACKGROUND: 1}
+RATE_BUDGET = RateBudget(NMAP_RATE_BUDGET, RATE_WEIGHTS, floor=int(os.environ.get("NMAP_RATE_FLOOR", 10)),
+                         slots=lambda: SCAN_LIMIT.max_scans) if NMAP_RATE_BUDGET > 0 else None
+# wall-clock limit of every scan and job in seconds, queueing included (0 = none)
+NMAP_MAX_RUNTIME = float(os.environ.get("NMAP_MAX_RUNTIME", 0))
+# how often a sync /scan checks that its client is still connected
+DISCONNECT_POLL = 1.0
+
+# -------------------------
+# Metrics (GET /metrics); gauges are computed when scraped
+# -------------------------
+SCHED_WAIT = REGISTRY.histogram("nmap_scheduler_wait_seconds", "Time scans waited for a scheduler slot", ["priority"])
+SCHED_SLOT = REGISTRY.histogram("nmap_scheduler_slot_seconds", "Time scans held a scheduler slot", ["priority"])
+REGISTRY.gauge("nmap_scheduler_waiting", "Scans waiting for a slot", fn=lambda: len(SCAN_LIMIT.waiting))
+REGISTRY.gauge("nmap_scheduler_running", "Scans holding a slot", fn=lambda: len(SCAN_LIMIT.running))
+REGISTRY.gauge("nmap_scheduler_running_cost", "Summed cost of scans holding a slot", fn=lambda: SCAN_LIMIT.running_cost)
+REGISTRY.gauge("nmap_scheduler_max_scans", "Configured concurrent scan limit", fn=lambda: SCAN_LIMIT.max_scans)
+REGISTRY.gauge("nmap_scheduler_max_cost", "Configured summed cost limit", fn=lambda: SCAN_LIMIT.max_cost)
+REGISTRY.gauge("nmap_rate_budget_allocated", "Packets/s allocated to running nmap processes",
+               fn=lambda: RATE_BUDGET.status()["allocated"] if RATE_BUDGET else None)
+SCAN_LIMIT.on_grant = lambda ticket, wait: SCHED_WAIT.observe(wait, priority=ticket.priority)
+SCAN_LIMIT.on_release = lambda ticket, runtime: SCHED_SLOT.observe(runtime, priority=ticket.priority)
+NMAP_RUNNING = REGISTRY.gauge("nmap_processes_running", "nmap processes currently running")
+NMAP_RUNTIME = REGISTRY.histogram("nmap_process_seconds", "Runtime of nmap processes by option profile", ["profile"])
+NMAP_EXIT = REGISTRY.counter("nmap_process_exits_total", "nmap process exit codes by option profile", ["profile", "code"])
+REGISTRY.gauge("scan_cache_events", "Scan cache lookups by outcome", ["outcome"],
+               fn=lambda: {(k,): v for k, v in SCAN_CACHE.stats.items()})
+REGISTRY.gauge("scan_cache_entries", "Finished scans held by the scan cache", fn=lambda: len(SCAN_CACHE.entries))
+REGISTRY.gauge("scan_jobs", "Job records in the job store", fn=lambda: len(SCAN_JOBS))
+# option profiles are label values; the first 50 distinct ones are kept
+profile_label = label_limit(50)
 @app.post("/scan")
-async def scan_sync(req: ScanRequest):
+async def scan_sync(req: ScanRequest, request: Request):
     c=0
     for op in req.options:
         if op.id==150 and op.value is not None:
@@ -221,27 +360,28 @@ async def scan_sync(req: ScanRequest):
         return {"error": str(e)}
 
     fpath=os.path.abspath(path) if path else None
-    
-    async with SCAN_LIMIT:
-        result = await run_nmap(cmd)
-    if result["returncode"] != 0:
-        return {
-            "error": "Nmap scan failed",
-            "details": result["stderr"]
-        }
-    ren={
-        "message": "Nmap scan completed successfully",  
-        "output_file": '',
-        "output": result["stdout"]
-    } if fpath is None else {
-        "message": "Nmap scan completed successfully",
-        "output_file": fpath,
-        "output": result["stdout"]
-    }
-    if auto_xml:
-        ren["auto_xml"]=auto_xml
-    if mode:
-        ren["output_mode"]=mode
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_scan(request, cmd, req, fpath, mode, auto_xml),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    deadline = scan_deadline(req.timeout)
+    try:
+        outcome = await until_disconnected(request, asyncio.wait_for(
+            cached_scan(cmd, req, fpath, mode, auto_xml, scan_slot(request, INTERACTIVE)), deadline))
+    except asyncio.TimeoutError:
+        return {"error": f"Scan exceeded its {deadline:g}s deadline"}
+    except (OSError, ValueError) as e:
+        return {"error": str(e)}
+    if outcome is None:
+        return {"error": "Client disconnected, scan cancelled"}
+    value, cache_status = outcome
+    spawn(preparse_report(value))
+    ren = scan_record(value)
+    ren["cache"] = SCAN_CACHE.info(cache_status)
     return ren
 
 ALL_OPTIONS = {}
@@ -287,55 +427,774 @@ def command_build(target: str, options: list[Option]):
 
 
 
-async def run_nmap(cmd: list[str]):
+PROFILE_FLAGS = {spec["flag"] for table in (HOST_DISCOVERY, SCAN_TECHNIQUES, PORT_SPEC, SERVICE_VERSION, OS_DETECTION, TIMING)
+                 for spec in table.values()}
+
+def option_profile(cmd: list[str]) -> str:
+    # scan-shaping flags without their values (targets, ports, paths), -T keeps its level
+    flags = set()
+    for i, arg in enumerate(cmd[1:-1], 1):
+        if arg == "-T":
+            flags.add("-T" + cmd[i + 1])
+        elif arg in PROFILE_FLAGS:
+            flags.add(arg)
+    return profile_label(" ".join(sorted(flags)) or "default")
+
+# async job whose nmap process is being started (its pid is persisted so a
+# restarted server can stop a leftover process before resuming the job)
+CURRENT_JOB = contextvars.ContextVar("CURRENT_JOB", default=None)
+
+async def update_job(job_id: str, **fields):
+    # job store writes (SQLite) run off the event loop
+    await asyncio.to_thread(SCAN_JOBS.update, job_id, **fields)
+
+# user outputs whose content depends on verbosity (-oN, -oA)
+VERBOSE_OUTPUT_IDS = (150, 152)
+
+def rate_observable(options: list) -> bool:
+    # whether -v may be added to a scan: outputs the server adds itself
+    # (resume logs, shard and check reports) don't count, only the user's
+    return not any(op.id in VERBOSE_OUTPUT_IDS for op in options)
+
+async def run_nmap(cmd: list[str], profile: Optional[str] = None, capture: bool = True,
+                   priority: int = BACKGROUND, observe: bool = False):
+    # capture=False discards stdout, for callers that only read the XML output;
+    # observe=True lets -v be added to read the observed rate
+    profile = profile or option_profile(cmd)
+    lease = None
+    # workers run argv the coordinator already limited; a resumed scan keeps
+    # the rate it started with
+    if RATE_BUDGET is not None and NMAP_ROLE != "worker" and "--resume" not in cmd:
+        lease = RATE_BUDGET.acquire(priority, flag_value(cmd, "--max-rate"), CURRENT_JOB.get())
+        cmd = with_max_rate(cmd, lease.allocated)
+        if capture and observe and not any(arg.startswith(("-v", "-d")) for arg in cmd[1:-1]):
+            # -v makes nmap print "Raw packets sent", the observed rate; only
+            # when stdout is read and -v can't change an output the user asked for
+            cmd = cmd[:1] + ["-v"] + cmd[1:]
+    try:
+        if lease is not None and CURRENT_JOB.get():
+            await update_job(CURRENT_JOB.get(), rate=lease.info())
+        if NMAP_ROLE == "coordinator":
+            result = await run_remote(cmd, capture)
+        else:
+            result = await exec_nmap(cmd, profile, capture)
+    finally:
+        if lease is not None:
+            RATE_BUDGET.release(lease)
+    if lease is not None:
+        result["rate"] = dict(lease.info(), observed=observed_rate(result["stdout"], result.get("elapsed", 0)))
+    return result
+
+async def exec_nmap(cmd: list[str], profile: str, capture: bool = True):
+    started = time.monotonic()
     process = await asyncio.create_subprocess_exec(
         *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+        stdout=asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        **group_kwargs()
     )
-
-    stdout, stderr = await process.communicate()
+    NMAP_RUNNING.inc()
+    try:
+        if CURRENT_JOB.get():
+            await update_job(CURRENT_JOB.get(), pid=process.pid)
+        stdout, stderr = await process.communicate()
+    finally:
+        NMAP_RUNNING.dec()
+        # cancelled (job deleted, deadline, client gone): stop nmap and its children
+        await stop_group(process)
+    elapsed = time.monotonic() - started
+    NMAP_RUNTIME.observe(elapsed, profile=profile)
+    NMAP_EXIT.inc(profile=profile, code=process.returncode)
 
     return {
         "returncode": process.returncode,
-        "stdout": stdout.decode(errors="ignore"),
+        "stdout": stdout.decode(errors="ignore") if capture else "",
         "stderr": stderr.decode(errors="ignore"),
+        "elapsed": round(elapsed, 3),
     }
 
-async def run_scan_job(job_id: str, cmd: list[str], output_path: Optional[str] = None,auto_xml:Optional[str]=None,mode:Optional[int]=None):
-    async with SCAN_LIMIT:
-        result = await run_nmap(cmd)
+SHARD_FLAGS = ("-oN", "-oX", "-oA", "-iL")
 
-    
+def shard_command(cmd: list[str], shard_base: str, target_file: str) -> list[str]:
+    # same argv minus outputs/target, each shard writes its own -oA set
+    argv = []
+    skip = False
+    for arg in cmd[:-1]:
+        if skip:
+            skip = False
+            continue
+        if arg in SHARD_FLAGS:
+            skip = True
+            continue
+        argv.append(arg)
+    return argv + ["-oA", shard_base, "-iL", target_file]
+
+def concat_files(paths: list[str], dest: str):
+    with open(dest, "wb") as out:
+        for p in paths:
+            if os.path.exists(p):
+                with open(p, "rb") as f:
+                    shutil.copyfileobj(f, out)
+
+async def run_part(i: int, cmd: list[str], targets: int, sched: dict, capture: bool = True,
+                   observe: bool = False):
+    # one nmap process of a sharded, discovery or delta scan; its queueing
+    # and run time (and rate) are reported under "shard"
+    queued = time.monotonic()
+    async with SCAN_LIMIT.slot(scan_cost(cmd), **sched):
+        started = time.monotonic()
+        res = await run_nmap(cmd, capture=capture, priority=sched["priority"], observe=observe)
+    res["shard"] = {
+        "shard": i,
+        "targets": targets,
+        "returncode": res["returncode"],
+        "queued": round(started - queued, 3),
+        "elapsed": round(time.monotonic() - started, 3)
+    }
+    if "rate" in res:
+        res["shard"]["rate"] = res["rate"]
+    return res
+
+async def run_nmap_sharded(cmd: list[str], req: ScanRequest, output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str], sched: dict, capture: bool = True):
+    if any(op.id == 2 for op in req.options):
+        raise ValueError("Sharding is not supported with random targets (-iR)")
+    spec = req.target
+    for op in req.options:
+        if op.id == 1:
+            spec += " " + read_target_file(str(op.value))
+    shard_targets = split_shards(expand_targets(spec), req.shards)
+
+    bases = []
+    for i, chunk in enumerate(shard_targets):
+        base = safe_output_path(f"shard{i}")
+        with open(base + ".targets", "w") as f:
+            f.write("\n".join(chunk) + "\n")
+        bases.append(base)
+
+    try:
+        results = await asyncio.gather(*(
+            run_part(i, shard_command(cmd, b, b + ".targets"), len(shard_targets[i]), sched, capture,
+                     rate_observable(req.options))
+            for i, b in enumerate(bases)))
+    except asyncio.CancelledError:
+        remove_shard_files(bases)
+        raise
+
+    await asyncio.to_thread(merge_shard_outputs, bases, cmd, output_path, mode, auto_xml)
+
+    failed = [r for r in results if r["returncode"] != 0]
+    return {
+        "returncode": failed[0]["returncode"] if failed else 0,
+        "stdout": "".join(r["stdout"] for r in results),
+        "stderr": "".join(r["stderr"] for r in results),
+        "shards": [r["shard"] for r in results]
+    }
+
+def remove_shard_files(bases: list[str]):
+    for base in bases:
+        for ext in (".targets", ".xml", ".nmap", ".gnmap"):
+            if os.path.exists(base + ext):
+                os.remove(base + ext)
+
+def merge_shard_outputs(bases: list[str], cmd: list[str], output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str],
+                        extra_xml: tuple = (), keep=None, provenance: Optional[list] = None):
+    # the per-shard -oA sets become the outputs the request asked for;
+    # extra_xml reports are merged after them (XML only), see merge_nmap_xml
+    # for keep and provenance
+    try:
+        merge_nmap_xml([b + ".xml" for b in bases] + list(extra_xml), xml_output_path(output_path, mode, auto_xml),
+                       " ".join(cmd), keep=keep, provenance=provenance)
+        if mode == 1:
+            concat_files([b + ".nmap" for b in bases], output_path)
+        elif mode == 3:
+            concat_files([b + ".nmap" for b in bases], output_path + ".nmap")
+            concat_files([b + ".gnmap" for b in bases], output_path + ".gnmap")
+    finally:
+        remove_shard_files(bases)
+
+# -------------------------
+# Two-phase scans: a fast -sn pass finds the live hosts, which are handed
+# in batches to -Pn port scans while discovery is still running
+# -------------------------
+NMAP_DISCOVERY_BATCH = int(os.environ.get("NMAP_DISCOVERY_BATCH", 64))
+# options the -sn pass keeps: target selection, discovery probes, name
+# resolution and timing
+DISCOVERY_IDS = (1, 2, 3, 4, 13, 14, 15, 16, 17, 18) + tuple(TIMING)
+# they decide host discovery themselves
+DISCOVERY_CONFLICTS = (10, 11, 12)
+# not needed once the targets are known live (all take a value)
+LIVE_SCAN_DROP = ("-iR", "-PS", "-PA", "-PU")
+
+def live_scan_command(cmd: list[str], batch_base: str, target_file: str) -> list[str]:
+    argv = []
+    skip = False
+    for arg in cmd[:-1]:
+        if skip:
+            skip = False
+            continue
+        if arg in LIVE_SCAN_DROP:
+            skip = True
+            continue
+        argv.append(arg)
+    argv = shard_command(argv + cmd[-1:], batch_base, target_file)
+    return argv[:1] + ["-Pn"] + argv[1:]
+
+async def run_nmap_discovery(cmd: list[str], req: ScanRequest, output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str], sched: dict, capture: bool = True):
+    if any(op.id in DISCOVERY_CONFLICTS for op in req.options):
+        raise ValueError("Discovery mode cannot be combined with -sL, -sn or -Pn")
+    disc_cmd, _, _, disc_xml = command_build(req.target, [op for op in req.options if op.id in DISCOVERY_IDS])
+    disc_cmd.insert(1, "-sn")
+    batch_size = max(1, req.discovery_batch or NMAP_DISCOVERY_BATCH)
+    job_id = CURRENT_JOB.get()
+    started = time.monotonic()
+    live = []
+    pending = []
+    bases = []
+    batches = []
+
+    async def discover():
+        async with SCAN_LIMIT.slot(scan_cost(disc_cmd), **sched):
+            return await run_nmap(disc_cmd, capture=capture, priority=sched["priority"], observe=True)
+
+    async def launch():
+        base = safe_output_path(f"live{len(bases)}")
+        with open(base + ".targets", "w") as f:
+            f.write("\n".join(pending) + "\n")
+        bases.append(base)
+        batches.append(asyncio.ensure_future(
+            run_part(len(batches), live_scan_command(cmd, base, base + ".targets"), len(pending), sched, capture,
+                     rate_observable(req.options))))
+        pending.clear()
+        if job_id:
+            await update_job(job_id, discovery={"live": len(live), "batches": len(batches)})
+
+    discovery = asyncio.ensure_future(discover())
+    try:
+        async for event, data in follow_nmap_xml(disc_xml, discovery.done):
+            if event == "host" and data["status"] == "up" and data["address"]:
+                live.append(data["address"])
+                pending.append(data["address"])
+                if len(pending) >= batch_size:
+                    await launch()
+        disc = await discovery
+        disc_elapsed = round(time.monotonic() - started, 3)
+        if pending:
+            await launch()
+        results = await asyncio.gather(*batches)
+    except BaseException:
+        # cancelled, or discovery failed: stop the batches already started
+        for task in [discovery, *batches]:
+            task.cancel()
+        await asyncio.wait([discovery, *batches])
+        remove_shard_files(bases)
+        raise
+    finally:
+        if os.path.exists(disc_xml):
+            os.remove(disc_xml)
+
+    await asyncio.to_thread(merge_shard_outputs, bases, cmd, output_path, mode, auto_xml)
+
+    failed = [r for r in [disc] + list(results) if r["returncode"] != 0]
+    return {
+        "returncode": failed[0]["returncode"] if failed else 0,
+        "stdout": disc["stdout"] + "".join(r["stdout"] for r in results),
+        "stderr": disc["stderr"] + "".join(r["stderr"] for r in results),
+        "shards": [r["shard"] for r in results],
+        "discovery": {"returncode": disc["returncode"], "live": len(live), "batches": len(batches),
+                      "elapsed": disc_elapsed}
+    }
+
+# -------------------------
+# Delta rescans: a cheap check of liveness and of the ports a baseline
+# report found open picks the hosts that get the full scan again; the
+# others are carried over from the baseline
+# -------------------------
+NMAP_DELTA_MAX_AGE = int(os.environ.get("NMAP_DELTA_MAX_AGE", 7 * 24 * 3600))
+# options the check keeps: targets, discovery, DNS, scan technique and timing
+DELTA_CHECK_IDS = (1, 3, 4, 12, 13, 14, 15, 16, 17, 18) + tuple(SCAN_TECHNIQUES) + tuple(TIMING)
+DELTA_CONFLICTS = (2, 10, 11)  # -iR, -sL, -sn
+
+def job_report(job: dict) -> Optional[str]:
+    return job.get("auto_xml") or xml_output_path(job.get("output_file") or None, job.get("output_mode"), None)
+
+def find_report(ref: str) -> Optional[str]:
+    # XML report of a job ID, or a report name in nmap_scans (same rule as /file)
+    job = SCAN_JOBS.get(ref, payloads=False)
+    if job:
+        path = job_report(job)
+    else:
+        path = stored_path(BASE_DIR, ref)
+    return path if path and locate(path) else None
+
+def check_ports(hosts: dict, udp: bool) -> Optional[str]:
+    # every port open on some baseline host, as an nmap -p spec
+    tcp = sorted({p for h in hosts.values() for proto, p in h["open"] if proto == "tcp"})
+    spec = ["T:" + ",".join(map(str, tcp))] if tcp else []
+    if udp:
+        udp_ports = sorted({p for h in hosts.values() for proto, p in h["open"] if proto == "udp"})
+        if udp_ports:
+            spec.append("U:" + ",".join(map(str, udp_ports)))
+    return ",".join(spec) or None
+
+def delta_plan(baseline: dict, check: dict, protocols: set, max_age: float) -> tuple:
+    """(hosts to scan again, hosts to carry over, counts) from the baseline
+    and check reports. Hosts the baseline had down and that are not up now
+    are carried over as they were."""
+    rescan, carried = [], set()
+    counts = {"new": 0, "changed": 0, "stale": 0, "carried": 0, "carried_down": 0, "gone": 0}
+    now = time.time()
+    for addr, host in check.items():
+        if host["status"] != "up" or not addr:
+            continue
+        old = baseline.get(addr)
+        if old is None or old["status"] != "up":
+            reason = "new"
+        elif {p for p in old["open"] if p[0] in protocols} != host["open"]:
+            reason = "changed"
+        elif now - old["time"] > max_age:
+            reason = "stale"
+        else:
+            carried.add(addr)
+            counts["carried"] += 1
+            continue
+        rescan.append(addr)
+        counts[reason] += 1
+    for addr, host in baseline.items():
+        if check.get(addr, {}).get("status") == "up" or not addr:
+            continue
+        if host["status"] == "up":
+            counts["gone"] += 1
+        else:
+            carried.add(addr)
+            counts["carried_down"] += 1
+    return rescan, carried, counts
+
+async def run_nmap_delta(cmd: list[str], req: ScanRequest, output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str], sched: dict, capture: bool = True):
+    if any(op.id in DELTA_CONFLICTS for op in req.options):
+        raise ValueError("Delta scans cannot be combined with -iR, -sL or -sn")
+    baseline_xml = find_report(req.baseline)
+    if not baseline_xml:
+        raise ValueError("Baseline report not found")
+    try:
+        baseline = await asyncio.to_thread(host_states, baseline_xml)
+    except (ET.ParseError, OSError) as e:
+        raise ValueError(f"Failed to parse baseline report: {e}")
+    udp = "-sU" in cmd
+    protocols = {"tcp", "udp"} if udp else {"tcp"}
+
+    ports = check_ports(baseline, udp)
+    # without open ports to check only liveness is; -sn can't be combined
+    # with a port scan technique
+    check_ids = [i for i in DELTA_CHECK_IDS if ports or i not in SCAN_TECHNIQUES]
+    check_cmd, _, _, check_xml = command_build(req.target, [op for op in req.options if op.id in check_ids])
+    check_cmd[1:1] = ["-p", ports] if ports else ["-sn"]
+    bases = []
+    try:
+        async with SCAN_LIMIT.slot(scan_cost(check_cmd), **sched):
+            check_result = await run_nmap(check_cmd, capture=capture, priority=sched["priority"], observe=True)
+        if check_result["returncode"] != 0:
+            return dict(check_result, delta={"baseline": baseline_xml, "check_returncode": check_result["returncode"]})
+        check = await asyncio.to_thread(host_states, check_xml)
+    except ET.ParseError as e:
+        raise ValueError(f"Failed to parse delta check report: {e}")
+    finally:
+        if os.path.exists(check_xml):
+            os.remove(check_xml)
+
+    max_age = req.baseline_max_age if req.baseline_max_age is not None else NMAP_DELTA_MAX_AGE
+    rescan, carried, counts = delta_plan(baseline, check, protocols, max_age)
+    if CURRENT_JOB.get():
+        await update_job(CURRENT_JOB.get(), delta=dict(counts, baseline=baseline_xml))
+
+    parts = split_shards(rescan, req.shards or 1) if rescan else []
+    for i, chunk in enumerate(parts):
+        base = safe_output_path(f"delta{i}")
+        with open(base + ".targets", "w") as f:
+            f.write("\n".join(chunk) + "\n")
+        bases.append(base)
+    try:
+        results = await asyncio.gather(*(
+            run_part(i, live_scan_command(cmd, b, b + ".targets"), len(parts[i]), sched, capture,
+                     rate_observable(req.options))
+            for i, b in enumerate(bases)))
+    except asyncio.CancelledError:
+        remove_shard_files(bases)
+        raise
+
+    # rescanned hosts first, then the baseline's hosts that were carried over
+    await asyncio.to_thread(merge_shard_outputs, bases, cmd, output_path, mode, auto_xml, [baseline_xml],
+                            keep=lambda n, addr: n < len(bases) or addr in carried,
+                            provenance=["fresh"] * len(bases) + ["carried"])
+
+    failed = [r for r in results if r["returncode"] != 0]
+    return {
+        "returncode": failed[0]["returncode"] if failed else 0,
+        "stdout": check_result["stdout"] + "".join(r["stdout"] for r in results),
+        "stderr": check_result["stderr"] + "".join(r["stderr"] for r in results),
+        "shards": [r["shard"] for r in results],
+        "delta": dict(counts, baseline=baseline_xml, checked_ports=ports,
+                      # -oN/-oA text reports are written by the rescans only
+                      **({"text_outputs": "rescanned_only"} if mode in (1, 3) else {}))
+    }
+
+def scan_cost(cmd: list[str]) -> int:
+    cost = 1 + sum(SCAN_COST_WEIGHTS.get(arg, 0) for arg in cmd)
+    for flag, value in zip(cmd, cmd[1:]):
+        if flag == "-p" and value in ("-", "1-65535", "0-65535"):
+            cost += 1
+    return cost
+
+def scan_slot(request: Request, priority: int, key: Optional[str] = None) -> dict:
+    # scheduler fairness is per client; X-Client-Id lets a proxy or shared
+    # service account identify the team behind a request
+    client = request.headers.get("x-client-id") or (request.client.host if request.client else "default")
+    return {"priority": priority, "client": client, "key": key}
+
+async def execute_scan(cmd: list[str], req: ScanRequest, output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str], sched: dict, capture: bool = True):
+    if req.baseline:
+        return await run_nmap_delta(cmd, req, output_path, mode, auto_xml, sched, capture)
+    if req.discovery:
+        return await run_nmap_discovery(cmd, req, output_path, mode, auto_xml, sched, capture)
+    if req.shards and req.shards > 1:
+        return await run_nmap_sharded(cmd, req, output_path, mode, auto_xml, sched, capture)
+    async with SCAN_LIMIT.slot(scan_cost(cmd), **sched):
+        return await run_nmap(cmd, capture=capture, priority=sched["priority"], observe=rate_observable(req.options))
+
+# results without stdout are cached apart from those of regular scans
+NO_STDOUT_KEY = ("<no-stdout>",)
+
+async def cached_scan(cmd: list[str], req: ScanRequest, output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str], sched: dict, capture: bool = True):
+    # identical argv (ignoring generated file names) share one nmap run; the
+    # value carries the output paths of whichever request actually ran it
+    async def runner():
+        result = await execute_scan(cmd, req, output_path, mode, auto_xml, sched, capture)
+        return {"result": result, "output_file": output_path, "output_mode": mode, "auto_xml": auto_xml}
+
+    def valid(value):
+        return files_exist(xml_output_path(value["output_file"], value["output_mode"], value["auto_xml"]))
+
+    max_age = req.max_age if req.max_age is not None else NMAP_CACHE_TTL
+    key = scan_key(cmd) + (() if capture else NO_STDOUT_KEY)
+    if req.baseline:
+        # a delta report carries hosts over, it never stands in for a full scan
+        key += (("<baseline>", req.baseline),)
+    return await SCAN_CACHE.run(
+        key, max_age, runner,
+        cacheable=lambda v: v["result"]["returncode"] == 0,
+        valid=valid,
+        meta={"xml_file": xml_output_path(output_path, mode, auto_xml)}
+    )
+
+def scan_key(cmd: list[str]) -> tuple:
+    # resume logs are an implementation detail of async jobs
+    return cache_key(cmd, RESUME_DIR)
+
+BACKGROUND_TASKS = set()
+
+def spawn(coro):
+    # fire-and-forget, but keep a reference so the task isn't collected
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# -------------------------
+# Cancellation and deadlines: async, pipeline and batch jobs run as tasks
+# that DELETE /scan/async/{job_id} or their deadline can cancel
+# -------------------------
+JOB_TASKS = {}
+
+def scan_deadline(timeout: Optional[float]) -> Optional[float]:
+    limits = [t for t in (timeout, NMAP_MAX_RUNTIME) if t and t > 0]
+    return min(limits) if limits else None
+
+def start_job(job_id: str, coro, timeout: Optional[float] = None):
+    task = spawn(run_job(job_id, coro, scan_deadline(timeout)))
+    JOB_TASKS[job_id] = task
+    task.add_done_callback(lambda t: JOB_TASKS.pop(job_id, None))
+    return task
+
+async def run_job(job_id: str, coro, deadline: Optional[float]):
+    try:
+        await asyncio.wait_for(coro, deadline)
+    except asyncio.TimeoutError:
+        finish_resumable(job_id)
+        SCAN_JOBS.update(job_id, status="timed_out", error=f"Job exceeded its {deadline:g}s deadline")
+
+# -------------------------
+# Coordinator / worker roles (NMAP_ROLE). A coordinator serves the API and
+# puts every nmap argv on a shared work queue instead of running it; workers
+# run what the queue assigns them. Both need the same nmap_scans directory
+# (shared volume, same path) since argv carries absolute output paths.
+# -------------------------
+NMAP_ROLE = os.environ.get("NMAP_ROLE", "standalone")
+if NMAP_ROLE not in ("standalone", "coordinator", "worker"):
+    raise ValueError(f"Unknown NMAP_ROLE: {NMAP_ROLE}")
+# heartbeat / claim interval of workers and dispatch interval of the coordinator
+WORKER_POLL = 1.0
+WORK_QUEUE = None
+if NMAP_ROLE != "standalone":
+    WORK_QUEUE = WorkQueue(
+        os.environ.get("NMAP_QUEUE_DB", os.path.join(JOBS_DIR, "queue.sqlite3")),
+        worker_timeout=float(os.environ.get("NMAP_WORKER_TIMEOUT", 30)),
+        max_attempts=int(os.environ.get("NMAP_TASK_ATTEMPTS", 3))
+    )
+    REGISTRY.gauge("nmap_queue_tasks", "Work queue tasks by state", ["status"], fn=lambda: WORK_QUEUE.counts())
+    REGISTRY.gauge("nmap_queue_workers", "Workers with a recent heartbeat",
+                   fn=lambda: sum(w["alive"] for w in WORK_QUEUE.workers()))
+# coordinator: queue task id -> future resolved by coordinator_loop
+REMOTE_TASKS = {}
+
+async def run_remote(cmd: list[str], capture: bool = True):
+    task_id = await asyncio.to_thread(WORK_QUEUE.submit, cmd, scan_cost(cmd), capture)
+    future = asyncio.get_running_loop().create_future()
+    REMOTE_TASKS[task_id] = future
+    try:
+        outcome = await future
+    except asyncio.CancelledError:
+        # the worker stops the process group at its next heartbeat
+        await asyncio.to_thread(WORK_QUEUE.cancel, task_id)
+        raise
+    finally:
+        REMOTE_TASKS.pop(task_id, None)
+    if outcome["status"] != "done":
+        raise OSError(outcome["error"] or f"Scan task {outcome['status']}")
+    return outcome["result"]
+
+async def coordinator_loop():
+    while True:
+        try:
+            stats = await asyncio.to_thread(WORK_QUEUE.dispatch)
+            # admission follows the capacity of the live workers
+            scans, cost = stats["capacity"]
+            SCAN_LIMIT.configure(max_scans=max(1, scans), max_cost=max(1, cost))
+            if REMOTE_TASKS:
+                finished = await asyncio.to_thread(WORK_QUEUE.results, list(REMOTE_TASKS))
+                for task_id, outcome in finished.items():
+                    future = REMOTE_TASKS.get(task_id)
+                    if future is not None and not future.done():
+                        future.set_result(outcome)
+        except sqlite3.Error as e:
+            print(f"Work queue dispatch failed: {e}")
+        await asyncio.sleep(WORKER_POLL / 2)
+
+async def run_worker_task(worker_id: str, task: dict):
+    try:
+        async with SCAN_LIMIT.slot(task["cost"]):
+            result = await run_nmap(task["argv"], capture=task["capture"])
+    except (OSError, ValueError) as e:
+        await asyncio.to_thread(WORK_QUEUE.fail, task["id"], worker_id, str(e))
+        return
+    await asyncio.to_thread(WORK_QUEUE.complete, task["id"], worker_id, result)
+
+async def worker_loop():
+    worker_id = os.environ.get("NMAP_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+    host = socket.gethostname()
+    running = {}
+    registered = False
+    try:
+        while True:
+            try:
+                if not registered:
+                    await asyncio.to_thread(WORK_QUEUE.register, worker_id, host,
+                                            SCAN_LIMIT.max_scans, SCAN_LIMIT.max_cost)
+                    registered = True
+                owned = await asyncio.to_thread(WORK_QUEUE.heartbeat, worker_id, len(running),
+                                                SCAN_LIMIT.max_scans, SCAN_LIMIT.max_cost)
+                if owned is None:
+                    # declared dead (missed heartbeats): its tasks were requeued
+                    registered = False
+                    owned = set()
+                # cancelled by the coordinator, or handed to another worker
+                for task_id in set(running) - owned:
+                    running[task_id].cancel()
+                if registered:
+                    for task in await asyncio.to_thread(WORK_QUEUE.claim, worker_id):
+                        running[task["id"]] = spawn(run_worker_task(worker_id, task))
+                        running[task["id"]].add_done_callback(lambda t, i=task["id"]: running.pop(i, None))
+            except sqlite3.Error as e:
+                print(f"Work queue heartbeat failed: {e}")
+            await asyncio.sleep(WORKER_POLL)
+    finally:
+        tasks = list(running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if registered:
+            await asyncio.to_thread(WORK_QUEUE.unregister, worker_id)
+
+@app.get("/workers")
+async def workers():
+    if WORK_QUEUE is None:
+        return {"error": "Not running as coordinator or worker (NMAP_ROLE)"}
+    listed, counts = await asyncio.gather(asyncio.to_thread(WORK_QUEUE.workers),
+                                          asyncio.to_thread(WORK_QUEUE.counts))
+    return {"role": NMAP_ROLE, "workers": listed, "tasks": counts}
+
+async def until_disconnected(request: Request, coro):
+    """Await coro, cancelling it (and the nmap process it started) if the
+    HTTP client disconnects first; returns None in that case."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                await asyncio.wait({task})
+                return None
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+def scan_record(value: dict) -> dict:
+    result = value["result"]
     if result["returncode"] != 0:
-        SCAN_JOBS[job_id] = {
+        job = {
             "error": "Nmap scan failed",
             "details": result["stderr"]
         }
     else:
-
-        SCAN_JOBS[job_id] ={
-            "message": "Nmap scan completed successfully",  
-            "output_file": '',
-            "output": result["stdout"]
-        } if output_path is None else {
+        job = {
             "message": "Nmap scan completed successfully",
-            "output_file": output_path,
+            "output_file": value["output_file"] or '',
             "output": result["stdout"]
         }
-        if auto_xml:
-            SCAN_JOBS[job_id]["auto_xml"]=auto_xml
-        if mode:
-            SCAN_JOBS[job_id]["output_mode"]=mode
+        if value["auto_xml"]:
+            job["auto_xml"]=value["auto_xml"]
+        if value["output_mode"]:
+            job["output_mode"]=value["output_mode"]
+    if "rate" in result:
+        job["rate"]=result["rate"]
+    if "shards" in result:
+        job["shards"]=result["shards"]
+    if "discovery" in result:
+        job["discovery"]=result["discovery"]
+    if "delta" in result:
+        job["delta"]=result["delta"]
+    return job
+
+def job_record(value: dict) -> dict:
+    # a finished job; failed ones say so in their status as well
+    job = scan_record(value)
+    if "error" in job:
+        job["status"] = "failed"
+    return job
+
+async def run_scan_job(job_id: str, cmd: list[str], output_path: Optional[str] = None,auto_xml:Optional[str]=None,mode:Optional[int]=None,req:Optional[ScanRequest]=None,sched:Optional[dict]=None):
+    CURRENT_JOB.set(job_id)
+    leader = SCAN_CACHE.running(scan_key(cmd))
+    if leader:
+        # coalesced: live events come from the scan that is actually running
+        await update_job(job_id, **leader)
+    try:
+        value, cache_status = await cached_scan(cmd, req, output_path, mode, auto_xml, sched)
+    except (OSError, ValueError) as e:
+        finish_resumable(job_id)
+        SCAN_JOBS[job_id] = {"status": "failed", "error": "Nmap scan failed", "details": str(e)}
+        return
+    await preparse_report(value)
+    finish_resumable(job_id)
+    job = job_record(value)
+    job["cache"] = SCAN_CACHE.info(cache_status)
+    SCAN_JOBS[job_id] = job
+
+# -------------------------
+# Resumable async scans: every async job writes nmap's normal log, which
+# `nmap --resume <log>` continues from after a server restart
+# -------------------------
+NMAP_AUTO_RESUME = os.environ.get("NMAP_AUTO_RESUME", "1") not in ("0", "false", "no")
+RESUME_DIR = os.path.join(JOBS_DIR, "resume")
+os.makedirs(RESUME_DIR, exist_ok=True)
+
+def add_resume_log(cmd: list[str], output_path: Optional[str], mode: Optional[int]) -> tuple:
+    """Normal-format log for --resume: the user's -oN/-oA file if there is
+    one, else one is added (and deleted once the scan completes)."""
+    if mode == 1:
+        return output_path, False
+    if mode == 3:
+        return output_path + ".nmap", False
+    log = os.path.join(RESUME_DIR, f"{uuid.uuid4().hex}.nmap")
+    cmd[-1:-1] = ["-oN", log]
+    return log, True
+
+def resumable(job: dict) -> bool:
+    return bool(job.get("argv")) and bool(job.get("resume_log")) and os.path.exists(job["resume_log"])
+
+def resume_slot(job_id: str, job: dict) -> dict:
+    return {"priority": BACKGROUND, "client": job.get("client") or "default", "key": job_id}
+
+def stop_stale_nmap(pid: Optional[int]):
+    # only signal the pid if it is still an nmap process (checked via /proc)
+    if not pid:
+        return
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            argv0 = f.read().split(b"\0", 1)[0]
+    except OSError:
+        return
+    if os.path.basename(argv0) == b"nmap":
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+def finish_resumable(job_id: str):
+    # nmap exited, so the resume log we added is no longer needed
+    job = SCAN_JOBS.get(job_id, {}, payloads=False)
+    if job.get("resume_cleanup") and os.path.exists(job["resume_log"]):
+        os.remove(job["resume_log"])
+
+async def resume_scan_job(job_id: str, sched: dict):
+    CURRENT_JOB.set(job_id)
+    job = SCAN_JOBS.get(job_id, payloads=False)
+    xml = job["xml_file"]
+    parts = list(job.get("xml_parts") or [])
+    # nmap appends the resumed run to the original XML; start it in a fresh
+    # file and merge the parts afterwards
+    if xml and os.path.exists(xml) and os.path.getsize(xml):
+        part = f"{xml}.part{len(parts) + 1}"
+        os.replace(xml, part)
+        parts.append(part)
+    SCAN_JOBS.update(job_id, status="running", xml_parts=parts, resumed=job.get("resumed", 0) + 1)
+    try:
+        async with SCAN_LIMIT.slot(scan_cost(job["argv"]), **sched):
+            result = await run_nmap(["nmap", "--resume", job["resume_log"]], option_profile(job["argv"]))
+        if xml and parts:
+            merged = xml + ".merged"
+            await asyncio.to_thread(merge_nmap_xml, parts + [xml], merged, " ".join(job["argv"]))
+            os.replace(merged, xml)
+            for part in parts:
+                os.remove(part)
+    except (OSError, ValueError) as e:
+        SCAN_JOBS.update(job_id, status="interrupted", error=f"Resume failed: {e}")
+        return
+    value = {"result": result, "output_file": job.get("output_file"), "output_mode": job.get("output_mode"),
+             "auto_xml": job.get("auto_xml")}
+    if result["returncode"] != 0:
+        SCAN_JOBS.update(job_id, status="interrupted", error="Resume failed", details=result["stderr"])
+        return
+    await preparse_report(value)
+    finish_resumable(job_id)
+    record = job_record(value)
+    record["resumed"] = job.get("resumed", 0) + 1
+    SCAN_JOBS[job_id] = record
     
-from fastapi import BackgroundTasks
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import json
+import threading
+from array import array
 
 
 
 
 
 @app.post("/scan/async")
-async def scan_async(req: ScanRequest, background_tasks: BackgroundTasks):
+async def scan_async(req: ScanRequest, request: Request):
     try:
         cmd, path, mode,auto_xml = command_build(req.target, req.options)
     except (TypeError, ValueError) as e:
@@ -344,10 +1203,20 @@ async def scan_async(req: ScanRequest, background_tasks: BackgroundTasks):
     fpath = os.path.abspath(path) if path else None
 
 
+    if NMAP_STATS_EVERY:
+        cmd[1:1] = ["--stats-every", NMAP_STATS_EVERY]
+
     job_id = str(uuid.uuid4())
-    SCAN_JOBS[job_id] = {"status": "running"}
+    sched = scan_slot(request, BACKGROUND, job_id)
+    job = {"status": "running", "xml_file": xml_output_path(fpath, mode, auto_xml)}
+    if not (req.shards and req.shards > 1) and not req.discovery and not req.baseline:
+        # enough to continue the scan with `nmap --resume` after a restart
+        resume_log, cleanup = add_resume_log(cmd, fpath, mode)
+        job.update(argv=cmd, resume_log=resume_log, resume_cleanup=cleanup, output_file=fpath,
+                   output_mode=mode, auto_xml=auto_xml, client=sched["client"], timeout=req.timeout)
+    SCAN_JOBS[job_id] = job
 
-    background_tasks.add_task(run_scan_job, job_id, cmd, fpath,auto_xml,mode)
+    start_job(job_id, run_scan_job(job_id, cmd, fpath,auto_xml,mode,req,sched), req.timeout)
 
     return {
         "message": "Scan started",
@@ -359,9 +1228,722 @@ async def scan_status(job_id: str):
     job = SCAN_JOBS.get(job_id)
     if not job:
         return {"error": "Invalid job ID"}
+    if job.get("status") == "running":
+        queued = SCAN_LIMIT.queue_info(job_id)
+        if queued:
+            job.update(queued)
     return job
+
+@app.post("/scan/async/{job_id}/resume")
+async def scan_resume(job_id: str):
+    job = SCAN_JOBS.get(job_id, payloads=False)
+    if not job:
+        return {"error": "Invalid job ID"}
+    if job.get("status") != "interrupted":
+        return {"error": "Only interrupted jobs can be resumed"}
+    if not resumable(job):
+        return {"error": "No resume log for this job"}
+    SCAN_JOBS.update(job_id, status="queued", error=None)
+    start_job(job_id, resume_scan_job(job_id, resume_slot(job_id, job)), job.get("timeout"))
+    return {"message": "Scan resumed", "job_id": job_id}
+
+@app.delete("/scan/async/{job_id}")
+async def scan_cancel(job_id: str):
+    # also cancels pipeline and batch jobs, which share the job store
+    job = SCAN_JOBS.get(job_id, payloads=False)
+    if not job:
+        return {"error": "Invalid job ID"}
+    task = JOB_TASKS.get(job_id)
+    if task is not None and task.cancel():
+        # returns once nmap's process group is gone and its slot is free
+        await asyncio.wait({task})
+    elif job.get("status") != "interrupted":
+        return {"error": "Job is not running"}
+    finish_resumable(job_id)
+    SCAN_JOBS.update(job_id, status="cancelled", error="Job cancelled")
+    return {"message": "Job cancelled", "job_id": job_id}
+
+class SchedulerConfig(BaseModel):
+    max_scans: Optional[int] = None
+    max_cost: Optional[int] = None
+
+@app.get("/scheduler")
+async def scheduler_status():
+    status = SCAN_LIMIT.status()
+    if RATE_BUDGET is not None:
+        status["rate_budget"] = RATE_BUDGET.status()
+    return status
+
+@app.put("/scheduler")
+async def scheduler_configure(cfg: SchedulerConfig):
+    SCAN_LIMIT.configure(cfg.max_scans, cfg.max_cost)
+    return SCAN_LIMIT.status()
+
+def sse(event: str, data, event_id: Optional[int] = None) -> str:
+    msg = f"event: {event}\n"
+    if event_id is not None:
+        msg += f"id: {event_id}\n"
+    return msg + f"data: {json.dumps(data)}\n\n"
+
+@app.get("/scan/async/{job_id}/events")
+async def scan_events(job_id: str, request: Request):
+    job = SCAN_JOBS.get(job_id, payloads=False)
+    if not job:
+        return {"error": "Invalid job ID"}
+    # hosts are numbered so a reconnecting EventSource only gets what it missed
+    try:
+        skip = int(request.headers.get("last-event-id", 0))
+    except ValueError:
+        skip = 0
+
+    def finished():
+        # queued (e.g. waiting to resume) is not finished either
+        return not is_active(SCAN_JOBS.get(job_id, {}, payloads=False))
+
+    async def stream():
+        seq = 0
+        xml = job.get("xml_file") or xml_output_path(
+            job.get("output_file") or None, job.get("output_mode"), job.get("auto_xml"))
+        if xml:
+            async for event, data in follow_nmap_xml(xml, finished):
+                if event == "host":
+                    seq += 1
+                    if seq > skip:
+                        yield sse("host", data, seq)
+                elif event == "progress":
+                    yield sse("progress", data)
+                elif await request.is_disconnected():
+                    return
+                else:
+                    yield ": keepalive\n\n"
+        else:
+            while not finished():
+                await asyncio.sleep(SSE_POLL_INTERVAL)
+        final = {k: v for k, v in SCAN_JOBS.get(job_id, {}, payloads=False).items() if k != "output"}
+        yield sse("done", final)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+# -------------------------
+# Streaming POST /scan (Accept: application/x-ndjson)
+# -------------------------
+def ndjson(record: dict) -> str:
+    return json.dumps(record) + "\n"
+
+async def stream_scan(request: Request, cmd: list[str], req: ScanRequest, output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str]):
+    """A header record, one record per host as nmap writes it to the XML
+    output, then a summary. Neither stdout nor the hosts are kept in
+    memory, so a large report costs no more than a small one."""
+    if NMAP_STATS_EVERY:
+        cmd[1:1] = ["--stats-every", NMAP_STATS_EVERY]
+    started = time.monotonic()
+    deadline = scan_deadline(req.timeout)
+    leader = SCAN_CACHE.running(scan_key(cmd) + NO_STDOUT_KEY)
+    xml = (leader or {}).get("xml_file") or xml_output_path(output_path, mode, auto_xml)
+    scan = asyncio.ensure_future(asyncio.wait_for(
+        cached_scan(cmd, req, output_path, mode, auto_xml, scan_slot(request, INTERACTIVE), capture=False),
+        deadline))
+    hosts = 0
+    try:
+        yield ndjson({"type": "header", "target": req.target, "output_file": output_path or "",
+                      "output_mode": mode, "auto_xml": auto_xml, "started": time.time()})
+        async for event, data in follow_nmap_xml(xml, scan.done):
+            if event == "host":
+                hosts += 1
+                yield ndjson({"type": "host", "seq": hosts, "host": data})
+            elif event == "progress":
+                yield ndjson({"type": "progress", "progress": data})
+            else:
+                # nothing new for SSE_KEEPALIVE seconds; keeps proxies from timing out
+                yield ndjson({"type": "keepalive"})
+        summary = {"type": "summary"}
+        try:
+            value, cache_status = await scan
+        except asyncio.TimeoutError:
+            summary["error"] = f"Scan exceeded its {deadline:g}s deadline"
+        except (OSError, ValueError) as e:
+            summary["error"] = str(e)
+        else:
+            final_xml = xml_output_path(value["output_file"], value["output_mode"], value["auto_xml"])
+            if not hosts and final_xml and final_xml != xml:
+                # served from the cache: replay the earlier scan's report
+                async for event, data in follow_nmap_xml(final_xml, lambda: True):
+                    if event == "host":
+                        hosts += 1
+                        yield ndjson({"type": "host", "seq": hosts, "host": data})
+            spawn(preparse_report(value))
+            summary.update(scan_record(value), returncode=value["result"]["returncode"],
+                           cache=SCAN_CACHE.info(cache_status))
+            summary.pop("output", None)
+        summary.update(hosts=hosts, elapsed=round(time.monotonic() - started, 3))
+        yield ndjson(summary)
+    finally:
+        # client went away mid-stream: stop the scan unless others share it
+        if not scan.done():
+            scan.cancel()
+            await asyncio.wait({scan})
+
+# -------------------------
+# nmap -> nuclei pipeline: web services are handed to batched nuclei runs
+# while the nmap scan is still streaming hosts
+# -------------------------
+from nuclei_runner import NucleiBatcher, web_targets, read_jsonl
+PIPELINE_DIR = os.path.join(JOBS_DIR, "pipeline")
+os.makedirs(PIPELINE_DIR, exist_ok=True)
+NUCLEI_LIMIT = asyncio.Semaphore(int(os.environ.get("NUCLEI_MAX_SCANS", 2)))
+
+class NucleiOptions(BaseModel):
+    templates: Optional[List[str]] = None       # -t, template files or directories
+    template_ids: Optional[List[str]] = None    # -id
+    severity: Optional[List[str]] = None
+    rate_limit: Optional[int] = 150
+    # a nuclei run starts once this many targets are pending ...
+    batch_size: int = 25
+    # ... or the oldest pending target has waited this many seconds
+    batch_wait: float = 5.0
+
+class PipelineRequest(ScanRequest):
+    nuclei: NucleiOptions = NucleiOptions()
+
+def nuclei_args(opts: NucleiOptions) -> list[str]:
+    args = []
+    for template in opts.templates or []:
+        args += ["-t", template]
+    if opts.template_ids:
+        args += ["-id", ",".join(opts.template_ids)]
+    if opts.severity:
+        args += ["-severity", ",".join(opts.severity)]
+    if opts.rate_limit:
+        args += ["-rate-limit", str(opts.rate_limit)]
+    return args + ["-json"]
+
+async def run_pipeline_job(job_id: str, cmd: list[str], output_path: Optional[str], auto_xml: Optional[str], mode: Optional[int], req: PipelineRequest, sched: dict):
+    batcher = NucleiBatcher(
+        os.path.join(PIPELINE_DIR, job_id), nuclei_args(req.nuclei), NUCLEI_LIMIT,
+        req.nuclei.batch_size, req.nuclei.batch_wait,
+        on_batch=lambda summary: SCAN_JOBS.update(job_id, nuclei=summary)
+    )
+    leader = SCAN_CACHE.running(scan_key(cmd))
+    xml = (leader or {}).get("xml_file") or xml_output_path(output_path, mode, auto_xml)
+    scan = asyncio.create_task(cached_scan(cmd, req, output_path, mode, auto_xml, sched))
+    try:
+        hosts = 0
+        async for event, data in follow_nmap_xml(xml, scan.done):
+            if event == "host":
+                hosts += 1
+                batcher.add(web_targets(data))
+        try:
+            value, cache_status = await scan
+        except (OSError, ValueError) as e:
+            await batcher.close()
+            SCAN_JOBS[job_id] = {"status": "failed", "error": "Nmap scan failed", "details": str(e),
+                                 "nuclei": batcher.summary()}
+            return
+        final_xml = xml_output_path(value["output_file"], value["output_mode"], value["auto_xml"])
+        if not hosts and final_xml and final_xml != xml:
+            # served from the cache: the hosts are all in the earlier scan's report
+            async for event, data in follow_nmap_xml(final_xml, lambda: True):
+                if event == "host":
+                    batcher.add(web_targets(data))
+        await asyncio.gather(batcher.close(), preparse_report(value))
+    except asyncio.CancelledError:
+        scan.cancel()
+        await asyncio.gather(scan, batcher.cancel(), return_exceptions=True)
+        raise
+    job = job_record(value)
+    job["cache"] = SCAN_CACHE.info(cache_status)
+    job["nuclei"] = batcher.summary()
+    SCAN_JOBS[job_id] = job
+
+@app.post("/pipeline")
+async def pipeline(req: PipelineRequest, request: Request):
+    try:
+        cmd, path, mode, auto_xml = command_build(req.target, req.options)
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}
+
+    fpath = os.path.abspath(path) if path else None
+    job_id = str(uuid.uuid4())
+    SCAN_JOBS[job_id] = {"status": "running", "xml_file": xml_output_path(fpath, mode, auto_xml), "nuclei": {}}
+
+    start_job(job_id, run_pipeline_job(job_id, cmd, fpath, auto_xml, mode, req,
+                                       scan_slot(request, BACKGROUND, job_id)), req.timeout)
+
+    return {
+        "message": "Pipeline started",
+        "job_id": job_id
+    }
+
+@app.get("/pipeline/{job_id}")
+async def pipeline_status(job_id: str, offset: int = 0, limit: int = 500, since: Optional[int] = None):
+    job = SCAN_JOBS.get(job_id)
+    if not job or "nuclei" not in job:
+        return {"error": "Invalid job ID"}
+    findings, position = await asyncio.to_thread(
+        read_jsonl, os.path.join(PIPELINE_DIR, job_id + ".findings.jsonl"),
+        max(0, offset), max(0, min(limit, 5000)), since)
+    job["findings"] = findings
+    # poll again with ?since=<next_since> to receive only new findings
+    job["next_since"] = position
+    return job
+
+# -------------------------
+# Batch submission: many (target, options) items, grouped so one nmap run
+# covers every item with the same options through an -iL target file
+# -------------------------
+NMAP_BATCH_GROUP = int(os.environ.get("NMAP_BATCH_GROUP", 256))
+NMAP_BATCH_MAX_ITEMS = int(os.environ.get("NMAP_BATCH_MAX_ITEMS", 100000))
+# options that pick targets or outputs themselves can't be shared by a group
+BATCH_EXCLUDED = {1: "-iL", 2: "-iR", 150: "-oN", 151: "-oX", 152: "-oA"}
+
+class BatchItem(BaseModel):
+    target: str
+    options: Optional[List[Option]] = None
+
+class BatchScanRequest(BaseModel):
+    # explicit items, and/or one profile (options) applied to many targets
+    items: Optional[List[BatchItem]] = None
+    targets: Optional[List[str]] = None
+    options: Optional[List[Option]] = None
+    # most targets per nmap invocation
+    group_size: Optional[int] = None
+    # wall-clock deadline of the whole batch in seconds (capped by NMAP_MAX_RUNTIME)
+    timeout: Optional[float] = None
+
+def plan_batch(req: BatchScanRequest):
+    """Validate every item and group the valid ones by their nmap argv."""
+    items = [BatchItem(target=t, options=None) for t in req.targets or []] + list(req.items or [])
+    if not items:
+        raise ValueError("No targets specified")
+    if len(items) > NMAP_BATCH_MAX_ITEMS:
+        raise ValueError(f"At most {NMAP_BATCH_MAX_ITEMS} items per batch")
+    size = max(1, min(req.group_size or NMAP_BATCH_GROUP, NMAP_BATCH_GROUP))
+    records, profiles = [], {}
+    for item in items:
+        options = item.options if item.options is not None else (req.options or [])
+        record = {"target": item.target}
+        try:
+            excluded = [BATCH_EXCLUDED[op.id] for op in options if op.id in BATCH_EXCLUDED]
+            if excluded:
+                raise ValueError(f"Not supported in batches: {', '.join(excluded)}")
+            if not item.target.strip():
+                raise ValueError("Empty target")
+            cmd, _, _, _ = command_build(item.target, options)
+        except (TypeError, ValueError) as e:
+            record["error"] = str(e)
+            records.append(record)
+            continue
+        # drop the generated "-oX <auto.xml> <target>" tail
+        profiles.setdefault(tuple(cmd[:-3]), []).append(len(records))
+        records.append(record)
+    groups = []
+    for argv, members in profiles.items():
+        for start in range(0, len(members), size):
+            chunk = members[start:start + size]
+            for i in chunk:
+                records[i]["group"] = len(groups)
+            groups.append({"group": len(groups), "argv": list(argv), "items": chunk,
+                           "targets": len(chunk), "status": "queued"})
+    return records, groups
+
+def batch_progress(groups: list, items: int) -> dict:
+    counts = {}
+    for g in groups:
+        counts[g["status"]] = counts.get(g["status"], 0) + 1
+    done = sum(g["targets"] for g in groups if g["status"] in ("completed", "failed"))
+    valid = sum(g["targets"] for g in groups)
+    return {
+        "items": items,
+        "invalid": items - valid,
+        "groups": len(groups),
+        "groups_by_status": counts,
+        "items_done": done,
+        "hosts_up": sum(g.get("hosts_up", 0) for g in groups),
+        "percent": round(100 * done / valid, 1) if valid else 100.0,
+    }
+
+def count_hosts_up(xml_path: str) -> int:
+    # inside a JSON string the quotes would be escaped, so this only matches the key
+    with open(parsed_path(xml_path), "rb") as f:
+        return sum(1 for line in f if b'"status":"up"' in line)
+
+# Items are written once, as JSON lines plus an index of their byte offsets,
+# so a status page reads only its own lines. Group changes are appended to
+# <batch_id>.groups.jsonl (later lines win); the job record itself only
+# holds status and progress.
+BATCH_LOCK = threading.Lock()
+
+def batch_path(batch_id: str, suffix: str) -> str:
+    return os.path.join(BATCH_DIR, batch_id + suffix)
+
+def group_row(group: dict) -> dict:
+    # member indexes are in the items file already
+    return {k: v for k, v in group.items() if k != "items"}
+
+def write_batch(batch_id: str, records: list, groups: list):
+    offsets = array("Q", [0])
+    with open(batch_path(batch_id, ".items.jsonl"), "wb") as f:
+        for record in records:
+            line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    with open(batch_path(batch_id, ".items.idx"), "wb") as f:
+        offsets.tofile(f)
+    with open(batch_path(batch_id, ".groups.jsonl"), "w") as f:
+        f.writelines(json.dumps(group_row(g)) + "\n" for g in groups)
+
+def append_batch_group(batch_id: str, group: dict):
+    line = json.dumps(group_row(group)) + "\n"
+    with BATCH_LOCK, open(batch_path(batch_id, ".groups.jsonl"), "a") as f:
+        f.write(line)
+
+def read_batch_groups(batch_id: str) -> list:
+    groups = {}
+    try:
+        with open(batch_path(batch_id, ".groups.jsonl"), "rb") as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    row = json.loads(line)
+                    groups.setdefault(row["group"], {}).update(row)
+    except FileNotFoundError:
+        pass
+    return [groups[n] for n in sorted(groups)]
+
+def read_batch_items(batch_id: str, offset: int, limit: int) -> list:
+    offsets = array("Q")
+    try:
+        with open(batch_path(batch_id, ".items.idx"), "rb") as f:
+            f.seek(offset * offsets.itemsize)
+            offsets.frombytes(f.read((limit + 1) * offsets.itemsize))
+        if len(offsets) < 2:
+            return []
+        with open(batch_path(batch_id, ".items.jsonl"), "rb") as f:
+            f.seek(offsets[0])
+            return [json.loads(line) for line in f.read(offsets[-1] - offsets[0]).splitlines()]
+    except FileNotFoundError:
+        return []
+
+async def save_batch_group(batch_id: str, group: dict, groups: list, items: int):
+    await asyncio.to_thread(append_batch_group, batch_id, group)
+    await asyncio.to_thread(SCAN_JOBS.update, batch_id, progress=batch_progress(groups, items))
+
+async def run_batch_group(batch_id: str, group: dict, records: list, groups: list, sched: dict):
+    base = safe_output_path(f"batch{group['group']}")
+    targets_file, xml = base + ".targets", base + ".xml"
+    with open(targets_file, "w") as f:
+        for i in group["items"]:
+            f.write("\n".join(records[i]["target"].split()) + "\n")
+    cmd = group["argv"] + ["-oX", xml, "-iL", targets_file]
+    queued = time.monotonic()
+    try:
+        async with SCAN_LIMIT.slot(scan_cost(cmd), **sched):
+            group["status"] = "running"
+            await save_batch_group(batch_id, group, groups, len(records))
+            started = time.monotonic()
+            # groups never write text outputs
+            result = await run_nmap(cmd, priority=sched["priority"], observe=True)
+        group.update(
+            status="completed" if result["returncode"] == 0 else "failed",
+            returncode=result["returncode"],
+            queued=round(started - queued, 3),
+            elapsed=round(time.monotonic() - started, 3),
+            output_file=xml,
+            output_mode=2
+        )
+        if result["returncode"] != 0:
+            group["error"] = result["stderr"][-2000:]
+        else:
+            await preparse_report({"result": result, "output_file": xml, "output_mode": 2, "auto_xml": None})
+            if os.path.exists(parsed_path(xml)):
+                group["hosts_up"] = await asyncio.to_thread(count_hosts_up, xml)
+    except (OSError, ValueError) as e:
+        group.update(status="failed", error=str(e))
+    except asyncio.CancelledError:
+        group["status"] = "cancelled"
+        await save_batch_group(batch_id, group, groups, len(records))
+        raise
+    finally:
+        if os.path.exists(targets_file):
+            os.remove(targets_file)
+    await save_batch_group(batch_id, group, groups, len(records))
+
+async def run_batch(batch_id: str, records: list, groups: list, sched: dict):
+    await asyncio.gather(*(run_batch_group(batch_id, g, records, groups, sched) for g in groups))
+    progress = batch_progress(groups, len(records))
+    await asyncio.to_thread(
+        SCAN_JOBS.update, batch_id,
+        status="completed" if not progress["groups_by_status"].get("failed") else "failed", progress=progress
+    )
+
+@app.post("/scan/batch")
+async def scan_batch(req: BatchScanRequest, request: Request):
+    try:
+        records, groups = await asyncio.to_thread(plan_batch, req)
+    except ValueError as e:
+        return {"error": str(e)}
+    batch_id = str(uuid.uuid4())
+    await asyncio.to_thread(write_batch, batch_id, records, groups)
+    SCAN_JOBS[batch_id] = {"status": "running" if groups else "failed", "batch": True,
+                           "progress": batch_progress(groups, len(records))}
+    if groups:
+        start_job(batch_id, run_batch(batch_id, records, groups, scan_slot(request, BACKGROUND, batch_id)),
+                  req.timeout)
+    return {
+        "message": "Batch started" if groups else "No valid items",
+        "batch_id": batch_id,
+        "items": len(records),
+        "groups": len(groups),
+        "invalid": [dict(r, index=i) for i, r in enumerate(records) if "error" in r][:100]
+    }
+
+@app.get("/scan/batch/{batch_id}")
+async def scan_batch_status(batch_id: str, offset: int = 0, limit: int = 1000):
+    job = await asyncio.to_thread(SCAN_JOBS.get, batch_id)
+    if not job or not job.get("batch"):
+        return {"error": "Invalid batch ID"}
+    offset = max(0, offset)
+    groups = await asyncio.to_thread(read_batch_groups, batch_id)
+    page = await asyncio.to_thread(read_batch_items, batch_id, offset, max(0, limit))
+    items = []
+    for index, item in enumerate(page, offset):
+        record = dict(item, index=index)
+        if "error" in record:
+            record["status"] = "invalid"
+        else:
+            group = groups[record["group"]]
+            record["status"] = group["status"]
+            if "output_file" in group:
+                record["output_file"] = group["output_file"]
+                record["output_mode"] = group["output_mode"]
+        items.append(record)
+    queued = SCAN_LIMIT.queue_info(batch_id)
+    job["items"] = items
+    job["groups"] = groups
+    if queued:
+        job.update(queued)
+    return job
+
+# XML parsing is CPU bound, it runs in a bounded process pool so /alive and
+# job polls keep answering while a large report is parsed
+PARSE_WORKERS = int(os.environ.get("NMAP_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+PARSE_TIMEOUT = float(os.environ.get("NMAP_PARSE_TIMEOUT", 120))
+PARSE_QUEUE_LIMIT = int(os.environ.get("NMAP_PARSE_QUEUE", 16))
+PARSE_POOL = None
+PARSE_PENDING = 0
+PARSE_SECONDS = REGISTRY.histogram("nmap_xml_parse_seconds", "Time to convert an Nmap XML report", ["stage"])
+PARSE_BYTES = REGISTRY.counter("nmap_xml_parse_bytes_total", "Bytes of Nmap XML converted", ["stage"])
+PARSE_REJECTED = REGISTRY.counter("nmap_xml_parse_rejected_total", "Parses rejected because the queue was full or timed out")
+REGISTRY.gauge("nmap_xml_parse_pending", "Parses queued or running in the parse pool", fn=lambda: PARSE_PENDING)
+
+class ParserBusy(Exception):
+    pass
+
+def parse_done():
+    global PARSE_PENDING
+    PARSE_PENDING -= 1
+
+def parse_finished(loop):
+    # runs in a pool thread once the job itself is over
+    try:
+        loop.call_soon_threadsafe(parse_done)
+    except RuntimeError:
+        # the loop is already closed at shutdown
+        pass
+
+async def run_in_parse_pool(fn, *args):
+    global PARSE_POOL, PARSE_PENDING
+    if PARSE_PENDING >= PARSE_QUEUE_LIMIT:
+        PARSE_REJECTED.inc()
+        raise ParserBusy("Parser queue is full, try again later")
+    if PARSE_POOL is None:
+        # hypercorn/uvicorn CLI workers are daemonic and may not fork a pool
+        if multiprocessing.current_process().daemon:
+            PARSE_POOL = ThreadPoolExecutor(max_workers=PARSE_WORKERS)
+        else:
+            PARSE_POOL = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    loop = asyncio.get_running_loop()
+    job = PARSE_POOL.submit(fn, *args)
+    # a timed out parse keeps its worker until it finishes, so it counts
+    # against the queue until then, not until the caller gives up
+    PARSE_PENDING += 1
+    job.add_done_callback(lambda _: parse_finished(loop))
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(job), PARSE_TIMEOUT)
+        # every pool job converts the XML report passed as its first argument
+        PARSE_SECONDS.observe(time.monotonic() - started, stage=fn.__name__)
+        if locate(args[0]):
+            PARSE_BYTES.inc(os.path.getsize(locate(args[0])), stage=fn.__name__)
+        return result
+    except asyncio.TimeoutError:
+        PARSE_REJECTED.inc()
+        raise ParserBusy(f"Parsing took longer than {PARSE_TIMEOUT:g} seconds")
+
+# encoded /file responses keyed on (path, mtime, size), NMAP_FILE_CACHE_BYTES total
+FILE_CACHE = ByteLRU(int(os.environ.get("NMAP_FILE_CACHE_BYTES", 256 * 1024 * 1024)))
+FILE_BYTES = REGISTRY.histogram("file_response_bytes", "Size of /file response bodies", ["kind"], buckets=SIZE_BUCKETS)
+REGISTRY.gauge("file_cache_bytes", "Bytes held by the /file response cache", fn=lambda: FILE_CACHE.size)
+REGISTRY.gauge("file_cache_events", "/file response cache lookups by outcome", ["outcome"],
+               fn=lambda: {("hits",): FILE_CACHE.hits, ("misses",): FILE_CACHE.misses})
+
+async def load_report(xml_path: str) -> bytes:
+    key = file_key(xml_path)
+    data = FILE_CACHE.get(key)
+    if data is None:
+        if is_fresh(xml_path, parsed_path(xml_path)):
+            # already converted, this is just a file read
+            data = await asyncio.to_thread(load_report_json, xml_path)
+        else:
+            data = await run_in_parse_pool(load_report_json, xml_path)
+        FILE_CACHE.put(key, data)
+    return data
+
+async def preparse_report(value: dict):
+    # convert the finished scan's XML once so /file never parses it again,
+    # add it to the asset store, then compress the outputs
+    xml = xml_output_path(value["output_file"], value["output_mode"], value["auto_xml"])
+    if value["result"]["returncode"] != 0 or not xml or not locate(xml):
+        return
+    if not (is_fresh(xml, parsed_path(xml)) and is_fresh(xml, index_path(xml))):
+        try:
+            await run_in_parse_pool(ensure_parsed, xml)
+        except Exception as e:
+            print(f"Pre-parsing {xml} failed: {e}")
+            return
+    await ingest_assets(xml)
+    await compress_outputs(value)
+
+# -------------------------
+# nmap_scans housekeeping: finished outputs are compressed, and outputs
+# past NMAP_OUTPUT_RETENTION seconds or the NMAP_OUTPUT_QUOTA bytes total
+# are deleted (oldest first)
+# -------------------------
+NMAP_COMPRESS = os.environ.get("NMAP_COMPRESS", "gzip")
+if NMAP_COMPRESS not in CODECS and NMAP_COMPRESS != "none":
+    print(f"WARNING: NMAP_COMPRESS={NMAP_COMPRESS} is not available, using gzip")
+    NMAP_COMPRESS = "gzip"
+NMAP_OUTPUT_RETENTION = float(os.environ.get("NMAP_OUTPUT_RETENTION", 0))
+NMAP_OUTPUT_QUOTA = int(os.environ.get("NMAP_OUTPUT_QUOTA", 0))
+NMAP_GC_INTERVAL = float(os.environ.get("NMAP_GC_INTERVAL", 300))
+# outputs written to this recently may belong to a scan still running
+NMAP_GC_MIN_AGE = float(os.environ.get("NMAP_GC_MIN_AGE", 3600))
+OUTPUT_STATS = {}
+GC_DELETED = REGISTRY.counter("nmap_output_deleted_bytes_total", "Bytes of scan outputs deleted by retention / quota")
+REGISTRY.gauge("nmap_output_bytes", "Bytes in nmap_scans at the last collection", fn=lambda: OUTPUT_STATS.get("bytes"))
+REGISTRY.gauge("nmap_output_files", "Files in nmap_scans at the last collection", fn=lambda: OUTPUT_STATS.get("files"))
+
+def output_files(value: dict) -> list:
+    paths = [xml_output_path(value["output_file"], value["output_mode"], value["auto_xml"])]
+    if value["output_mode"] == 1:
+        paths.append(value["output_file"])
+    elif value["output_mode"] == 3:
+        paths += [value["output_file"] + ".nmap", value["output_file"] + ".gnmap"]
+    return [p for p in paths if p]
+
+async def compress_outputs(value: dict):
+    if NMAP_COMPRESS == "none":
+        return
+    for path in output_files(value):
+        try:
+            await asyncio.to_thread(compress_output, path, NMAP_COMPRESS)
+        except OSError as e:
+            print(f"Compressing {path} failed: {e}")
+
+def protected_outputs() -> set:
+    # outputs of scans still running, whatever their age
+    paths = [meta.get("xml_file") for meta in SCAN_CACHE.inflight_meta.values() if meta]
+    paths += [job.get("xml_file") for job in SCAN_JOBS.active().values()]
+    return {output_id(os.path.basename(p)) for p in paths if p}
+
+async def output_gc_loop():
+    while True:
+        try:
+            stats = await asyncio.to_thread(
+                collect_garbage, BASE_DIR, NMAP_OUTPUT_RETENTION, NMAP_OUTPUT_QUOTA, NMAP_GC_MIN_AGE,
+                (JOBS_DIR,), protected_outputs()
+            )
+            OUTPUT_STATS.update(stats)
+            GC_DELETED.inc(stats["deleted_bytes"])
+            if stats["deleted_files"]:
+                print(f"Output GC deleted {stats['deleted_files']} files ({stats['deleted_bytes']} bytes)")
+        except OSError as e:
+            print(f"Output GC failed: {e}")
+        await asyncio.sleep(NMAP_GC_INTERVAL)
+
+# loaded per-report indexes for filtered /file queries
+REPORT_INDEXES = IndexCache(int(os.environ.get("NMAP_INDEX_CACHE", 8)))
+FILE_PAGE_LIMIT = int(os.environ.get("NMAP_FILE_PAGE_LIMIT", 1000))
+
+def split_param(value: Optional[str]) -> Optional[list]:
+    if not value:
+        return None
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+async def query_report(xml_path: str, query: dict) -> dict:
+    if not (is_fresh(xml_path, parsed_path(xml_path)) and is_fresh(xml_path, index_path(xml_path))):
+        await run_in_parse_pool(ensure_parsed, xml_path)
+    return await asyncio.to_thread(lambda: REPORT_INDEXES.get(xml_path).query(**query))
+
+# computed differences between two reports for GET /diff
+REPORT_DIFFS = DiffCache(REPORT_INDEXES, int(os.environ.get("NMAP_DIFF_CACHE", 4)))
+
+async def diff_reports(base_xml: str, head_xml: str, query: dict) -> dict:
+    for xml_path in (base_xml, head_xml):
+        if not (is_fresh(xml_path, parsed_path(xml_path)) and is_fresh(xml_path, index_path(xml_path))):
+            await run_in_parse_pool(ensure_parsed, xml_path)
+    return await asyncio.to_thread(lambda: REPORT_DIFFS.get(base_xml, head_xml).query(**query))
+
+# -------------------------
+# Asset store: the port records of every finished report in one columnar
+# store (nmap_scans/jobs/assets), for aggregates across all scans
+# -------------------------
+NMAP_ASSET_STORE = os.environ.get("NMAP_ASSET_STORE", "1") != "0"
+# workers share the coordinator's nmap_scans; only the coordinator appends
+ASSETS = AssetStore(os.path.join(JOBS_DIR, "assets")) if NMAP_ASSET_STORE and NMAP_ROLE != "worker" else None
+REGISTRY.gauge("nmap_asset_records", "Port records in the asset store", fn=lambda: len(ASSETS) if ASSETS else None)
+REGISTRY.gauge("nmap_asset_scans", "Reports in the asset store", fn=lambda: len(ASSETS.scans) if ASSETS else None)
+
+async def ingest_assets(xml: str) -> Optional[dict]:
+    name = os.path.basename(xml)
+    if ASSETS is None or name in ASSETS:
+        return None
+    try:
+        # nmap's last write to the report is when the scan finished
+        finished = os.stat(locate(xml)).st_mtime
+        return await asyncio.to_thread(lambda: ASSETS.ingest(ReportIndex(xml), name, finished))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Adding {xml} to the asset store failed: {e}")
+        return None
+
+def report_name(ref: str) -> str:
+    # a job ID or a report name; reports deleted from nmap_scans stay in the store
+    job = SCAN_JOBS.get(ref, payloads=False)
+    path = job_report(job) if job else None
+    return os.path.basename(path or ref)
+
+def stream_normal_output(path: str):
+    # the log as one JSON string, decompressed and escaped chunk by chunk
+    size = 0
+    yield b'{"output_mode":"normal","content":"'
+    with open_output(path, "rt", errors="ignore") as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            data = json.dumps(chunk)[1:-1].encode()
+            size += len(data)
+            yield data
+    yield b'"}'
+    FILE_BYTES.observe(size + 37, kind="normal")
+
 @app.get("/file")
-async def get_file(output_file:str, output_mode:int):
+async def get_file(output_file:str, output_mode:int, host: Optional[str] = None, port: Optional[str] = None,
+                   protocol: Optional[str] = None, state: Optional[str] = None, service: Optional[str] = None,
+                   status: Optional[str] = None, fields: Optional[str] = None, cursor: Optional[str] = None,
+                   limit: Optional[int] = None):
     try:
         if not output_file:
             return {"error": "No file specified"}
@@ -370,67 +1952,208 @@ async def get_file(output_file:str, output_mode:int):
         if output_mode not in [1,2,3]:
             return {"error": "Invalid output mode"}
         fpath = os.path.abspath( output_file)
-        filename=os.path.basename(fpath)
-        f_path=os.path.join(BASE_DIR, filename)
+        f_path=stored_path(BASE_DIR, fpath)
         if f_path!=fpath:
             return {"error": "Invalid file path"}
         if output_mode==3:
             fpath=fpath+'.xml'
-        if not os.path.exists(fpath):
+        if not locate(fpath):
             return {"error": "File does not exist"}
         if output_mode==1:
-            with open(fpath, "r", errors="ignore") as f:
-                content = f.read()
-            return {"output_mode": "normal", "content": content}
-        if output_mode==2:
-            x=nmap_xml_to_dict(fpath)
-            return {
-            "output_mode": "xml",
-            "data": x
-        }
-        if output_mode==3:
-            x=nmap_xml_to_dict(fpath)
-            return {
-            "output_mode": "xml",
-            "data": x
-        }
+            return StreamingResponse(stream_normal_output(fpath), media_type="application/json")
+        if output_mode in (2, 3) and any(v is not None for v in (host, port, protocol, state, service, status, fields, cursor, limit)):
+            # filtered / paginated: answered from the report index, only matching hosts are read
+            page = await query_report(fpath, {
+                "hosts": split_param(host),
+                "ports": [int(p) for p in split_param(port) or []],
+                "protocols": split_param(protocol),
+                "states": split_param(state),
+                "services": split_param(service),
+                "status": split_param(status),
+                "fields": split_param(fields),
+                "cursor": int(cursor) if cursor else 0,
+                "limit": max(1, min(limit or 100, FILE_PAGE_LIMIT)),
+            })
+            body = json.dumps({"output_mode": "xml", "data": page["data"], "total": page["total"],
+                               "next_cursor": str(page["next_cursor"]) if page["next_cursor"] is not None else None}).encode()
+            FILE_BYTES.observe(len(body), kind="query")
+            return Response(content=body, media_type="application/json")
+        if output_mode in (2, 3):
+            data = await load_report(fpath)
+            FILE_BYTES.observe(len(data) + 29, kind="full")
+            return Response(content=b'{"output_mode":"xml","data":' + data + b'}', media_type="application/json")
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.get("/diff")
+async def get_diff(base: str, head: str, host: Optional[str] = None, change: Optional[str] = None,
+                   port: Optional[str] = None, protocol: Optional[str] = None, kind: Optional[str] = None,
+                   service: Optional[str] = None, cursor: Optional[str] = None, limit: Optional[int] = None):
+    # base/head: job IDs or XML report names in nmap_scans
+    base_xml, head_xml = find_report(base), find_report(head)
+    if not base_xml or not head_xml:
+        return {"error": f"Report not found: {base if not base_xml else head}"}
+    try:
+        page = await diff_reports(base_xml, head_xml, {
+            "hosts": split_param(host),
+            "changes": split_param(change),
+            "ports": [int(p) for p in split_param(port) or []],
+            "protocols": split_param(protocol),
+            "kinds": split_param(kind),
+            "services": split_param(service),
+            "cursor": int(cursor) if cursor else 0,
+            "limit": max(1, min(limit or 100, FILE_PAGE_LIMIT)),
+        })
     except Exception as e:
         return {"error": str(e)}
+    body = json.dumps({"base": os.path.basename(base_xml), "head": os.path.basename(head_xml),
+                       "summary": page["summary"], "data": page["data"], "total": page["total"],
+                       "next_cursor": str(page["next_cursor"]) if page["next_cursor"] is not None else None}).encode()
+    FILE_BYTES.observe(len(body), kind="diff")
+    return Response(content=body, media_type="application/json")
+@app.get("/assets")
+async def get_assets(cursor: Optional[str] = None, limit: Optional[int] = None):
+    if ASSETS is None:
+        return {"error": "Asset store is disabled (NMAP_ASSET_STORE=0 or worker role)"}
+    return await asyncio.to_thread(ASSETS.summary, int(cursor) if cursor else 0,
+                                   max(1, min(limit or 20, FILE_PAGE_LIMIT)))
+
+@app.post("/assets/ingest")
+async def ingest_report(report: str):
+    # add a report written before the store existed (job ID or report name)
+    if ASSETS is None:
+        return {"error": "Asset store is disabled (NMAP_ASSET_STORE=0 or worker role)"}
+    xml = find_report(report)
+    if not xml:
+        return {"error": f"Report not found: {report}"}
+    if os.path.basename(xml) in ASSETS:
+        return {"error": f"Already in the asset store: {os.path.basename(xml)}"}
+    try:
+        await run_in_parse_pool(ensure_parsed, xml)
+    except Exception as e:
+        return {"error": str(e)}
+    scan = await ingest_assets(xml)
+    if scan is None:
+        return {"error": f"Failed to add {os.path.basename(xml)} to the asset store"}
+    return {k: v for k, v in scan.items() if k != "end"}
+
+@app.get("/assets/aggregate")
+async def aggregate_assets(group_by: Optional[str] = None, metric: str = "records", host: Optional[str] = None,
+                           port: Optional[str] = None, protocol: Optional[str] = None, state: Optional[str] = None,
+                           service: Optional[str] = None, scan: Optional[str] = None, since: Optional[float] = None,
+                           until: Optional[float] = None, max_age: Optional[float] = None,
+                           limit: Optional[int] = None):
+    if ASSETS is None:
+        return {"error": "Asset store is disabled (NMAP_ASSET_STORE=0 or worker role)"}
+    if max_age is not None:
+        since = max(since or 0, time.time() - max_age)
+    try:
+        return await asyncio.to_thread(
+            ASSETS.aggregate,
+            group_by=split_param(group_by),
+            metric=metric,
+            hosts=split_param(host),
+            ports=[int(p) for p in split_param(port) or []],
+            protocols=split_param(protocol),
+            states=split_param(state),
+            services=split_param(service),
+            scans=[report_name(s) for s in split_param(scan) or []],
+            since=since,
+            until=until,
+            limit=max(1, min(limit or 100, FILE_PAGE_LIMIT)),
+        )
+    except ValueError as e:
+        return {"error": str(e)}
 @app.get("/alive")
 async def alive():
     return {"status": "alive"}
 
+@app.get("/metrics")
+async def metrics(format: Optional[str] = None):
+    if format == "json":
+        return REGISTRY.snapshot()
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
 
 
     
-from libnmap.parser import NmapParser
+from nmap_xml import parse_nmap_xml, NmapXmlFeed, merge_nmap_xml, host_states
+from targets import expand_targets, read_target_file, split_shards
+import xml.etree.ElementTree as ET
 
 def nmap_xml_to_dict(path: str) -> dict:
-    try:
-        report = NmapParser.parse_fromfile(path)
-    except Exception as e:
-        raise ValueError(f"Failed to parse Nmap XML file: {e}")
-
-    result = []
-    for host in report.hosts:
-        host_data = {
-            "address": host.address,
-            "status": host.status,
-            "ports": []
-        }
+    return parse_nmap_xml(path)
 
-        for service in host.services:
-            host_data["ports"].append({
-                "port": service.port,
-                "protocol": service.protocol,
-                "state": service.state,
-                "service": service.service,
-                "banner": service.banner
-            })
+def xml_output_path(output_path: Optional[str], mode: Optional[int], auto_xml: Optional[str]) -> Optional[str]:
+    if auto_xml:
+        return auto_xml
+    if mode == 2:
+        return output_path
+    if mode == 3:
+        return output_path + ".xml"
+    return None
 
-        result.append(host_data)
+def feed_xml_events(feed: NmapXmlFeed, f) -> tuple:
+    # (events, bytes read) of the next chunk of an open report
+    chunk = f.read(XML_FOLLOW_CHUNK)
+    return (feed.feed(chunk) if chunk else []), len(chunk)
 
-    return result
+def read_xml_events(feed: NmapXmlFeed, path: str, offset: int) -> tuple:
+    # (events, bytes read) of the next chunk after offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return feed_xml_events(feed, f)
+
+async def follow_nmap_xml(path: str, finished, poll: float = None):
+    # tail an XML file nmap is still writing; stops once finished() is true
+    # and everything written up to that point has been read. Reading and
+    # parsing run in a thread, one chunk at a time, so a large report never
+    # holds up the event loop.
+    poll = poll or SSE_POLL_INTERVAL
+    feed = NmapXmlFeed()
+    offset = 0
+    idle = 0.0
+    while True:
+        done = finished()
+        events, size = [], 0
+        if os.path.exists(path):
+            try:
+                events, size = await asyncio.to_thread(read_xml_events, feed, path, offset)
+            except FileNotFoundError:
+                # compressed meanwhile, picked up on the next pass
+                continue
+            except ET.ParseError:
+                return
+            offset += size
+        elif locate(path):
+            # finished and compressed meanwhile: read the rest from the copy,
+            # decompressing and parsing chunk by chunk in a thread as well
+            f = await asyncio.to_thread(open_output, path)
+            try:
+                await asyncio.to_thread(f.seek, offset)
+                while True:
+                    try:
+                        events, size = await asyncio.to_thread(feed_xml_events, feed, f)
+                    except ET.ParseError:
+                        return
+                    if not size:
+                        return
+                    for event in events:
+                        yield event
+            finally:
+                f.close()
+        if size:
+            for event in events:
+                yield event
+            idle = 0.0
+            continue
+        if done:
+            return
+        await asyncio.sleep(poll)
+        idle += poll
+        if idle >= SSE_KEEPALIVE:
+            idle = 0.0
+            yield ("keepalive", None)
 from fastapi.middleware.cors import CORSMiddleware
 app.add_middleware(
     CORSMiddleware,
@@ -444,7 +2167,8 @@ from hypercorn.asyncio import serve
 if __name__ == "__main__":
 
     config = Config()
-    config.bind = ["127.0.0.1:8000"]
+    # NMAP_BIND lets a worker run next to the coordinator on one host
+    config.bind = [os.environ.get("NMAP_BIND", "127.0.0.1:8000")]
     config.use_reloader = True
 
     asyncio.run(serve(app, config))
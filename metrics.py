@@ -0,0 +1,215 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Minimal Prometheus-style metrics (text exposition format 0.0.4)
+
+import asyncio
+import math
+import threading
+import time
+
+# seconds; covers sub-millisecond parses up to hour-long scans
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+SIZE_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26, 1 << 29)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self.lock:
+            items = list(self.series.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, k)} {format_value(v)}" for k, v in items]
+
+    def snapshot(self):
+        with self.lock:
+            return {",".join(k) or "": v for k, v in self.series.items()}
+
+
+class Gauge(Counter):
+    """Set directly, or computed at scrape time by fn returning a value or a
+    {label values tuple: value} dict."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.series[self.key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def collect(self):
+        if self.fn is None:
+            return
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        with self.lock:
+            if isinstance(value, dict):
+                self.series = {k if isinstance(k, tuple) else (k,): v for k, v in value.items()}
+            elif value is not None:
+                self.series = {(): value}
+
+    def render(self) -> list:
+        self.collect()
+        return super().render()
+
+    def snapshot(self):
+        self.collect()
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self) -> list:
+        with self.lock:
+            items = [(k, list(c), s, n) for k, (c, s, n) in self.series.items()]
+        lines = self.header()
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {",".join(k) or "": {"count": n, "sum": s} for k, (_, s, n) in self.series.items()}
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric: Metric) -> Metric:
+        # modules may be imported by both apps; keep the first registration
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None) -> Gauge:
+        return self.add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Same numbers as render(), as a dict (histograms as count/sum)."""
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LOOP_LAG = REGISTRY.histogram("event_loop_lag_seconds", "Delay of a periodic event loop timer", buckets=LAG_BUCKETS)
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    # run as a task for the lifetime of the app
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+def label_limit(limit: int = 50):
+    """Map free-form label values to themselves until limit distinct values
+    were seen, then to "other", so label cardinality stays bounded."""
+    seen = set()
+    lock = threading.Lock()
+
+    def bound(value: str) -> str:
+        with lock:
+            if value in seen:
+                return value
+            if len(seen) < limit:
+                seen.add(value)
+                return value
+        return "other"
+    return bound
@@ -1,5 +1,11 @@
 import { useState, useEffect, useRef, useCallback } from "react";
-import { checkJobStatus, JobStatusResponse } from "@/services/api";
+import {
+  checkJobStatus,
+  getJobEventsUrl,
+  HostData,
+  JobProgress,
+  JobStatusResponse,
+} from "@/services/api";
 
 interface UseAsyncPollOptions {
   interval?: number;
@@ -13,6 +19,8 @@ interface UseAsyncPollReturn {
   pollCount: number;
   result: JobStatusResponse | null;
   error: string | null;
+  liveHosts: HostData[];
+  progress: JobProgress | null;
   startPolling: (jobId: string) => void;
   stopPolling: () => void;
 }
@@ -25,17 +33,28 @@ export function useAsyncPoll(options: UseAsyncPollOptions = {}): UseAsyncPollRet
   const [pollCount, setPollCount] = useState(0);
   const [result, setResult] = useState<JobStatusResponse | null>(null);
   const [error, setError] = useState<string | null>(null);
+  const [liveHosts, setLiveHosts] = useState<HostData[]>([]);
+  const [progress, setProgress] = useState<JobProgress | null>(null);
   
   const intervalRef = useRef<NodeJS.Timeout | null>(null);
+  const eventSourceRef = useRef<EventSource | null>(null);
   const jobIdRef = useRef<string | null>(null);
 
+  const closeEventSource = useCallback(() => {
+    if (eventSourceRef.current) {
+      eventSourceRef.current.close();
+      eventSourceRef.current = null;
+    }
+  }, []);
+
   const stopPolling = useCallback(() => {
     if (intervalRef.current) {
       clearInterval(intervalRef.current);
       intervalRef.current = null;
     }
+    closeEventSource();
     setIsPolling(false);
-  }, []);
+  }, [closeEventSource]);
 
   const poll = useCallback(async () => {
     if (!jobIdRef.current) return;
@@ -64,6 +83,14 @@ export function useAsyncPoll(options: UseAsyncPollOptions = {}): UseAsyncPollRet
     }
   }, [stopPolling, onComplete, onError]);
 
+  const startIntervalPolling = useCallback(() => {
+    if (intervalRef.current) {
+      clearInterval(intervalRef.current);
+    }
+    intervalRef.current = setInterval(poll, interval);
+    poll();
+  }, [poll, interval]);
+
   const startPolling = useCallback((newJobId: string) => {
     // Reset state
     setJobId(newJobId);
@@ -72,18 +99,48 @@ export function useAsyncPoll(options: UseAsyncPollOptions = {}): UseAsyncPollRet
     setPollCount(0);
     setResult(null);
     setError(null);
+    setLiveHosts([]);
+    setProgress(null);
     
-    // Clear any existing interval
+    // Clear any existing interval / stream
     if (intervalRef.current) {
       clearInterval(intervalRef.current);
+      intervalRef.current = null;
     }
-    
-    // Start polling
-    intervalRef.current = setInterval(poll, interval);
-    
-    // Also poll immediately
-    poll();
-  }, [poll, interval]);
+    closeEventSource();
+
+    if (typeof EventSource === "undefined") {
+      startIntervalPolling();
+      return;
+    }
+
+    // Prefer the server push stream; fall back to polling if it breaks
+    const source = new EventSource(getJobEventsUrl(newJobId));
+    eventSourceRef.current = source;
+
+    source.addEventListener("host", (event) => {
+      const host = JSON.parse((event as MessageEvent).data) as HostData;
+      setLiveHosts(prev => [...prev, host]);
+      setPollCount(prev => prev + 1);
+    });
+
+    source.addEventListener("progress", (event) => {
+      setProgress(JSON.parse((event as MessageEvent).data) as JobProgress);
+      setPollCount(prev => prev + 1);
+    });
+
+    source.addEventListener("done", () => {
+      closeEventSource();
+      // The done event omits the raw output, fetch the full job record once
+      poll();
+    });
+
+    source.onerror = () => {
+      if (eventSourceRef.current !== source) return;
+      closeEventSource();
+      startIntervalPolling();
+    };
+  }, [poll, startIntervalPolling, closeEventSource]);
 
   // Cleanup on unmount
   useEffect(() => {
@@ -91,8 +148,9 @@ export function useAsyncPoll(options: UseAsyncPollOptions = {}): UseAsyncPollRet
       if (intervalRef.current) {
         clearInterval(intervalRef.current);
       }
+      closeEventSource();
     };
-  }, []);
+  }, [closeEventSource]);
 
   return {
     jobId,
@@ -100,6 +158,8 @@ export function useAsyncPoll(options: UseAsyncPollOptions = {}): UseAsyncPollRet
     pollCount,
     result,
     error,
+    liveHosts,
+    progress,
     startPolling,
     stopPolling,
   };
@@ -39,6 +39,14 @@ export interface JobStatusResponse {
   details?: string;
 }
 
+export interface JobProgress {
+  type: string;
+  task?: string;
+  percent?: string;
+  remaining?: string;
+  etc?: string;
+}
+
 export interface FileResponse {
   output_mode?: string;
   content?: string;
@@ -114,6 +122,11 @@ export async function checkJobStatus(jobId: string): Promise<JobStatusResponse>
   return response.json();
 }
 
+// Async scan - live event stream (Server-Sent Events)
+export function getJobEventsUrl(jobId: string): string {
+  return `${API_BASE_URL}/scan/async/${jobId}/events`;
+}
+
 // Get file content
 export async function getFileContent(outputFile: string, outputMode: number): Promise<FileResponse> {
   const params = new URLSearchParams({
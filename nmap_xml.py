@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Streaming Nmap XML parsing helpers used by main.py
+
+import xml.etree.ElementTree as ET
+from typing import Optional
+from xml.sax.saxutils import quoteattr
+
+from output_store import locate, open_output
+
+# service attributes that never show up in a banner (same rules as libnmap)
+BANNER_SKIP = ("name", "method", "conf", "cpelist", "servicefp", "tunnel")
+BANNER_FIRST = ("product", "version", "extrainfo")
+
+
+def service_banner(attrs: dict) -> str:
+    if attrs.get("method") != "probed":
+        return ""
+    parts = [f"{k}: {attrs[k]}" for k in BANNER_FIRST if k in attrs]
+    parts += [
+        f"{k}: {v}" for k, v in attrs.items()
+        if k not in BANNER_SKIP and k not in BANNER_FIRST
+    ]
+    return " ".join(parts)
+
+
+def host_record(host: ET.Element) -> dict:
+    addrs = {}
+    for addr in host.iterfind("address"):
+        addrs[addr.get("addrtype")] = addr.get("addr")
+    status = host.find("status")
+
+    record = {
+        "address": addrs.get("ipv4") or addrs.get("ipv6") or "",
+        "status": status.get("state") if status is not None else None,
+        "ports": []
+    }
+    if host.get("provenance"):
+        # delta rescans: "fresh" (scanned this run) or "carried" (from the baseline)
+        record["provenance"] = host.get("provenance")
+    for port in host.iterfind("ports/port"):
+        state = port.find("state")
+        service = port.find("service")
+        attrs = dict(service.attrib) if service is not None else {}
+        record["ports"].append({
+            "port": int(port.get("portid") or -1),
+            "protocol": port.get("protocol"),
+            "state": state.get("state") if state is not None else None,
+            "service": attrs.get("name", ""),
+            "banner": service_banner(attrs)
+        })
+    return record
+
+
+def iter_nmap_hosts(source):
+    """Yield one host record at a time from an Nmap XML file or file object.
+
+    Each <host> element is dropped from the tree as soon as it has been
+    converted, so memory use stays flat regardless of report size.
+    """
+    context = ET.iterparse(source, events=("start", "end"))
+    root = None
+    for event, elem in context:
+        if root is None:
+            root = elem
+            if root.tag != "nmaprun":
+                raise ValueError("Not an Nmap XML report")
+            continue
+        if event == "end" and elem.tag == "host":
+            yield host_record(elem)
+            root.clear()
+
+
+def parse_nmap_xml(path: str) -> list:
+    try:
+        with open_output(path) as f:
+            return list(iter_nmap_hosts(f))
+    except (ET.ParseError, OSError, ValueError) as e:
+        raise ValueError(f"Failed to parse Nmap XML file: {e}")
+
+
+class NmapXmlFeed:
+    """Incremental parser for an Nmap XML file that is still being written.
+
+    feed() takes raw bytes as nmap flushes them and returns the events that
+    became complete: ("host", record) for every finished <host> and
+    ("progress", attrs) for every <taskprogress> written by --stats-every.
+    """
+
+    def __init__(self):
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.root = None
+
+    def feed(self, data: bytes) -> list:
+        self.parser.feed(data)
+        events = []
+        for event, elem in self.parser.read_events():
+            if self.root is None:
+                self.root = elem
+                continue
+            if event != "end":
+                continue
+            if elem.tag == "host":
+                events.append(("host", host_record(elem)))
+                self.root.clear()
+            elif elem.tag in ("taskbegin", "taskprogress", "taskend"):
+                events.append(("progress", dict(elem.attrib, type=elem.tag)))
+                self.root.clear()
+        return events
+
+
+def merge_nmap_xml(paths: list, dest: str, args: Optional[str] = None, keep=None,
+                   provenance: Optional[list] = None) -> dict:
+    """Stream the <host> elements of several Nmap XML reports into one report.
+
+    The header (<nmaprun>, <scaninfo>, ...) comes from the first readable
+    report and <runstats> is recomputed from all of them. Missing or
+    truncated inputs (an interrupted nmap) contribute whatever complete
+    hosts they contain. keep(n, address), if given, selects the hosts taken
+    from the n-th input, and provenance[n] is written on them as a
+    provenance attribute. Returns the merged host counts.
+    """
+    header_done = False
+    start = None
+    finished = 0
+    counts = {"up": 0, "down": 0, "total": 0}
+    with open(dest, "w", encoding="utf-8") as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE nmaprun>\n')
+        for n, path in enumerate(paths):
+            if not locate(path):
+                continue
+            root = None
+            src = open_output(path)
+            try:
+                for event, elem in ET.iterparse(src, events=("start", "end")):
+                    if root is None:
+                        root = elem
+                        attrs = dict(elem.attrib)
+                        if not header_done:
+                            if args is not None:
+                                attrs["args"] = args
+                            out.write(f"<nmaprun{xml_attrs(attrs)}>\n")
+                        if attrs.get("start", "").isdigit():
+                            start = min(start or int(attrs["start"]), int(attrs["start"]))
+                        continue
+                    if event != "end" or elem not in root:
+                        continue
+                    if elem.tag == "host":
+                        if keep is not None and not keep(n, host_address(elem)):
+                            root.remove(elem)
+                            continue
+                        if provenance:
+                            elem.set("provenance", provenance[n])
+                        status = elem.find("status")
+                        state = status.get("state") if status is not None else None
+                        counts["total"] += 1
+                        if state in counts:
+                            counts[state] += 1
+                        write_element(out, elem)
+                    elif elem.tag == "runstats":
+                        fin = elem.find("finished")
+                        if fin is not None and fin.get("time", "").isdigit():
+                            finished = max(finished, int(fin.get("time")))
+                    elif not header_done and elem.tag in HEADER_TAGS:
+                        write_element(out, elem)
+                    root.remove(elem)
+            except ET.ParseError:
+                pass
+            finally:
+                src.close()
+            if root is not None:
+                header_done = True
+        if not header_done:
+            out.write('<nmaprun scanner="nmap">\n')
+        elapsed = finished - start if start and finished else 0
+        out.write(
+            f'<runstats><finished time="{finished}" elapsed="{elapsed}" exit="success"/>'
+            f'<hosts up="{counts["up"]}" down="{counts["down"]}" total="{counts["total"]}"/>'
+            '</runstats>\n</nmaprun>\n'
+        )
+    return counts
+
+
+HEADER_TAGS = ("scaninfo", "verbose", "debugging")
+
+
+def host_address(host: ET.Element) -> str:
+    addrs = {a.get("addrtype"): a.get("addr") for a in host.iterfind("address")}
+    return addrs.get("ipv4") or addrs.get("ipv6") or ""
+
+
+def host_states(path: str) -> dict:
+    """{address: {"status", "open", "time"}} for every host of a report:
+    its state, the set of (protocol, port) found open and when the host
+    was last scanned (its endtime, else the report's start time)."""
+    hosts = {}
+    root = None
+    with open_output(path) as src:
+        for event, elem in ET.iterparse(src, events=("start", "end")):
+            if root is None:
+                root = elem
+                if root.tag != "nmaprun":
+                    raise ValueError("Not an Nmap XML report")
+                continue
+            if event != "end" or elem.tag != "host":
+                continue
+            status = elem.find("status")
+            scanned = elem.get("endtime") or elem.get("starttime") or root.get("start") or ""
+            hosts[host_address(elem)] = {
+                "status": status.get("state") if status is not None else None,
+                "open": {(port.get("protocol"), int(port.get("portid") or -1))
+                         for port in elem.iterfind("ports/port")
+                         if port.find("state") is not None and port.find("state").get("state") == "open"},
+                "time": int(scanned) if scanned.isdigit() else 0,
+            }
+            root.clear()
+    return hosts
+
+
+def xml_attrs(attrs: dict) -> str:
+    return "".join(f' {k}={quoteattr(str(v))}' for k, v in attrs.items())
+
+
+def write_element(out, elem: ET.Element):
+    elem.tail = None
+    out.write(ET.tostring(elem, encoding="unicode"))
+    out.write("\n")
+
@@ -1,21 +1,107 @@
 from sys import stderr
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
 from pydantic import BaseModel
 from typing import List, Optional, Literal
-import subprocess
+import asyncio
 import uuid
-import json
+import os
+import time
+from contextlib import asynccontextmanager
+from job_store import open_job_store
+from template_catalog import TemplateCatalog
+from nuclei_runner import LINE_LIMIT, NUCLEI_RUNNING, NUCLEI_RUNTIME, NUCLEI_EXIT, NUCLEI_FINDINGS, pipe_findings, read_jsonl
+from process_group import group_kwargs, stop_group
+from metrics import REGISTRY, CONTENT_TYPE, monitor_loop_lag
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # jobs persisted as running lost their nuclei process with the old server
+    for job_id in JOBS.active():
+        JOBS.update(job_id, status="interrupted", error="Scan interrupted by server restart")
+    # findings of jobs the store has already evicted
+    for name in os.listdir(RESULTS_DIR):
+        if name.endswith(".jsonl") and name[:-len(".jsonl")] not in JOBS:
+            os.remove(os.path.join(RESULTS_DIR, name))
+    # serve the persisted catalog right away, pick up template changes in the background
+    CATALOG.load()
+    refresh_in_background()
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+    yield
+    if CATALOG_REFRESH is not None:
+        CATALOG_REFRESH.cancel()
+    lag_monitor.cancel()
+    # nuclei runs in its own process group; stop it with the server
+    tasks = list(JOB_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 app = FastAPI(
+    lifespan=lifespan,
     title="nuclei-exec-api",
     description="Nuclei Execution API with Template Support",
     version="1.0.0"
 )
 
 # -------------------------
-# In-memory job store
+# Job store (JOB_STORE / JOB_RETENTION / JOB_MAX_JOBS)
 # -------------------------
-JOBS = {}
+NUCLEI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nuclei_jobs")
+def remove_results(job_id: str):
+    # the findings file goes with the job record when the store evicts it
+    try:
+        os.remove(results_path(job_id))
+    except OSError:
+        pass
+
+JOBS = open_job_store(NUCLEI_DIR, "nuclei_jobs", on_evict=remove_results)
+# findings are appended here, one JSON object per line, instead of the job record
+RESULTS_DIR = os.path.join(NUCLEI_DIR, "results")
+os.makedirs(RESULTS_DIR, exist_ok=True)
+# running jobs update their findings count at most this often (seconds)
+RESULT_FLUSH_INTERVAL = 2.0
+# nuclei processes allowed to run at once, later jobs wait as "queued"
+NUCLEI_MAX_SCANS = int(os.environ.get("NUCLEI_MAX_SCANS", 2))
+NUCLEI_LIMIT = asyncio.Semaphore(NUCLEI_MAX_SCANS)
+# default / maximum findings returned by one GET /jobs/{job_id}
+RESULTS_PAGE = 500
+RESULTS_PAGE_LIMIT = int(os.environ.get("NUCLEI_PAGE_LIMIT", 5000))
+# wall-clock limit of every job in seconds, queueing included (0 = none)
+NUCLEI_MAX_RUNTIME = float(os.environ.get("NUCLEI_MAX_RUNTIME", 0))
+# running jobs, cancelled by DELETE /jobs/{job_id} or their deadline
+JOB_TASKS = {}
+
+# -------------------------
+# Template catalog (NUCLEI_TEMPLATES_DIR, default ~/nuclei-templates)
+# -------------------------
+CATALOG = TemplateCatalog(
+    os.path.join(NUCLEI_DIR, "templates.json"),
+    check_interval=float(os.environ.get("NUCLEI_CATALOG_CHECK", 300))
+)
+CATALOG_LOCK = asyncio.Lock()
+
+REGISTRY.gauge("nuclei_jobs", "Job records in the job store", fn=lambda: len(JOBS))
+NUCLEI_WAITING = REGISTRY.gauge("nuclei_scheduler_waiting", "Jobs waiting for a nuclei slot")
+REGISTRY.gauge("nuclei_templates", "Templates in the catalog", fn=lambda: len(CATALOG.index))
+NUCLEI_WAIT = REGISTRY.histogram("nuclei_scheduler_wait_seconds", "Time jobs waited for a nuclei slot")
+
+async def refresh_catalog(force: bool = False):
+    async with CATALOG_LOCK:
+        return await asyncio.to_thread(CATALOG.refresh, force)
+
+# the background refresh, kept so it isn't collected mid-run and only one runs
+CATALOG_REFRESH = None
+
+def refresh_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Template catalog refresh failed: {task.exception()}")
+
+def refresh_in_background():
+    global CATALOG_REFRESH
+    if CATALOG_REFRESH is None or CATALOG_REFRESH.done():
+        CATALOG_REFRESH = asyncio.create_task(refresh_catalog())
+        CATALOG_REFRESH.add_done_callback(refresh_done)
 
 # -------------------------
 # Models
@@ -32,22 +118,42 @@ class NucleiScanRequest(BaseModel):
     severity: Optional[List[str]] = None
     rate_limit: Optional[int] = 150
     json: bool = True
+    # wall-clock deadline in seconds, queueing included (capped by NUCLEI_MAX_RUNTIME)
+    timeout: Optional[float] = None
 
 # -------------------------
 # Helpers
 # -------------------------
+def results_path(job_id: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{job_id}.jsonl")
+
 def create_job():
     job_id = uuid.uuid4().hex
     JOBS[job_id] = {
-        "status": "running",
-        "results": []
+        "status": "queued",
+        "findings": 0
     }
     return job_id
 
+def check_templates(templates: TemplateConfig):
+    # only checked once a catalog exists, nuclei reports its own errors otherwise
+    index = CATALOG.index
+    if not len(index):
+        return
+    if templates.mode == "ids":
+        unknown = index.unknown_ids(templates.value)
+    elif templates.mode == "category":
+        unknown = index.unknown_dirs(templates.value)
+    else:
+        return
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown template {templates.mode}: {', '.join(unknown)}")
+
 def build_nuclei_cmd(req: NucleiScanRequest):
     cmd = ["nuclei", "-u", req.target]
 
     if req.templates:
+        check_templates(req.templates)
         if req.templates.mode == "category":
             for cat in req.templates.value:
                 cmd += ["-t", f"{cat}/"]
@@ -71,64 +177,157 @@ def build_nuclei_cmd(req: NucleiScanRequest):
 
     return cmd
 
-def run_nuclei(job_id: str, cmd: list):
+async def run_nuclei(job_id: str, cmd: list):
+    findings = 0
+    flushed = time.monotonic()
+
+    def progress(count):
+        nonlocal findings, flushed
+        findings = count
+        if time.monotonic() - flushed > RESULT_FLUSH_INTERVAL:
+            JOBS.update(job_id, findings=findings)
+            flushed = time.monotonic()
+
+    queued = time.monotonic()
+    waiting = True
+    NUCLEI_WAITING.inc()
     try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-
-        for line in process.stdout:
-            try:
-                JOBS[job_id]["results"].append(json.loads(line))
-            except json.JSONDecodeError:
-                continue
+        async with NUCLEI_LIMIT:
+            waiting = False
+            NUCLEI_WAITING.dec()
+            NUCLEI_WAIT.observe(time.monotonic() - queued)
+            started = time.monotonic()
+            JOBS.update(job_id, status="running")
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=LINE_LIMIT,
+                **group_kwargs()
+            )
+            errors = asyncio.create_task(process.stderr.read())
 
-        process.wait()
-        JOBS[job_id]["status"] = "completed"
-        stderr = process.stderr.read()
-        if stderr:
-            JOBS[job_id]["stderr"] = stderr
+            NUCLEI_RUNNING.inc()
+            try:
+                with open(results_path(job_id), "ab") as out:
+                    findings = await pipe_findings(process.stdout, out, progress)
+                await process.wait()
+            finally:
+                NUCLEI_RUNNING.dec()
+                # cancelled: stop nuclei and everything it started
+                await stop_group(process)
+            NUCLEI_RUNTIME.observe(time.monotonic() - started, kind="scan")
+            NUCLEI_EXIT.inc(kind="scan", code=process.returncode)
+            NUCLEI_FINDINGS.inc(findings, kind="scan")
+            job = {"status": "completed", "findings": findings}
+            stderr = (await errors).decode(errors="ignore")
+            if stderr:
+                job["stderr"] = stderr
+            JOBS[job_id] = job
 
     except Exception as e:
-        JOBS[job_id]["status"] = "failed"
-        JOBS[job_id]["error"] = str(e)
+        JOBS.update(job_id, status="failed", error=str(e), findings=findings)
+    except asyncio.CancelledError:
+        JOBS.update(job_id, findings=findings)
+        raise
+    finally:
+        if waiting:
+            NUCLEI_WAITING.dec()
+
+def job_deadline(timeout: Optional[float]) -> Optional[float]:
+    limits = [t for t in (timeout, NUCLEI_MAX_RUNTIME) if t and t > 0]
+    return min(limits) if limits else None
+
+async def run_job(job_id: str, cmd: list, deadline: Optional[float]):
+    try:
+        await asyncio.wait_for(run_nuclei(job_id, cmd), deadline)
+    except asyncio.TimeoutError:
+        JOBS.update(job_id, status="timed_out", error=f"Job exceeded its {deadline:g}s deadline")
 
 # -------------------------
 # API Endpoints
 # -------------------------
 @app.post("/nuclei/scan")
-def start_scan(req: NucleiScanRequest, bg: BackgroundTasks):
+async def start_scan(req: NucleiScanRequest):
     cmd = build_nuclei_cmd(req)
 
     job_id = create_job()
-    bg.add_task(run_nuclei, job_id, cmd)
+    task = asyncio.create_task(run_job(job_id, cmd, job_deadline(req.timeout)))
+    JOB_TASKS[job_id] = task
+    task.add_done_callback(lambda t: JOB_TASKS.pop(job_id, None))
 
     return {
         "job_id": job_id,
-        "status": "running",
+        "status": "queued",
         "command": cmd
     }
 
 @app.get("/jobs/{job_id}")
-def get_job(job_id: str):
+async def get_job(job_id: str, offset: int = 0, limit: int = RESULTS_PAGE, since: Optional[int] = None):
     job = JOBS.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
+    limit = max(0, min(limit, RESULTS_PAGE_LIMIT))
+    if "results" in job:
+        # record written before findings moved to results/<job_id>.jsonl
+        results = job.pop("results")
+        job["findings"] = len(results)
+        job["results"] = results[offset:offset + limit]
+        return job
+    results, position = await asyncio.to_thread(read_jsonl, results_path(job_id), max(0, offset), limit, since)
+    job["results"] = results
+    # poll again with ?since=<next_since> to receive only new findings
+    job["next_since"] = position
     return job
 
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    if job_id not in JOBS:
+        raise HTTPException(status_code=404, detail="Job not found")
+    task = JOB_TASKS.get(job_id)
+    if task is None or not task.cancel():
+        raise HTTPException(status_code=409, detail="Job is not running")
+    # returns once the nuclei process group is gone and its slot is free
+    await asyncio.wait({task})
+    JOBS.update(job_id, status="cancelled")
+    return {"job_id": job_id, "status": "cancelled"}
+
+@app.get("/metrics")
+async def metrics(format: Optional[str] = None):
+    if format == "json":
+        return REGISTRY.snapshot()
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
 @app.get("/nuclei/templates")
-def list_templates():
-    result = subprocess.run(
-        ["nuclei", "-tl"],
-        capture_output=True,
-        text=True
+async def list_templates(q: Optional[str] = None, id: Optional[str] = None, tag: Optional[str] = None,
+                         severity: Optional[str] = None, category: Optional[str] = None,
+                         path: Optional[str] = None, offset: int = 0, limit: int = 100):
+    if CATALOG.due():
+        refresh_in_background()
+    split = lambda v: [x.strip() for x in v.split(",") if x.strip()] if v else None
+    return CATALOG.index.search(
+        q=q, template_id=split(id), tags=split(tag), severity=split(severity),
+        category=split(category), path=path, offset=max(0, offset), limit=max(0, min(limit, 1000))
     )
-    return {"templates": result.stdout}
+
+@app.get("/nuclei/templates/facets")
+async def template_facets():
+    return CATALOG.index.facets()
+
+@app.get("/nuclei/templates/{template_id}")
+async def get_template(template_id: str):
+    template = CATALOG.index.get(template_id)
+    if not template:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return template
 
 @app.post("/nuclei/templates/update")
-def update_templates():
-    subprocess.run(["nuclei", "-update-templates"])
-    return {"status": "templates updated"}
+async def update_templates():
+    process = await asyncio.create_subprocess_exec(
+        "nuclei", "-update-templates",
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    await process.wait()
+    catalog = await refresh_catalog(force=True)
+    return {"status": "templates updated", **catalog}
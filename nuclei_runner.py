@@ -0,0 +1,201 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Nuclei subprocess helpers: JSONL findings files and batched target lists
+
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+from metrics import REGISTRY
+from process_group import group_kwargs, stop_group
+
+# nuclei JSON lines carry full requests/responses and can be large
+LINE_LIMIT = 16 * 1024 * 1024
+
+NUCLEI_RUNNING = REGISTRY.gauge("nuclei_processes_running", "nuclei processes currently running")
+NUCLEI_RUNTIME = REGISTRY.histogram("nuclei_process_seconds", "Runtime of nuclei processes", ["kind"])
+NUCLEI_EXIT = REGISTRY.counter("nuclei_process_exits_total", "nuclei process exit codes", ["kind", "code"])
+NUCLEI_FINDINGS = REGISTRY.counter("nuclei_findings_total", "Findings written by nuclei processes", ["kind"])
+
+# services nmap reports for web servers, plus ports assumed to be web when
+# nmap could not name the service
+WEB_SERVICES = ("http", "https", "http-proxy", "http-alt", "https-alt", "http-mgmt", "ssl/http", "ssl/https")
+WEB_PORTS = {80, 81, 443, 591, 3000, 5000, 8000, 8008, 8080, 8081, 8443, 8888, 9000, 9443}
+TLS_PORTS = {443, 8443, 9443}
+
+
+def web_targets(host: dict) -> list:
+    """http(s):// URLs for the open web-like ports of one parsed nmap host."""
+    urls = []
+    address = host.get("address")
+    if not address or host.get("status") != "up":
+        return urls
+    if ":" in address:
+        address = f"[{address}]"
+    for port in host.get("ports", []):
+        if port.get("state") != "open" or port.get("protocol") != "tcp":
+            continue
+        service = (port.get("service") or "").lower()
+        if not (service.startswith("http") or service in WEB_SERVICES
+                or (not service and port["port"] in WEB_PORTS)):
+            continue
+        tls = "https" in service or "ssl" in service or (service in ("", "http") and port["port"] in TLS_PORTS)
+        urls.append(f"{'https' if tls else 'http'}://{address}:{port['port']}")
+    return urls
+
+
+async def pipe_findings(stream, out, progress=None) -> int:
+    """Append each JSON line of a nuclei stdout stream to out; returns the
+    count. progress(count) is called after every finding."""
+    count = 0
+    async for line in stream:
+        try:
+            json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        out.write(line if line.endswith(b"\n") else line + b"\n")
+        out.flush()
+        count += 1
+        if progress:
+            progress(count)
+    return count
+
+
+def read_jsonl(path: str, offset: int, limit: int, since: Optional[int]):
+    """Up to limit records starting at byte position since (or at the
+    offset-th record) and the byte position to continue from."""
+    results = []
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return results, since or 0
+    with f:
+        if since is not None:
+            f.seek(since)
+        else:
+            for _ in range(offset):
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+        position = f.tell()
+        while len(results) < limit:
+            line = f.readline()
+            # a partial line is still being written
+            if not line.endswith(b"\n"):
+                break
+            results.append(json.loads(line))
+            position += len(line)
+    return results, position
+
+
+class NucleiBatcher:
+    """Collects targets as they are discovered and runs nuclei over them in
+    batches (`nuclei -l <list>`).
+
+    A batch starts once batch_size targets are pending or the oldest pending
+    target has waited batch_wait seconds; at most `limit` batches run at once.
+    Findings of every batch are appended to findings_path.
+    """
+
+    def __init__(self, base: str, args: list, limit: asyncio.Semaphore, batch_size: int = 25,
+                 batch_wait: float = 5.0, on_batch=None):
+        self.base = base
+        self.findings_path = base + ".findings.jsonl"
+        self.args = args
+        self.limit = limit
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.on_batch = on_batch
+        self.pending = []
+        self.seen = set()
+        self.timer = None
+        self.tasks = []
+        self.batches = []
+        self.findings = 0
+
+    def add(self, targets):
+        for target in targets:
+            if target in self.seen:
+                continue
+            self.seen.add(target)
+            self.pending.append(target)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.pending and self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.batch_wait)
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            self.tasks.append(asyncio.create_task(self.run_batch(len(self.tasks), batch)))
+
+    async def run_batch(self, n: int, targets: list):
+        list_file = f"{self.base}.batch{n}.targets"
+        info = {"batch": n, "targets": len(targets)}
+        queued = time.monotonic()
+        process = None
+        try:
+            async with self.limit:
+                started = time.monotonic()
+                info["queued"] = round(started - queued, 3)
+                with open(list_file, "w") as f:
+                    f.write("\n".join(targets) + "\n")
+                process = await asyncio.create_subprocess_exec(
+                    "nuclei", "-l", list_file, *self.args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                    limit=LINE_LIMIT,
+                    **group_kwargs()
+                )
+                NUCLEI_RUNNING.inc()
+                try:
+                    with open(self.findings_path, "ab") as out:
+                        found = await pipe_findings(process.stdout, out)
+                    info["returncode"] = await process.wait()
+                finally:
+                    NUCLEI_RUNNING.dec()
+                info["findings"] = found
+                info["elapsed"] = round(time.monotonic() - started, 3)
+                self.findings += found
+                NUCLEI_RUNTIME.observe(info["elapsed"], kind="pipeline")
+                NUCLEI_EXIT.inc(kind="pipeline", code=info["returncode"])
+                NUCLEI_FINDINGS.inc(found, kind="pipeline")
+        except OSError as e:
+            info["error"] = str(e)
+        finally:
+            if process is not None:
+                await stop_group(process)
+            if os.path.exists(list_file):
+                os.remove(list_file)
+        self.batches.append(info)
+        if self.on_batch:
+            self.on_batch(self.summary())
+
+    async def close(self):
+        self.flush()
+        await asyncio.gather(*self.tasks)
+
+    async def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def summary(self) -> dict:
+        return {
+            "targets": len(self.seen),
+            "batches": sorted(self.batches, key=lambda b: b["batch"]),
+            "running": len(self.tasks) - len(self.batches),
+            "findings": self.findings,
+        }
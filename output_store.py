@@ -0,0 +1,146 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Layout, compression and garbage collection of the files in nmap_scans
+
+import gzip
+import os
+import re
+import shutil
+import time
+from typing import Optional
+
+try:
+    # Python 3.14+
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# codec name -> (suffix, open function)
+CODECS = {"gzip": (".gz", gzip.open)}
+if zstd is not None:
+    CODECS["zstd"] = (".zst", zstd.open)
+# safe_output_path names end in _<uuid hex>; it also picks the subdirectory
+OUTPUT_ID = re.compile(r"_([0-9a-f]{32})")
+
+
+def output_id(filename: str) -> Optional[str]:
+    ids = OUTPUT_ID.findall(filename)
+    return ids[-1] if ids else None
+
+
+def shard_dir(base_dir: str, filename: str) -> str:
+    """Subdirectory (first two hex digits of the output's uuid) so no single
+    directory ends up holding every output."""
+    uid = output_id(filename)
+    return os.path.join(base_dir, uid[:2]) if uid else base_dir
+
+
+def locate(path: str) -> Optional[str]:
+    """path itself, or its compressed copy, whichever exists."""
+    if os.path.exists(path):
+        return path
+    for suffix, _ in CODECS.values():
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+
+def stored_path(base_dir: str, name: str) -> str:
+    """Where the output called name lives: its subdirectory, or the top
+    level for outputs written before subdirectories were used."""
+    filename = os.path.basename(name)
+    sharded = os.path.join(shard_dir(base_dir, filename), filename)
+    flat = os.path.join(base_dir, filename)
+    if sharded != flat and not locate(sharded) and locate(flat):
+        return flat
+    return sharded
+
+
+def open_output(path: str, mode: str = "rb", **kwargs):
+    """Open an output, decompressing it on the fly if it was compressed."""
+    found = locate(path)
+    if found is None:
+        raise FileNotFoundError(f"No such file: {path}")
+    if found != path:
+        for suffix, opener in CODECS.values():
+            if found.endswith(suffix):
+                return opener(found, mode, **kwargs)
+    return open(found, mode, **kwargs)
+
+
+def compress_output(path: str, codec: str) -> Optional[str]:
+    """Replace a finished output with its compressed copy. The copy keeps
+    the original mtime, so files derived from it stay fresh."""
+    if codec not in CODECS or not os.path.isfile(path):
+        return None
+    suffix, opener = CODECS[codec]
+    dest = path + suffix
+    tmp = dest + ".tmp"
+    st = os.stat(path)
+    try:
+        with open(path, "rb") as src, opener(tmp, "wb") as out:
+            shutil.copyfileobj(src, out, 1 << 20)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(path)
+    return dest
+
+
+def output_groups(base_dir: str, skip: tuple = ()) -> dict:
+    """{output id: {"paths", "bytes", "mtime"}} for every file under
+    base_dir; an output's XML, logs, compressed copies and pre-parsed forms
+    share the id and are collected together."""
+    groups = {}
+    for root, dirs, files in os.walk(base_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in skip]
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            group = groups.setdefault(output_id(name) or name.split(".", 1)[0],
+                                      {"paths": [], "bytes": 0, "mtime": 0})
+            group["paths"].append(path)
+            group["bytes"] += st.st_size
+            group["mtime"] = max(group["mtime"], st.st_mtime)
+    return groups
+
+
+def collect_garbage(base_dir: str, max_age: float = 0, quota: int = 0, min_age: float = 3600,
+                    skip: tuple = (), protected: set = frozenset()) -> dict:
+    """Delete outputs older than max_age seconds, then the oldest ones until
+    the total is within quota bytes (0 disables either). Outputs changed
+    in the last min_age seconds and protected output ids are kept."""
+    now = time.time()
+    groups = output_groups(base_dir, skip)
+    total = sum(g["bytes"] for g in groups.values())
+    stats = {"files": sum(len(g["paths"]) for g in groups.values()), "bytes": total,
+             "deleted_files": 0, "deleted_bytes": 0}
+    candidates = sorted(
+        ((g["mtime"], uid) for uid, g in groups.items()
+         if uid not in protected and now - g["mtime"] > min_age)
+    )
+    for mtime, uid in candidates:
+        # oldest first: once one is young enough and the quota holds, so do the rest
+        if not (max_age and now - mtime > max_age) and not (quota and total > quota):
+            break
+        group = groups[uid]
+        for path in group["paths"]:
+            try:
+                os.remove(path)
+                stats["deleted_files"] += 1
+            except OSError:
+                pass
+        total -= group["bytes"]
+        stats["deleted_bytes"] += group["bytes"]
+    stats["files"] -= stats["deleted_files"]
+    stats["bytes"] = total
+    return stats
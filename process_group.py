@@ -0,0 +1,49 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Scanner subprocesses in their own process group, stopped as a whole
+
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+
+# seconds between SIGTERM and SIGKILL when stopping a scanner
+KILL_GRACE = float(os.environ.get("SCAN_KILL_GRACE", 3))
+
+
+def group_kwargs() -> dict:
+    """create_subprocess_exec() arguments that start a new process group,
+    so the scanner and anything it forks can be signalled together."""
+    if sys.platform == "win32":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def signal_group(process, sig):
+    if process.returncode is not None:
+        return
+    try:
+        if sys.platform == "win32":
+            process.kill()
+        else:
+            os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def stop_group(process, grace: float = None):
+    """SIGTERM the process group, SIGKILL it if the leader is still alive
+    after grace seconds, and reap the leader.
+
+    Safe to await from an except/finally block of a cancelled task.
+    """
+    if process.returncode is not None:
+        return
+    grace = KILL_GRACE if grace is None else grace
+    signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), grace)
+    except asyncio.TimeoutError:
+        signal_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+        await process.wait()
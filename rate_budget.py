@@ -0,0 +1,117 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Global packets-per-second budget shared by concurrent nmap processes
+
+import itertools
+import re
+import threading
+import time
+from typing import Optional
+
+# "Raw packets sent: 2002 (88.064KB) | Rcvd: ..." (printed at the end with -v)
+PACKETS_SENT = re.compile(r"Raw packets sent: (\d+)")
+
+
+def flag_value(cmd: list, flag: str) -> Optional[float]:
+    for arg, value in zip(cmd, cmd[1:]):
+        if arg == flag:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def with_max_rate(cmd: list, rate: int) -> list:
+    """argv with --max-rate set to rate (and --min-rate lowered to it,
+    nmap refuses a minimum above the maximum)."""
+    argv = [cmd[0]]
+    skip = False
+    for arg, value in zip(cmd[1:], cmd[2:] + [None]):
+        if skip:
+            skip = False
+            continue
+        if arg == "--max-rate":
+            skip = True
+            continue
+        if arg == "--min-rate" and value is not None:
+            argv += [arg, str(min(int(float(value)), rate))]
+            skip = True
+            continue
+        argv.append(arg)
+    return argv[:1] + ["--max-rate", str(rate)] + argv[1:]
+
+
+def observed_rate(stdout: str, elapsed: float) -> Optional[float]:
+    match = PACKETS_SENT.search(stdout or "")
+    if not match or elapsed <= 0:
+        return None
+    return round(int(match.group(1)) / elapsed, 1)
+
+
+class Lease:
+    __slots__ = ("id", "priority", "requested", "allocated", "started", "key")
+
+    def __init__(self, lease_id, priority, requested, allocated, key):
+        self.id = lease_id
+        self.priority = priority
+        self.requested = requested
+        self.allocated = allocated
+        self.started = time.monotonic()
+        self.key = key
+
+    def info(self) -> dict:
+        return {"allocated": self.allocated, "requested": self.requested, "priority": self.priority}
+
+
+class RateBudget:
+    """Splits budget packets/s among running nmap processes by priority.
+
+    nmap can't change its rate while running, so a process gets its rate
+    when it starts: its weighted share of the budget among the processes
+    running at that moment plus the slots() still free (counted at weight
+    1, so the first scan does not take everything), but no more than the
+    others left unallocated (never below floor) and no more than the
+    caller's own --max-rate. Released rate goes to the next processes
+    started (for example the next shards of a sharded scan), which is how
+    the split rebalances.
+    """
+
+    def __init__(self, budget: int, weights: dict, floor: int = 10, slots=None):
+        self.budget = budget
+        self.weights = weights
+        self.floor = floor
+        self.slots = slots
+        self.leases = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def weight(self, priority: int) -> float:
+        return self.weights.get(priority, 1)
+
+    def acquire(self, priority: int, requested: Optional[float] = None, key: Optional[str] = None) -> Lease:
+        with self.lock:
+            idle = max(0, self.slots() - len(self.leases) - 1) if self.slots else 0
+            total = sum(self.weight(l.priority) for l in self.leases.values()) + self.weight(priority) + idle
+            share = self.budget * self.weight(priority) / total
+            free = self.budget - sum(l.allocated for l in self.leases.values())
+            rate = max(self.floor, int(min(share, free)))
+            if requested:
+                rate = min(rate, int(requested))
+            lease = Lease(next(self.counter), priority, requested, max(1, rate), key)
+            self.leases[lease.id] = lease
+            return lease
+
+    def release(self, lease: Lease):
+        with self.lock:
+            self.leases.pop(lease.id, None)
+
+    def status(self) -> dict:
+        with self.lock:
+            leases = list(self.leases.values())
+        return {
+            "budget": self.budget,
+            "allocated": sum(l.allocated for l in leases),
+            "scans": [dict(l.info(), key=l.key, running_for=round(time.monotonic() - l.started, 3))
+                      for l in leases],
+        }
@@ -0,0 +1,293 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Host and port differences between two pre-parsed scan reports
+
+import ipaddress
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from result_index import ReportIndex, file_key
+
+PORT_FIELDS = ("state", "service", "banner")
+# per-port changes: opened/closed (to or from "open"), added/removed
+# (present in one report only, never open), changed (state, service or banner)
+PORT_CHANGES = ("opened", "closed", "added", "removed", "changed")
+
+
+def translate(base: ReportIndex, head: ReportIndex, key: str, column=None) -> array:
+    """base's code column for key re-encoded with head's dictionary, so
+    equal values compare equal; values head never saw get codes past the
+    end of head's dictionary. The typecode stays base's, which is head's."""
+    codes = head.codes[key]
+    unseen = len(head.dicts[key])
+    table = [codes.get(v, unseen + i) for i, v in enumerate(base.dicts[key])]
+    column = base.rows[key] if column is None else column
+    return array(column.typecode, map(table.__getitem__, column))
+
+
+def port_fields(index: ReportIndex, row: int) -> dict:
+    return {k: index.dicts[k][index.rows[k][row]] for k in PORT_FIELDS}
+
+
+class ReportDiff:
+    """Differences between two reports, filtered and paginated like /file.
+
+    Building it only finds the hosts that differ: hosts present in both
+    reports are compared column by column on their port rows, on
+    dictionary codes, so unchanged hosts cost a few slice comparisons.
+    The port changes of a host are worked out, and decoded, when a page or
+    a port level filter first needs them; count_ports() works them all out
+    once for the summary's port counts.
+    """
+
+    def __init__(self, base: ReportIndex, head: ReportIndex):
+        self.base = base
+        self.head = head
+        # entries: (head host or None, base host or None, change)
+        self.entries = []
+        # port changes per entry, filled in on first use; a port change is
+        # (port, protocol code, kind, base row, head row) with protocol
+        # codes in head's dictionary (past its end: base only)
+        self.changes = []
+        self.summary = {"hosts_added": 0, "hosts_removed": 0, "hosts_changed": 0}
+        # None, with ports_pending set, until count_ports() has run
+        self.summary.update({f"ports_{c}": None for c in PORT_CHANGES})
+        self.summary["ports_pending"] = True
+        self.build()
+
+    def build(self):
+        base, head = self.base, self.head
+        base_hosts = {addr: b for b, addr in enumerate(base.addresses)}
+        base_status = translate(base, head, "status", base.status)
+        # same typecode on both sides keeps the slice comparisons in C
+        self.b_port, self.h_port = base.rows["port"], head.rows["port"]
+        self.b_proto, self.h_proto = translate(base, head, "protocol"), head.rows["protocol"]
+        self.b_state, self.h_state = translate(base, head, "state"), head.rows["state"]
+        self.b_service, self.h_service = translate(base, head, "service"), head.rows["service"]
+        self.b_banner, self.h_banner = translate(base, head, "banner"), head.rows["banner"]
+        b_port, h_port, b_proto, h_proto = self.b_port, self.h_port, self.b_proto, self.h_proto
+        b_state, h_state, b_service, h_service = self.b_state, self.h_state, self.b_service, self.h_service
+        b_banner, h_banner = self.b_banner, self.h_banner
+        self.is_open = head.codes["state"].get("open")
+        was_open = base.codes["state"].get("open")
+        if was_open is not None:
+            was_open = head.codes["state"].get("open", len(head.dicts["state"]) + was_open)
+        self.was_open = was_open
+        base.host_rows(0)
+        head.host_rows(0)
+        b_starts, h_starts, h_status = base.starts, head.starts, head.status
+        summary = self.summary
+        entries = self.entries
+        seen = set()
+        for h, addr in enumerate(head.addresses):
+            b = base_hosts.get(addr)
+            if b is None:
+                summary["hosts_added"] += 1
+                entries.append((h, None, "added"))
+                continue
+            seen.add(b)
+            bs, be, hs, he = b_starts[b], b_starts[b + 1], h_starts[h], h_starts[h + 1]
+            if base_status[b] == h_status[h] and be - bs == he - hs:
+                if b_port[bs:be] == h_port[hs:he] and b_state[bs:be] == h_state[hs:he] \
+                        and b_proto[bs:be] == h_proto[hs:he] and b_service[bs:be] == h_service[hs:he] \
+                        and b_banner[bs:be] == h_banner[hs:he]:
+                    continue
+                # same ports in a different order
+                if sum(b_port[bs:be]) == sum(h_port[hs:he]) and \
+                        sorted(zip(b_port[bs:be], b_proto[bs:be], b_state[bs:be], b_service[bs:be], b_banner[bs:be])) \
+                        == sorted(zip(h_port[hs:he], h_proto[hs:he], h_state[hs:he], h_service[hs:he], h_banner[hs:he])):
+                    continue
+            summary["hosts_changed"] += 1
+            entries.append((h, b, "changed"))
+        for b in range(len(base)):
+            if b not in seen:
+                summary["hosts_removed"] += 1
+                entries.append((None, b, "removed"))
+        self.changes = [None] * len(entries)
+
+    def port_changes(self, n: int) -> list:
+        """The port changes of entry n."""
+        ports = self.changes[n]
+        if ports is not None:
+            return ports
+        h, b, change = self.entries[n]
+        ports = []
+        if change != "changed":
+            side_head = change == "added"
+            start, end = (self.head if side_head else self.base).host_rows(h if side_head else b)
+            state, port, proto = (self.h_state, self.h_port, self.h_proto) if side_head \
+                else (self.b_state, self.b_port, self.b_proto)
+            is_open, kinds = (self.is_open, ("opened", "added")) if side_head \
+                else (self.was_open, ("closed", "removed"))
+            for r in range(start, end):
+                kind = kinds[0] if state[r] == is_open else kinds[1]
+                ports.append((port[r], proto[r], kind, None if side_head else r, r if side_head else None))
+            self.changes[n] = ports
+            return ports
+        bs, be = self.base.host_rows(b)
+        hs, he = self.head.host_rows(h)
+        b_state, h_state = self.b_state, self.h_state
+        old = dict(zip(zip(self.b_port[bs:be], self.b_proto[bs:be]), range(bs, be)))
+        new = dict(zip(zip(self.h_port[hs:he], self.h_proto[hs:he]), range(hs, he)))
+        for key in old.keys() | new.keys():
+            br, hr = old.get(key), new.get(key)
+            if br is not None and hr is not None and b_state[br] == h_state[hr] \
+                    and self.b_service[br] == self.h_service[hr] and self.b_banner[br] == self.h_banner[hr]:
+                continue
+            opened = hr is not None and h_state[hr] == self.is_open
+            closed = br is not None and b_state[br] == self.was_open
+            if opened and not closed:
+                kind = "opened"
+            elif closed and not opened:
+                kind = "closed"
+            elif br is None:
+                kind = "added"
+            elif hr is None:
+                kind = "removed"
+            else:
+                kind = "changed"
+            ports.append((key[0], key[1], kind, br, hr))
+        self.changes[n] = ports
+        return ports
+
+    def count_ports(self):
+        """Fill in the summary's port counts."""
+        counts = dict.fromkeys(PORT_CHANGES, 0)
+        for n in range(len(self.entries)):
+            for p in self.port_changes(n):
+                counts[p[2]] += 1
+        self.summary.update({f"ports_{c}": v for c, v in counts.items()})
+        self.summary["ports_pending"] = False
+
+    def protocol(self, code: int) -> str:
+        names = self.head.dicts["protocol"]
+        return names[code] if code < len(names) else self.base.dicts["protocol"][code - len(names)]
+
+    def address(self, entry: tuple) -> str:
+        h, b = entry[0], entry[1]
+        return self.head.addresses[h] if h is not None else self.base.addresses[b]
+
+    def decode(self, entry: tuple, ports: list) -> dict:
+        h, b, change = entry[0], entry[1], entry[2]
+        status = {"base": self.base.dicts["status"][self.base.status[b]] if b is not None else None,
+                  "head": self.head.dicts["status"][self.head.status[h]] if h is not None else None}
+        decoded = []
+        for port, proto, kind, br, hr in ports:
+            item = {"port": port, "protocol": self.protocol(proto), "change": kind}
+            if change == "changed":
+                bf = port_fields(self.base, br) if br is not None else None
+                hf = port_fields(self.head, hr) if hr is not None else None
+                item.update(base=bf, head=hf)
+                if bf is not None and hf is not None:
+                    item["fields"] = [k for k in PORT_FIELDS if bf[k] != hf[k]]
+            elif change == "added":
+                item["head"] = port_fields(self.head, hr)
+            else:
+                item["base"] = port_fields(self.base, br)
+            decoded.append(item)
+        if change == "changed":
+            decoded.sort(key=lambda p: (p["port"], p["protocol"]))
+        return {"address": self.address(entry), "change": change, "status": status, "ports": decoded}
+
+    def query(self, hosts=None, changes=None, ports=None, protocols=None, kinds=None,
+              services=None, cursor: int = 0, limit: int = 100) -> dict:
+        networks = [ipaddress.ip_network(h, strict=False) for h in hosts] if hosts else None
+        port_level = bool(ports or protocols or kinds or services)
+        base, head = self.base, self.head
+        if services:
+            b_services = {base.codes["service"][s] for s in services if s in base.codes["service"]}
+            h_services = {head.codes["service"][s] for s in services if s in head.codes["service"]}
+        b_service, h_service = base.rows["service"], head.rows["service"]
+
+        def port_match(p):
+            port, proto, kind, br, hr = p
+            if ports and port not in ports:
+                return False
+            if protocols and self.protocol(proto) not in protocols:
+                return False
+            if kinds and kind not in kinds:
+                return False
+            if services and not ((br is not None and b_service[br] in b_services)
+                                 or (hr is not None and h_service[hr] in h_services)):
+                return False
+            return True
+
+        data = []
+        total = 0
+        next_cursor = None
+        for n, entry in enumerate(self.entries):
+            if changes and entry[2] not in changes:
+                continue
+            if networks:
+                try:
+                    ip = ipaddress.ip_address(self.address(entry))
+                except ValueError:
+                    continue
+                if not any(ip in net for net in networks):
+                    continue
+            if port_level or (n >= cursor and len(data) < limit):
+                matching = self.port_changes(n)
+            if port_level:
+                matching = [p for p in matching if port_match(p)]
+                if not matching:
+                    continue
+            total += 1
+            if n < cursor:
+                continue
+            if len(data) < limit:
+                data.append(self.decode(entry, matching))
+            elif next_cursor is None:
+                next_cursor = n
+        return {"data": data, "total": total, "next_cursor": next_cursor, "summary": dict(self.summary)}
+
+
+class DiffCache:
+    """A few computed ReportDiff objects, keyed on both reports' file_key.
+
+    Concurrent requests for a diff that isn't cached yet wait for one build.
+    Port counts are worked out one diff at a time on a single worker
+    thread, so the first page goes out without waiting for them.
+    """
+
+    def __init__(self, indexes, max_entries: int = 4):
+        self.indexes = indexes
+        self.max_entries = max_entries
+        # key -> Future of the ReportDiff, set once it is built
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diff-count")
+
+    def get(self, base_xml: str, head_xml: str) -> ReportDiff:
+        key = (file_key(base_xml), file_key(head_xml))
+        build = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            else:
+                entry = self.entries[key] = Future()
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                build = True
+        if not build:
+            return entry.result()
+        try:
+            diff = ReportDiff(self.indexes.get(base_xml), self.indexes.get(head_xml))
+        except BaseException as e:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            entry.set_exception(e)
+            raise
+        entry.set_result(diff)
+        self.counter.submit(self.count, key, entry)
+        return diff
+
+    def count(self, key: tuple, entry: Future):
+        # diffs evicted while waiting for the worker aren't counted
+        with self.lock:
+            if self.entries.get(key) is not entry:
+                return
+        entry.result().count_ports()
@@ -0,0 +1,324 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Pre-parsed scan results stored next to the Nmap XML they came from
+
+import ipaddress
+import json
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from itertools import accumulate
+
+from nmap_xml import iter_nmap_hosts
+from output_store import locate, open_output
+
+# one compact JSON host record per line, in report order
+PARSED_SUFFIX = ".hosts.ndjson"
+# per-host offsets plus a flattened, dictionary encoded port table
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+
+def parsed_path(xml_path: str) -> str:
+    return xml_path + PARSED_SUFFIX
+
+
+def index_path(xml_path: str) -> str:
+    return xml_path + INDEX_SUFFIX
+
+
+def is_fresh(xml_path: str, derived: str) -> bool:
+    # a compressed report keeps the mtime of the XML it replaced
+    try:
+        return os.stat(derived).st_mtime_ns >= os.stat(locate(xml_path) or xml_path).st_mtime_ns
+    except OSError:
+        return False
+
+
+class Encoder:
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {v: i for i, v in enumerate(self.values)}
+
+    def code(self, value) -> int:
+        value = "" if value is None else str(value)
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def build_parsed(xml_path: str) -> str:
+    """Convert an Nmap XML report into its pre-parsed form and index (once)."""
+    dest = parsed_path(xml_path)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp, tmp_index = dest + suffix, index_path(xml_path) + suffix
+    offsets, addresses = [0], []
+    status = array("B")
+    rows = {"host": array("I"), "port": array("i"), "protocol": array("H"),
+            "state": array("H"), "service": array("I"), "banner": array("I")}
+    dicts = {k: Encoder() for k in ("status", "protocol", "state", "service", "banner")}
+    try:
+        with open(tmp, "wb") as out, open_output(xml_path) as src:
+            for n, record in enumerate(iter_nmap_hosts(src)):
+                line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+                out.write(line)
+                offsets.append(offsets[-1] + len(line))
+                addresses.append(record["address"])
+                status.append(dicts["status"].code(record["status"]))
+                for port in record["ports"]:
+                    rows["host"].append(n)
+                    rows["port"].append(port["port"])
+                    for key in ("protocol", "state", "service", "banner"):
+                        rows[key].append(dicts[key].code(port[key]))
+        with open(tmp_index, "w") as out:
+            json.dump({
+                "version": INDEX_VERSION,
+                "offsets": offsets,
+                "addresses": addresses,
+                "status": status.tolist(),
+                "rows": {k: v.tolist() for k, v in rows.items()},
+                "dicts": {k: v.values for k, v in dicts.items()},
+            }, out, separators=(",", ":"))
+        os.replace(tmp, dest)
+        os.replace(tmp_index, index_path(xml_path))
+    except Exception:
+        for path in (tmp, tmp_index):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return dest
+
+
+def ensure_parsed(xml_path: str) -> str:
+    dest = parsed_path(xml_path)
+    if not (is_fresh(xml_path, dest) and is_fresh(xml_path, index_path(xml_path))):
+        try:
+            build_parsed(xml_path)
+        except Exception as e:
+            raise ValueError(f"Failed to parse Nmap XML file: {e}")
+    return dest
+
+
+def load_report_json(xml_path: str) -> bytes:
+    """JSON array of all host records, built from the pre-parsed form
+    without decoding a single record."""
+    with open(ensure_parsed(xml_path), "rb") as f:
+        lines = f.read().splitlines()
+    return b"[" + b",".join(lines) + b"]"
+
+
+class ByteLRU:
+    """LRU of encoded responses bounded by their total size in bytes.
+
+    Keys should include the source file's mtime and size so a rewritten
+    report never serves stale bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+def file_key(path: str) -> tuple:
+    st = os.stat(locate(path) or path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+class ReportIndex:
+    """Loaded form of a report's .index.json, answering filtered,
+    projected and paginated host queries while reading only the matching
+    records from the .hosts.ndjson file."""
+
+    def __init__(self, xml_path: str):
+        self.records = parsed_path(xml_path)
+        with open(index_path(xml_path)) as f:
+            data = json.load(f)
+        self.offsets = array("Q", data["offsets"])
+        self.addresses = data["addresses"]
+        self.status = array("B", data["status"])
+        self.rows = {
+            "host": array("I", data["rows"]["host"]),
+            "port": array("i", data["rows"]["port"]),
+            "protocol": array("H", data["rows"]["protocol"]),
+            "state": array("H", data["rows"]["state"]),
+            "service": array("I", data["rows"]["service"]),
+            "banner": array("I", data["rows"]["banner"]),
+        }
+        self.dicts = data["dicts"]
+        self.codes = {k: {v: i for i, v in enumerate(vals)} for k, vals in self.dicts.items()}
+        # built on first use: row ids by port / service code, and where
+        # each host's rows start (rows are stored host by host)
+        self.postings = {}
+        self.starts = None
+        self.ips = None
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def posting(self, key: str) -> dict:
+        table = self.postings.get(key)
+        if table is None:
+            table = {}
+            for row, value in enumerate(self.rows[key]):
+                table.setdefault(value, array("I")).append(row)
+            self.postings[key] = table
+        return table
+
+    def host_rows(self, host: int) -> tuple:
+        """(first, end) row ids of a host's ports."""
+        if self.starts is None:
+            counts = Counter(self.rows["host"])
+            self.starts = array("I", accumulate((counts.get(h, 0) for h in range(len(self))), initial=0))
+        return self.starts[host], self.starts[host + 1]
+
+    def read(self, host: int) -> dict:
+        with open(self.records, "rb") as f:
+            f.seek(self.offsets[host])
+            return json.loads(f.read(self.offsets[host + 1] - self.offsets[host]))
+
+    def code_set(self, key: str, values):
+        if not values:
+            return None
+        return {self.codes[key].get(v, -1) for v in values}
+
+    def port_rows(self, ports=None, protocols=None, states=None, services=None):
+        """Row ids of the port table matching every given filter, or None
+        when no port level filter was given."""
+        if not (ports or protocols or states or services):
+            return None
+        service_codes = self.code_set("service", services)
+        if ports:
+            by_port = self.posting("port")
+            candidates = [r for p in ports for r in by_port.get(p, ())]
+            candidates.sort()
+        elif service_codes is not None:
+            by_service = self.posting("service")
+            candidates = sorted(r for c in service_codes for r in by_service.get(c, ()))
+        else:
+            candidates = range(len(self.rows["port"]))
+        checks = []
+        for key, codes in (("protocol", self.code_set("protocol", protocols)),
+                           ("state", self.code_set("state", states)),
+                           ("service", service_codes)):
+            if codes is not None:
+                checks.append((self.rows[key], codes))
+        return [r for r in candidates if all(col[r] in codes for col, codes in checks)]
+
+    def address_match(self, networks):
+        if self.ips is None:
+            self.ips = []
+            for addr in self.addresses:
+                try:
+                    self.ips.append(ipaddress.ip_address(addr))
+                except ValueError:
+                    self.ips.append(None)
+        ips = self.ips
+        return lambda h: ips[h] is not None and any(ips[h] in net for net in networks)
+
+    def query(self, hosts=None, status=None, ports=None, protocols=None, states=None,
+              services=None, fields=None, cursor: int = 0, limit: int = 100) -> dict:
+        rows = self.port_rows(ports, protocols, states, services)
+        if rows is None:
+            candidates = range(len(self))
+            matching_rows = None
+        else:
+            matching_rows = {}
+            for r in rows:
+                matching_rows.setdefault(self.rows["host"][r], []).append(r)
+            candidates = sorted(matching_rows)
+        tests = []
+        if hosts:
+            tests.append(self.address_match([ipaddress.ip_network(h, strict=False) for h in hosts]))
+        status_codes = self.code_set("status", status)
+        if status_codes is not None:
+            tests.append(lambda h: self.status[h] in status_codes)
+
+        selected = []
+        total = 0
+        next_cursor = None
+        start = bisect_left(candidates, cursor) if cursor else 0
+        for i in range(len(candidates)):
+            h = candidates[i]
+            if not all(t(h) for t in tests):
+                continue
+            total += 1
+            if i < start:
+                continue
+            if len(selected) < limit:
+                selected.append(h)
+            elif next_cursor is None:
+                next_cursor = h
+
+        data = []
+        for h in selected:
+            record = self.read(h)
+            if matching_rows is not None:
+                wanted = {(self.rows["port"][r], self.dicts["protocol"][self.rows["protocol"][r]])
+                          for r in matching_rows[h]}
+                record["ports"] = [p for p in record["ports"] if (p["port"], p["protocol"]) in wanted]
+            data.append(project(record, fields) if fields else record)
+        return {"data": data, "total": total, "next_cursor": next_cursor}
+
+
+def project(record: dict, fields) -> dict:
+    """Keep only the requested fields; "ports.<name>" selects port fields."""
+    host_fields = [f for f in fields if "." not in f]
+    port_fields = [f.split(".", 1)[1] for f in fields if f.startswith("ports.")]
+    out = {k: record[k] for k in host_fields if k in record and k != "ports"}
+    if port_fields:
+        out["ports"] = [{k: p[k] for k in port_fields if k in p} for p in record["ports"]]
+    elif "ports" in host_fields:
+        out["ports"] = record["ports"]
+    return out
+
+
+class IndexCache:
+    """A few loaded ReportIndex objects, keyed on the report's file_key."""
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, xml_path: str) -> ReportIndex:
+        ensure_parsed(xml_path)
+        key = file_key(xml_path)
+        with self.lock:
+            index = self.entries.get(key)
+            if index is not None:
+                self.entries.move_to_end(key)
+                return index
+        index = ReportIndex(xml_path)
+        with self.lock:
+            self.entries[key] = index
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return index
@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Result cache and single-flight coalescing for identical nmap commands
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from output_store import locate
+
+# flags whose value is a generated path (or only affects progress output)
+VOLATILE_FLAGS = ("-oN", "-oX", "-oA", "--stats-every")
+
+
+def cache_key(cmd: list, private_dir: str = None) -> tuple:
+    """Normalize an argv from command_build so randomized output file names
+    do not make otherwise identical scans look different. Outputs written
+    below private_dir (added by the server, not the user) are dropped."""
+    key = []
+    skip = False
+    for n, arg in enumerate(cmd):
+        if skip:
+            skip = False
+            continue
+        if private_dir and n + 1 < len(cmd) and os.path.dirname(cmd[n + 1]) == private_dir:
+            skip = True
+            continue
+        if arg in VOLATILE_FLAGS:
+            skip = True
+            if arg != "--stats-every":
+                key.append(arg)
+            continue
+        key.append(arg)
+    return tuple(key)
+
+
+class ScanCache:
+    """LRU of finished scan results plus a table of scans still running.
+
+    run() returns (value, status) where status is "hit" (served from the
+    cache), "coalesced" (attached to an identical scan already running) or
+    "miss" (this call ran the scan). A running scan is cancelled when the
+    last caller waiting for it is cancelled.
+    """
+
+    def __init__(self, max_entries: int = 256, max_ttl: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.inflight_meta = {}
+        self.waiters = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    def lookup(self, key: tuple, max_age: float, valid=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored, value = entry
+        age = time.time() - stored
+        if age > self.max_ttl or (valid is not None and not valid(value)):
+            del self.entries[key]
+            return None
+        if age > max_age:
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def store(self, key: tuple, value):
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def running(self, key: tuple):
+        """Metadata the caller attached to an identical scan in progress."""
+        return self.inflight_meta.get(key)
+
+    async def run(self, key: tuple, max_age: float, runner, cacheable=None, valid=None, meta=None):
+        if max_age and max_age > 0:
+            value = self.lookup(key, max_age, valid)
+            if value is not None:
+                self.stats["hits"] += 1
+                return value, "hit"
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            status = "coalesced"
+        else:
+            # the scan runs as its own task so it outlives any one caller;
+            # it is cancelled once every caller has stopped waiting
+            self.stats["misses"] += 1
+            status = "miss"
+            pending = asyncio.ensure_future(runner())
+            self.inflight[key] = pending
+            self.inflight_meta[key] = meta
+            self.waiters[key] = 0
+            pending.add_done_callback(lambda task: self.finished(key, task, cacheable))
+        self.waiters[key] += 1
+        try:
+            value = await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.done():
+                self.waiters[key] -= 1
+                if not self.waiters[key]:
+                    # return once the scan has stopped and released its resources
+                    pending.cancel()
+                    await asyncio.wait({pending})
+            raise
+        return value, status
+
+    def finished(self, key: tuple, task: asyncio.Task, cacheable):
+        del self.inflight[key]
+        del self.inflight_meta[key]
+        del self.waiters[key]
+        if task.cancelled():
+            return
+        if task.exception() is None and (cacheable is None or cacheable(task.result())):
+            self.store(key, task.result())
+
+    def info(self, status: str) -> dict:
+        return dict(self.stats, status=status)
+
+
+def files_exist(*paths) -> bool:
+    # compressed outputs count, /file reads them transparently
+    return all(locate(p) for p in paths if p)
@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Priority and client aware admission control for nmap processes
+
+import asyncio
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+INTERACTIVE = 0   # sync /scan, a client is holding the connection open
+BACKGROUND = 1    # async jobs
+
+
+class Ticket:
+    __slots__ = ("seq", "priority", "client", "cost", "key", "future", "enqueued")
+
+    def __init__(self, seq, priority, client, cost, key, future):
+        self.seq = seq
+        self.priority = priority
+        self.client = client
+        self.cost = cost
+        self.key = key
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class ScanScheduler:
+    """Replacement for a plain semaphore around nmap processes.
+
+    A slot is granted when fewer than max_scans are running and the summed
+    cost of running scans stays within max_cost. Waiters are ordered by
+    priority class, then by how many slots their client already holds
+    (so one client cannot fill the queue for everyone), then FIFO. The
+    head of the queue is never skipped, which keeps expensive scans from
+    starving behind a stream of cheap ones.
+    """
+
+    def __init__(self, max_scans: int = 3, max_cost: int = 6):
+        self.max_scans = max_scans
+        self.max_cost = max_cost
+        self.waiting = []
+        self.running = {}
+        self.running_cost = 0
+        self.by_client = {}
+        self.counter = itertools.count()
+        self.avg_runtime = None
+        self.avg_wait = None
+        # optional callbacks for instrumentation: on_grant(ticket, wait),
+        # on_release(ticket, runtime)
+        self.on_grant = None
+        self.on_release = None
+
+    def order(self, ticket: Ticket):
+        return (ticket.priority, self.by_client.get(ticket.client, 0), ticket.seq)
+
+    def fits(self, cost: int) -> bool:
+        if not self.running:
+            return True
+        return len(self.running) < self.max_scans and self.running_cost + cost <= self.max_cost
+
+    def dispatch(self):
+        while self.waiting:
+            self.waiting.sort(key=self.order)
+            ticket = self.waiting[0]
+            cost = min(ticket.cost, self.max_cost)
+            if not self.fits(cost):
+                return
+            self.waiting.pop(0)
+            self.grant(ticket, cost)
+
+    def grant(self, ticket: Ticket, cost: int):
+        ticket.cost = cost
+        self.running[ticket.seq] = ticket
+        self.running_cost += cost
+        self.by_client[ticket.client] = self.by_client.get(ticket.client, 0) + 1
+        wait = time.monotonic() - ticket.enqueued
+        self.avg_wait = wait if self.avg_wait is None else 0.8 * self.avg_wait + 0.2 * wait
+        if self.on_grant:
+            self.on_grant(ticket, wait)
+        ticket.future.set_result(time.monotonic())
+
+    def release(self, ticket: Ticket, started: float):
+        if self.running.pop(ticket.seq, None) is None:
+            return
+        self.running_cost -= ticket.cost
+        self.by_client[ticket.client] -= 1
+        if not self.by_client[ticket.client]:
+            del self.by_client[ticket.client]
+        runtime = time.monotonic() - started
+        self.avg_runtime = runtime if self.avg_runtime is None else 0.8 * self.avg_runtime + 0.2 * runtime
+        if self.on_release:
+            self.on_release(ticket, runtime)
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, cost: int = 1, priority: int = BACKGROUND, client: str = "default",
+                   key: Optional[str] = None):
+        ticket = Ticket(next(self.counter), priority, client, max(1, cost), key,
+                        asyncio.get_running_loop().create_future())
+        self.waiting.append(ticket)
+        self.dispatch()
+        try:
+            started = await ticket.future
+        except asyncio.CancelledError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            elif ticket.future.done() and not ticket.future.cancelled():
+                self.release(ticket, ticket.future.result())
+            raise
+        try:
+            yield
+        finally:
+            self.release(ticket, started)
+
+    def queue_info(self, key: str) -> Optional[dict]:
+        self.waiting.sort(key=self.order)
+        for position, ticket in enumerate(self.waiting, 1):
+            if ticket.key == key:
+                info = {"queue_position": position, "queued_for": round(time.monotonic() - ticket.enqueued, 3)}
+                if self.avg_runtime is not None:
+                    # every max_scans waiters ahead of us cost roughly one average runtime
+                    rounds = (position - 1) // max(1, self.max_scans) + (1 if len(self.running) >= self.max_scans else 0)
+                    info["estimated_start"] = round(time.time() + rounds * self.avg_runtime, 3)
+                return info
+        return None
+
+    def configure(self, max_scans: Optional[int] = None, max_cost: Optional[int] = None):
+        if max_scans is not None:
+            self.max_scans = max(1, max_scans)
+        if max_cost is not None:
+            self.max_cost = max(1, max_cost)
+        self.dispatch()
+
+    def status(self) -> dict:
+        return {
+            "max_scans": self.max_scans,
+            "max_cost": self.max_cost,
+            "running": len(self.running),
+            "running_cost": self.running_cost,
+            "waiting": len(self.waiting),
+            "clients": dict(self.by_client),
+            "avg_runtime": self.avg_runtime,
+            "avg_wait": self.avg_wait,
+        }
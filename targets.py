@@ -0,0 +1,102 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Nmap target specification expansion used for sharded scans
+
+import ipaddress
+
+# refuse to expand target specs larger than this into individual hosts
+MAX_EXPANDED_TARGETS = 1 << 20
+
+
+def expand_octet(part: str) -> list:
+    values = []
+    for item in part.split(","):
+        if item == "*":
+            item = "0-255"
+        if "-" in item:
+            lo, hi = item.split("-", 1)
+            lo = int(lo) if lo else 0
+            hi = int(hi) if hi else 255
+        else:
+            lo = hi = int(item)
+        if not 0 <= lo <= hi <= 255:
+            raise ValueError(f"Invalid octet range: {item}")
+        values.extend(range(lo, hi + 1))
+    return values
+
+
+def expand_octet_range(spec: str):
+    """Expand nmap octet syntax such as 192.168.0-3.1,5,10-20 or 10.0.*.1."""
+    parts = spec.split(".")
+    if len(parts) != 4:
+        return None
+    try:
+        octets = [expand_octet(p) for p in parts]
+    except ValueError:
+        return None
+    size = len(octets[0]) * len(octets[1]) * len(octets[2]) * len(octets[3])
+    if size > MAX_EXPANDED_TARGETS:
+        raise ValueError(f"Target {spec} expands to more than {MAX_EXPANDED_TARGETS} hosts")
+    return [
+        f"{a}.{b}.{c}.{d}"
+        for a in octets[0] for b in octets[1] for c in octets[2] for d in octets[3]
+    ]
+
+
+def expand_token(token: str) -> list:
+    if "/" in token:
+        try:
+            net = ipaddress.ip_network(token, strict=False)
+        except ValueError:
+            # hostname/prefix, leave it to nmap
+            return [token]
+        if net.num_addresses > MAX_EXPANDED_TARGETS:
+            raise ValueError(f"Target {token} expands to more than {MAX_EXPANDED_TARGETS} hosts")
+        return [str(ip) for ip in net]
+    try:
+        ipaddress.ip_address(token)
+        return [token]
+    except ValueError:
+        pass
+    expanded = expand_octet_range(token)
+    if expanded is not None:
+        return expanded
+    if "," in token:
+        result = []
+        for item in token.split(","):
+            if item:
+                result.extend(expand_token(item))
+        return result
+    return [token]
+
+
+def expand_targets(spec: str) -> list:
+    """Expand a whitespace separated nmap target spec into single targets.
+
+    CIDR blocks, octet ranges and comma lists are expanded; hostnames and
+    anything else nmap understands but we don't are passed through as-is.
+    """
+    targets = []
+    for token in spec.split():
+        targets.extend(expand_token(token))
+        if len(targets) > MAX_EXPANDED_TARGETS:
+            raise ValueError(f"Target list expands to more than {MAX_EXPANDED_TARGETS} hosts")
+    return targets
+
+
+def read_target_file(path: str) -> str:
+    with open(path, "r", errors="ignore") as f:
+        lines = [line.split("#", 1)[0] for line in f]
+    return " ".join(lines)
+
+
+def split_shards(targets: list, count: int) -> list:
+    count = max(1, min(count, len(targets)))
+    size, extra = divmod(len(targets), count)
+    shards = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        shards.append(targets[start:end])
+        start = end
+    return shards
@@ -0,0 +1,227 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Indexed, on-disk cached catalog of nuclei templates for nuclei-api.py
+
+import json
+import os
+import threading
+import time
+
+TEMPLATE_EXTENSIONS = (".yaml", ".yml")
+CATALOG_VERSION = 1
+
+
+def default_templates_dir() -> str:
+    return os.environ.get("NUCLEI_TEMPLATES_DIR", os.path.join(os.path.expanduser("~"), "nuclei-templates"))
+
+
+def split_list(value: str) -> list:
+    value = value.strip().strip("[]")
+    return [v.strip().strip("'\"") for v in value.split(",") if v.strip().strip("'\"")]
+
+
+def scalar(value: str) -> str:
+    return value.strip().strip("'\"")
+
+
+def read_header(path: str) -> dict:
+    """id, name, severity, author and tags of a template.
+
+    Only the top of the file (id and the info block) is read, with a line
+    parser rather than a YAML library: a full catalog has thousands of
+    templates and the request bodies below info are never needed.
+    """
+    header = {"id": "", "name": "", "severity": "", "author": [], "tags": []}
+    in_info = False
+    pending = None
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            indented = line[0] in " \t"
+            if not indented:
+                key, _, value = stripped.partition(":")
+                if key == "id":
+                    header["id"] = scalar(value)
+                    in_info = False
+                elif key == "info":
+                    in_info = True
+                elif header["id"]:
+                    # first key after the header (http:, dns:, ...)
+                    break
+                continue
+            if not in_info:
+                continue
+            if pending and stripped.startswith("- "):
+                header[pending].append(scalar(stripped[2:]))
+                continue
+            pending = None
+            key, _, value = stripped.partition(":")
+            if key in ("name", "severity") and not header[key]:
+                header[key] = scalar(value)
+            elif key in ("author", "tags") and not header[key]:
+                if value.strip():
+                    header[key] = split_list(value)
+                else:
+                    pending = key
+    header["severity"] = header["severity"].lower()
+    return header
+
+
+class TemplateIndex:
+    """Templates plus posting lists by id, tag, severity and category.
+
+    The category of a template is its top-level directory (http, dns,
+    network, ...); `dirs` holds every directory prefix so `-t <dir>/`
+    arguments can be validated too.
+    """
+
+    def __init__(self, root: str, entries: dict):
+        self.root = root
+        self.entries = entries
+        self.templates = sorted(entries.values(), key=lambda t: t["path"])
+        self.by_id = {}
+        self.by_tag = {}
+        self.by_severity = {}
+        self.by_category = {}
+        self.dirs = set()
+        for n, t in enumerate(self.templates):
+            if t["id"]:
+                self.by_id.setdefault(t["id"], n)
+            for tag in t["tags"]:
+                self.by_tag.setdefault(tag.lower(), []).append(n)
+            self.by_severity.setdefault(t["severity"], []).append(n)
+            self.by_category.setdefault(t["category"], []).append(n)
+            parts = t["path"].split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                self.dirs.add("/".join(parts[:i]))
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def get(self, template_id: str):
+        n = self.by_id.get(template_id)
+        return None if n is None else self.templates[n]
+
+    def search(self, q=None, template_id=None, tags=None, severity=None, category=None,
+               path=None, offset: int = 0, limit: int = 100) -> dict:
+        candidates = None
+        for postings in (
+            [self.by_id[i] for i in template_id if i in self.by_id] if template_id else None,
+            [n for t in tags for n in self.by_tag.get(t.lower(), ())] if tags else None,
+            [n for s in severity for n in self.by_severity.get(s.lower(), ())] if severity else None,
+            [n for c in category for n in self.by_category.get(c, ())] if category else None,
+        ):
+            if postings is None:
+                continue
+            candidates = set(postings) if candidates is None else candidates & set(postings)
+        rows = sorted(candidates) if candidates is not None else range(len(self.templates))
+        if path:
+            rows = [n for n in rows if self.templates[n]["path"].startswith(path)]
+        if q:
+            q = q.lower()
+            rows = [n for n in rows if q in self.templates[n]["id"].lower()
+                    or q in self.templates[n]["name"].lower()]
+        return {
+            "total": len(rows),
+            "templates": [self.templates[n] for n in rows[offset:offset + limit]],
+        }
+
+    def unknown_ids(self, ids) -> list:
+        return [i for i in ids if i not in self.by_id]
+
+    def unknown_dirs(self, dirs) -> list:
+        return [d for d in dirs if d.strip("/") not in self.dirs]
+
+    def facets(self) -> dict:
+        return {
+            "total": len(self.templates),
+            "severity": {k: len(v) for k, v in sorted(self.by_severity.items())},
+            "category": {k: len(v) for k, v in sorted(self.by_category.items())},
+            "tags": {k: len(v) for k, v in sorted(self.by_tag.items(), key=lambda kv: -len(kv[1]))[:100]},
+        }
+
+
+class TemplateCatalog:
+    """Catalog persisted as JSON in cache_path and refreshed incrementally.
+
+    refresh() walks the templates directory and only re-reads files whose
+    mtime or size changed; check() does so at most every check_interval
+    seconds, and only when a directory under the root changed.
+    """
+
+    def __init__(self, cache_path: str, root: str = None, check_interval: float = 300):
+        self.cache_path = cache_path
+        self.root = root or default_templates_dir()
+        self.check_interval = check_interval
+        self.index = TemplateIndex(self.root, {})
+        self.signature = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != CATALOG_VERSION or data.get("root") != self.root:
+            return
+        self.signature = data.get("signature")
+        self.index = TemplateIndex(self.root, data["entries"])
+
+    def save(self):
+        tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "root": self.root, "signature": self.signature,
+                       "entries": self.index.entries}, f, separators=(",", ":"))
+        os.replace(tmp, self.cache_path)
+
+    def scan(self):
+        """Template files below root with their stat, plus a directory signature."""
+        files = {}
+        dirs = 0
+        newest = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            dirs += 1
+            newest = max(newest, os.stat(dirpath).st_mtime_ns)
+            for name in filenames:
+                if name.endswith(TEMPLATE_EXTENSIONS):
+                    full = os.path.join(dirpath, name)
+                    st = os.stat(full)
+                    files[os.path.relpath(full, self.root).replace(os.sep, "/")] = (st.st_mtime_ns, st.st_size)
+        return files, [dirs, len(files), newest]
+
+    def refresh(self, force: bool = False) -> dict:
+        with self.lock:
+            self.checked = time.monotonic()
+            if not os.path.isdir(self.root):
+                return {"templates": len(self.index), "changed": 0}
+            files, signature = self.scan()
+            if not force and signature == self.signature:
+                return {"templates": len(self.index), "changed": 0}
+            old = self.index.entries
+            entries = {}
+            changed = 0
+            for rel, (mtime, size) in files.items():
+                entry = old.get(rel)
+                if entry is None or entry["mtime"] != mtime or entry["size"] != size:
+                    try:
+                        entry = dict(read_header(os.path.join(self.root, rel)), path=rel,
+                                     category=rel.split("/", 1)[0] if "/" in rel else "",
+                                     mtime=mtime, size=size)
+                    except OSError:
+                        continue
+                    changed += 1
+                entries[rel] = entry
+            changed += len(set(old) - set(entries))
+            self.signature = signature
+            if changed or len(entries) != len(old):
+                self.index = TemplateIndex(self.root, entries)
+            self.save()
+            return {"templates": len(self.index), "changed": changed}
+
+    def due(self) -> bool:
+        return time.monotonic() - self.checked > self.check_interval
@@ -0,0 +1,253 @@
+# Licensed under the Apache License, Version 2.0 (the "License")
+# @hejhdiss (Muhammed Shafin P)
+# Shared nmap work queue for coordinator / worker deployments
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+OWNED_STATES = ("assigned", "running")
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class WorkQueue:
+    """nmap argv tasks and the workers running them, in one SQLite (WAL)
+    database that the coordinator and every worker open.
+
+    A SQLite file on a shared volume stands in for a networked queue; all
+    access goes through these methods, so another backend only has to
+    provide the same ones.
+
+    Task states: queued -> assigned (dispatch() picked a worker) -> running
+    (the worker claimed it) -> done / failed / cancelled. Tasks of a worker
+    whose last heartbeat is older than worker_timeout are queued again, up
+    to max_attempts times.
+    """
+
+    def __init__(self, path: str, worker_timeout: float = 30.0, max_attempts: int = 3,
+                 retention: float = 3600.0):
+        self.path = path
+        self.worker_timeout = worker_timeout
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "id TEXT PRIMARY KEY, host TEXT, capacity INTEGER NOT NULL, max_cost INTEGER NOT NULL, "
+            "running INTEGER NOT NULL DEFAULT 0, heartbeat REAL NOT NULL, started REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id TEXT PRIMARY KEY, argv TEXT NOT NULL, cost INTEGER NOT NULL, capture INTEGER NOT NULL, "
+            "status TEXT NOT NULL, worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created REAL NOT NULL, updated REAL NOT NULL, result TEXT, error TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_worker ON tasks (worker)")
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE: take the write lock up front so two nodes can't both
+        # read the same queued task and assign it
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    # -------------------------
+    # coordinator side
+    # -------------------------
+    def submit(self, argv: list, cost: int = 1, capture: bool = True) -> str:
+        task_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO tasks (id, argv, cost, capture, status, created, updated) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (task_id, json.dumps(argv), max(1, cost), int(capture), now, now)
+            )
+        return task_id
+
+    def results(self, task_ids: list) -> dict:
+        """{task_id: {"status", "result", "error"}} for the given tasks that have finished."""
+        finished = {}
+        with self.lock:
+            for start in range(0, len(task_ids), 500):
+                chunk = task_ids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self.db.execute(
+                    f"SELECT id, status, result, error FROM tasks WHERE id IN ({marks}) "
+                    f"AND status IN ({','.join('?' * len(FINAL_STATES))})",
+                    (*chunk, *FINAL_STATES)
+                ).fetchall()
+                for task_id, status, result, error in rows:
+                    finished[task_id] = {"status": status, "result": json.loads(result) if result else None,
+                                         "error": error}
+        return finished
+
+    def cancel(self, task_id: str):
+        # a worker running it stops the process at its next heartbeat
+        with self.transaction() as db:
+            db.execute(
+                f"UPDATE tasks SET status = 'cancelled', updated = ? WHERE id = ? "
+                f"AND status NOT IN ({','.join('?' * len(FINAL_STATES))})",
+                (time.time(), task_id, *FINAL_STATES)
+            )
+
+    def cancel_all(self) -> int:
+        """Cancel every unfinished task (nobody waits for them after a coordinator restart)."""
+        with self.transaction() as db:
+            return db.execute(
+                f"UPDATE tasks SET status = 'cancelled', updated = ? "
+                f"WHERE status NOT IN ({','.join('?' * len(FINAL_STATES))})",
+                (time.time(), *FINAL_STATES)
+            ).rowcount
+
+    def dispatch(self, now: Optional[float] = None) -> dict:
+        """Requeue the tasks of dead workers, then hand queued tasks to the
+        least-loaded live workers (by share of their capacity in use)."""
+        now = now or time.time()
+        stats = {"requeued": 0, "failed": 0, "assigned": 0}
+        owned = ",".join("?" * len(OWNED_STATES))
+        with self.transaction() as db:
+            dead = [r[0] for r in db.execute(
+                "SELECT id FROM workers WHERE heartbeat < ?", (now - self.worker_timeout,))]
+            db.executemany("DELETE FROM workers WHERE id = ?", [(w,) for w in dead])
+            lost = db.execute(
+                f"SELECT id, attempts FROM tasks WHERE status IN ({owned}) "
+                "AND (worker IS NULL OR worker NOT IN (SELECT id FROM workers))", OWNED_STATES
+            ).fetchall()
+            for task_id, attempts in lost:
+                if attempts + 1 >= self.max_attempts:
+                    db.execute("UPDATE tasks SET status = 'failed', error = ?, attempts = ?, updated = ? "
+                               "WHERE id = ?", ("Worker lost", attempts + 1, now, task_id))
+                    stats["failed"] += 1
+                else:
+                    db.execute("UPDATE tasks SET status = 'queued', worker = NULL, attempts = ?, updated = ? "
+                               "WHERE id = ?", (attempts + 1, now, task_id))
+                    stats["requeued"] += 1
+
+            workers = {w: {"capacity": cap, "max_cost": max_cost, "count": 0, "cost": 0}
+                       for w, cap, max_cost in db.execute("SELECT id, capacity, max_cost FROM workers")}
+            for w, count, cost in db.execute(
+                    f"SELECT worker, COUNT(*), SUM(cost) FROM tasks WHERE status IN ({owned}) GROUP BY worker",
+                    OWNED_STATES):
+                if w in workers:
+                    workers[w].update(count=count, cost=cost)
+            for task_id, cost in db.execute(
+                    "SELECT id, cost FROM tasks WHERE status = 'queued' ORDER BY created").fetchall():
+                free = [(w["count"] / w["capacity"], w["cost"] / w["max_cost"], name)
+                        for name, w in workers.items()
+                        if w["count"] < w["capacity"]
+                        and (not w["count"] or w["cost"] + min(cost, w["max_cost"]) <= w["max_cost"])]
+                if not free:
+                    # the head of the queue is never skipped, as in ScanScheduler
+                    break
+                name = min(free)[2]
+                workers[name]["count"] += 1
+                workers[name]["cost"] += min(cost, workers[name]["max_cost"])
+                db.execute("UPDATE tasks SET status = 'assigned', worker = ?, updated = ? WHERE id = ?",
+                           (name, now, task_id))
+                stats["assigned"] += 1
+
+            db.execute(f"DELETE FROM tasks WHERE status IN ({','.join('?' * len(FINAL_STATES))}) "
+                       "AND updated < ?", (*FINAL_STATES, now - self.retention))
+        stats["capacity"] = [sum(w["capacity"] for w in workers.values()),
+                             sum(w["max_cost"] for w in workers.values())]
+        return stats
+
+    def workers(self, now: Optional[float] = None) -> list:
+        now = now or time.time()
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, host, capacity, max_cost, running, heartbeat, started FROM workers ORDER BY id"
+            ).fetchall()
+            owned = dict(self.db.execute(
+                f"SELECT worker, COUNT(*) FROM tasks WHERE status IN ({','.join('?' * len(OWNED_STATES))}) "
+                "GROUP BY worker", OWNED_STATES
+            ).fetchall())
+        return [{
+            "id": w, "host": host, "capacity": cap, "max_cost": max_cost, "running": running,
+            "assigned": owned.get(w, 0), "heartbeat_age": round(now - heartbeat, 3),
+            "alive": now - heartbeat <= self.worker_timeout, "started": started,
+        } for w, host, cap, max_cost, running, heartbeat, started in rows]
+
+    def counts(self) -> dict:
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    # -------------------------
+    # worker side
+    # -------------------------
+    def register(self, worker_id: str, host: str, capacity: int, max_cost: int):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO workers (id, host, capacity, max_cost, running, heartbeat, started) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?) ON CONFLICT(id) DO UPDATE SET host = excluded.host, "
+                "capacity = excluded.capacity, max_cost = excluded.max_cost, heartbeat = excluded.heartbeat",
+                (worker_id, host, max(1, capacity), max(1, max_cost), now, now)
+            )
+
+    def heartbeat(self, worker_id: str, running: int, capacity: int, max_cost: int) -> Optional[set]:
+        """Record liveness and load; returns the ids of the tasks the worker
+        still owns (None if it was declared dead and has to register again)."""
+        with self.transaction() as db:
+            updated = db.execute(
+                "UPDATE workers SET running = ?, capacity = ?, max_cost = ?, heartbeat = ? WHERE id = ?",
+                (running, max(1, capacity), max(1, max_cost), time.time(), worker_id)
+            ).rowcount
+            if not updated:
+                return None
+            return {r[0] for r in db.execute(
+                "SELECT id FROM tasks WHERE worker = ? AND status = 'running'", (worker_id,))}
+
+    def claim(self, worker_id: str) -> list:
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT id, argv, cost, capture FROM tasks WHERE worker = ? AND status = 'assigned' "
+                "ORDER BY created", (worker_id,)
+            ).fetchall()
+            db.executemany("UPDATE tasks SET status = 'running', updated = ? WHERE id = ?",
+                           [(time.time(), r[0]) for r in rows])
+        return [{"id": task_id, "argv": json.loads(argv), "cost": cost, "capture": bool(capture)}
+                for task_id, argv, cost, capture in rows]
+
+    def complete(self, task_id: str, worker_id: str, result: dict) -> bool:
+        # only while the worker still owns the task; a requeued copy may be
+        # running elsewhere by now
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE tasks SET status = 'done', result = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (json.dumps(result), time.time(), task_id, worker_id)
+            ).rowcount == 1
+
+    def fail(self, task_id: str, worker_id: str, error: str) -> bool:
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE tasks SET status = 'failed', error = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (error, time.time(), task_id, worker_id)
+            ).rowcount == 1
+
+    def unregister(self, worker_id: str):
+        """Graceful shutdown: hand the worker's tasks straight back to the queue."""
+        with self.transaction() as db:
+            db.execute(
+                f"UPDATE tasks SET status = 'queued', worker = NULL, updated = ? "
+                f"WHERE worker = ? AND status IN ({','.join('?' * len(OWNED_STATES))})",
+                (time.time(), worker_id, *OWNED_STATES)
+            )
+            db.execute("DELETE FROM workers WHERE id = ?", (worker_id,))